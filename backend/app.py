@@ -3,19 +3,26 @@
 校務系統AI助手 - Flask REST API
 """
 
-from flask import Flask, request, jsonify
+import time
+
+# 啟動耗時的起點：開始匯入應用
+_BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from datetime import datetime
+import atexit
 import logging
 from dotenv import load_dotenv
 import os
 
+# 載入環境變數（須在匯入 app.* 之前，模組層級的設定才會讀到 .env）
+load_dotenv()
+
 from app.routes import api_routes
+from app.models import metrics
 from app.models.ai_model import AIModel
 
-# 載入環境變數
-load_dotenv()
-
 # 初始化 Flask 應用
 app = Flask(__name__)
 CORS(app)
@@ -31,8 +38,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 初始化 AI 模型
-ai_model = AIModel()
+# 初始化 AI 模型（不阻塞：後端探測與雲端 SDK 匯入在背景進行）
+ai_model = AIModel(boot_started=_BOOT_STARTED)
+# worker 結束時釋放 Ollama 連線池
+atexit.register(ai_model.close)
 
 # 註冊藍圖
 app.register_blueprint(api_routes.bp)
@@ -42,16 +51,31 @@ app.register_blueprint(api_routes.bp)
 def setup_context():
     from flask import g
     g.ai_model = ai_model
+    ai_model.mark_first_request()
 
 # 健康檢查端點
 @app.route('/health', methods=['GET'])
 def health_check():
-    """健康檢查端點"""
+    """
+    健康檢查端點：程序存活即返回 200
+    
+    ready 表示第一次後端探測已完成，backends 為各後端的可用狀態，startup 為啟動耗時；
+    負載平衡器的就緒檢查可使用 /health?ready=1（尚未就緒時返回 503）
+    """
+    readiness = ai_model.readiness()
+    status = 503 if request.args.get('ready') and not readiness['ready'] else 200
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0'
-    }), 200
+        'version': '1.0.0',
+        **readiness
+    }), status
+
+# Prometheus 指標端點
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文字格式指標；設定 METRICS_DIR 時彙總所有 gunicorn worker"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 # 錯誤處理
 @app.errorhandler(400)
@@ -0,0 +1,224 @@
+"""
+推論請求准入控制模組
+每個後端限制同時進行的推論數，其餘請求在有上限的優先佇列中排隊；
+佇列滿時立即拒絕（API 返回 429 + Retry-After），避免請求堆積到逾時
+
+同一個控制器可同時給同步 (Flask 執行緒) 與非同步 (asyncio) 呼叫端使用；
+限制範圍為單一程序，多個 worker 時總同時數為 worker 數 × 上限。
+gunicorn 需使用 gthread worker（見 gunicorn.conf.py），sync worker 一次只處理一個請求，請求不會進入佇列
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """推論佇列已滿或排隊逾時；retry_after 為建議的重試秒數"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """佇列中的一個等待者；wake 在取得名額時呼叫"""
+    __slots__ = ('wake', 'granted', 'cancelled')
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    """單一後端的同時推論數限制與排隊佇列（priority 數字越小越優先，同優先度先到先服務）"""
+
+    def __init__(self, name, max_concurrency=2, max_queue=32, queue_timeout=60.0):
+        """
+        Args:
+            name: 後端名稱（用於日誌與統計）
+            max_concurrency: 同時進行的推論數上限
+            max_queue: 排隊中的請求數上限，超過即拒絕
+            queue_timeout: 最長排隊秒數
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        # 推論耗時的指數移動平均，用來估計 Retry-After
+        self._service_time = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _retry_after(self):
+        """估計佇列清空所需秒數（須持有鎖）"""
+        service = self._service_time or 1.0
+        return max(1, math.ceil(service * (self.queued + 1) / self.max_concurrency))
+
+    def _enter(self, priority, wake):
+        """
+        嘗試取得名額，否則加入佇列
+
+        Returns:
+            (等待者；直接取得名額時為 None, 進入時的佇列深度)
+        """
+        with self._lock:
+            depth = self.queued
+            if self.active < self.max_concurrency and not self.queued:
+                self.active += 1
+                return None, depth
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f'{self.name} 推論佇列已滿，請稍後再試', self._retry_after())
+            waiter = _Waiter(wake)
+            heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+            self.queued += 1
+            return waiter, depth
+
+    def _abandon(self, waiter):
+        """
+        放棄排隊（逾時或取消）
+
+        Returns:
+            是否在放棄前已取得名額（此時名額歸呼叫端所有）
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.queued -= 1
+            self.timeouts += 1
+            return False
+
+    def _admit(self, started, depth):
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.admitted += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+        return {'queue_depth': depth, 'queue_wait_ms': round(waited * 1000, 2)}
+
+    def _timeout_error(self):
+        with self._lock:
+            retry_after = self._retry_after()
+        logger.warning(f'⚠️ {self.name} 排隊超過 {self.queue_timeout}s')
+        return QueueFullError(f'{self.name} 排隊逾時，請稍後再試', retry_after)
+
+    def acquire(self, priority=0):
+        """
+        取得推論名額（同步，阻塞直到輪到或逾時）
+
+        Returns:
+            {'queue_depth': 進入時排在前面的請求數, 'queue_wait_ms': 排隊毫秒數}
+
+        Raises:
+            QueueFullError: 佇列已滿或排隊逾時
+        """
+        started = time.perf_counter()
+        event = threading.Event()
+        waiter, depth = self._enter(priority, event.set)
+        if waiter is not None and not event.wait(self.queue_timeout) and not self._abandon(waiter):
+            raise self._timeout_error()
+        return self._admit(started, depth)
+
+    async def acquire_async(self, priority=0):
+        """取得推論名額（非同步），回傳值與例外同 acquire"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            # release 可能在其他執行緒呼叫
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter, depth = self._enter(priority, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not self._abandon(waiter):
+                    raise self._timeout_error()
+            except asyncio.CancelledError:
+                # 用戶端中斷連線；若剛好已取得名額，交給下一位
+                if self._abandon(waiter):
+                    self.release()
+                raise
+        return self._admit(started, depth)
+
+    def release(self, service_time=None):
+        """
+        歸還名額，依優先順序喚醒下一個等待者
+
+        Args:
+            service_time: 這次推論佔用名額的秒數，用來估計 Retry-After
+        """
+        with self._lock:
+            if service_time is not None:
+                self._service_time = (service_time if self._service_time is None
+                                      else 0.8 * self._service_time + 0.2 * service_time)
+            while self._heap:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self.queued -= 1
+                waiter.wake()
+                return
+            self.active -= 1
+
+    def stats(self):
+        """佇列統計（本程序）"""
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': round(self._total_wait / self.admitted * 1000, 2) if self.admitted else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 2),
+                'avg_service_ms': round(self._service_time * 1000, 2) if self._service_time else None,
+            }
+
+
+def create_admission_controllers():
+    """
+    依環境變數建立各後端的准入控制器
+
+    OLLAMA_MAX_CONCURRENCY: Ollama 同時推論數（0 表示不限制）
+    OLLAMA_MAX_QUEUE: Ollama 排隊上限
+    CLOUD_MAX_CONCURRENCY / CLOUD_MAX_QUEUE: 每個雲端後端 (gpt / claude) 各自的限制
+    INFERENCE_QUEUE_TIMEOUT: 最長排隊秒數
+
+    Returns:
+        {後端名稱: AdmissionController}
+    """
+    queue_timeout = float(os.getenv('INFERENCE_QUEUE_TIMEOUT', '60'))
+    limits = {
+        'ollama': (int(os.getenv('OLLAMA_MAX_CONCURRENCY', '2')), int(os.getenv('OLLAMA_MAX_QUEUE', '32'))),
+    }
+    cloud = (int(os.getenv('CLOUD_MAX_CONCURRENCY', '8')), int(os.getenv('CLOUD_MAX_QUEUE', '64')))
+    limits['gpt'] = limits['claude'] = cloud
+
+    controllers = {}
+    for backend, (max_concurrency, max_queue) in limits.items():
+        if max_concurrency > 0:
+            controllers[backend] = AdmissionController(backend, max_concurrency, max_queue, queue_timeout)
+    return controllers
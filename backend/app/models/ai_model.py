@@ -8,73 +8,387 @@ AI 模型集成
 import logging
 import os
 import base64
+import threading
 from io import BytesIO
 from PIL import Image
 import json
+import time
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+from . import metrics
+from .admission import QueueFullError, create_admission_controllers
+from .faq import create_faq_answers
+from .image_hash import dhash
+from .image_preprocess import ImagePreprocessor
+from .model_catalog import create_model_catalog
+from .model_registry import ModelSpec, get_model_registry
+from .model_router import create_model_router
+from .ollama_pool import OllamaNodePool
+from .prefix_cache import create_prompt_prefix_cache
+from .prompt_templates import default_template_name, get_prompt_template, ollama_body
+from .residency import create_residency_manager
+from .response_cache import ResponseCache, create_response_cache
+from .dense_retriever import use_ollama_pool
+from .semantic_cache import SemanticCache, create_semantic_cache
+from .single_flight import create_single_flight
 
 logger = logging.getLogger(__name__)
 
+# 預先編碼好的 JSON 請求體使用的標頭
+OLLAMA_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# 沒有可用後端時，指標與路由統計使用的模型名稱
+UNAVAILABLE_MODEL = 'default'
+
+
+class ModelQueryError(Exception):
+    """模型查詢失敗；訊息可直接顯示給使用者"""
+
+
+class ModelErrorMessage(str):
+    """推論失敗時返回給使用者的錯誤訊息：不寫入快取，也不提供給其他 worker 合併的請求"""
+
+
+def is_read_timeout(error):
+    """
+    requests 讀取回應內容時把 urllib3 的 ReadTimeoutError 包成 ConnectionError；
+    這是節點回應太慢而不是連不上，不應暫停節點或改送其他節點
+    """
+    return any(isinstance(arg, ReadTimeoutError) for arg in error.args)
+
+
 class AIModel:
     """AI 模型管理器"""
     
-    def __init__(self):
-        """初始化 AI 模型"""
+    def __init__(self, boot_started: float = None):
+        """
+        初始化 AI 模型
+        
+        不做任何阻塞的網路呼叫：Ollama 節點探測與雲端 SDK 匯入都在背景進行，
+        就緒狀態由 readiness() 提供
+        
+        Args:
+            boot_started: 程序開始匯入應用時的 time.perf_counter()，用來計算啟動耗時
+        """
+        self.boot_started = boot_started if boot_started is not None else time.perf_counter()
+        
+        # 模型登錄表：各模型的後端、是否為視覺模型、截圖尺寸與延遲估計
+        self.model_registry = get_model_registry()
+        
         # 本地 Ollama 配置
         self.ollama_url = os.getenv('OLLAMA_URL', 'http://localhost:11434')
         self.ollama_model = os.getenv('OLLAMA_MODEL', 'llava')  # 推薦使用 llava 視覺模型
-        self.ollama_enabled = os.getenv('OLLAMA_ENABLED', 'true').lower() == 'true'
+        self.ollama_configured = os.getenv('OLLAMA_ENABLED', 'true').lower() == 'true'
+        
+        # 多個 Ollama 節點（逗號分隔），未設定時只使用 OLLAMA_URL
+        self.ollama_urls = [u.strip() for u in os.getenv('OLLAMA_URLS', '').split(',') if u.strip()] or [self.ollama_url]
+        self.ollama_url = self.ollama_urls[0]
+        self.ollama_pool = OllamaNodePool(self.ollama_urls, os.getenv('OLLAMA_ROUTING', 'least_outstanding'))
+        # 背景健康檢查間隔秒數（0 表示停用）
+        self.ollama_health_interval = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '15'))
+        # 模型常駐管理：啟動時預先載入，常用模型以 keep_alive 固定在記憶體中
+        self.residency = create_residency_manager(self.ollama_pool, lambda: self.session, self.ollama_model)
+        # 系統提示前綴：量測、預熱並統計 Ollama KV 快取重用的 prompt token 數
+        self.prompt_prefixes = create_prompt_prefix_cache(self.ollama_pool, lambda: self.session)
+        # 向量檢索的 embedding 請求同樣經由節點池與連線池
+        use_ollama_pool(self.ollama_pool, lambda: self.session)
+        
+        # Ollama HTTP 連線池設定（keep-alive 重用 TCP 連線）
+        self.ollama_pool_size = int(os.getenv('OLLAMA_POOL_SIZE', '10'))
+        self.ollama_max_retries = int(os.getenv('OLLAMA_MAX_RETRIES', '2'))
+        self._session = None
+        self._session_pid = None
+        # 串流模式下兩個片段之間最長等待秒數
+        self.ollama_stream_timeout = float(os.getenv('OLLAMA_STREAM_TIMEOUT', '60'))
         
         # 雲端 API 配置
         self.qwen_api_key = os.getenv('QWEN_API_KEY')
         self.openai_api_key = os.getenv('OPENAI_API_KEY')
         self.claude_api_key = os.getenv('CLAUDE_API_KEY')
+        # 雲端 SDK 在第一次使用時才匯入；CLOUD_SDK_PRELOAD=true 時於背景預先匯入
+        self.cloud_sdk_preload = os.getenv('CLOUD_SDK_PRELOAD', 'true').lower() == 'true'
+        self._claude_client = None
+        self._sdk_state = {}
+        self._sdk_lock = threading.Lock()
+        # 啟動前等待第一次 Ollama 探測完成的最長秒數
+        self.discovery_wait = float(os.getenv('OLLAMA_DISCOVERY_WAIT', '3'))
+        self._discovery_pid = None
+        self._first_request_ms = None
+        
+        # /api/models 的模型目錄：背景探測後預先組好，請求時直接返回
+        self.model_catalog = create_model_catalog(
+            self.ollama_pool,
+            lambda: self.session,
+            {'gpt': self.openai_api_key, 'claude': self.claude_api_key},
+            self.model_registry,
+            self.ollama_configured
+        )
+        
+        # 模型路由：依檢索信心度、是否提到畫面與各模型負載改派本地模型
+        self.router = create_model_router(
+            self.model_registry,
+            self._resolve_backend,
+            self._model_spec,
+            lambda model: self.ollama_pool.choose(model) is not None
+        )
+        
+        # 回應快取：相同模型、prompt 與截圖直接返回先前的回應
+        self.response_cache = create_response_cache()
+        
+        # 常見問題預先產生的回答：只有一個高信心度片段且問題沒有提到畫面時直接返回
+        self.faq_answers = create_faq_answers()
+        
+        # 語意快取：文本模型的回應只取決於 prompt，相近的問法且檢索到相同片段時重用回應
+        self.semantic_cache = create_semantic_cache(self.ollama_pool, lambda: self.session) if self.ollama_configured else None
+        
+        # 相同的並行請求只計算一次（同一台機器的 worker 之間也會合併）
+        self.single_flight = create_single_flight()
+        
+        # 視覺模型的截圖預處理（縮小、裁切、重新編碼）
+        self.image_preprocessor = ImagePreprocessor.from_env(self.model_registry.image_targets())
+        
+        # 各後端的同時推論數限制與排隊佇列
+        self.admission = create_admission_controllers()
         
-        # 初始化各個模型的客戶端
-        self._init_clients()
+        # /metrics 快照前同步佇列、快取與節點統計
+        metrics.REGISTRY.add_collector(self._collect_metrics)
         
-        # 檢查 Ollama 連接
-        self._check_ollama_connection()
+        # 背景探測 Ollama 節點與預先匯入雲端 SDK
+        self._start_discovery()
+        
+        self.init_ms = round((time.perf_counter() - self.boot_started) * 1000, 2)
+        metrics.STARTUP_SECONDS.observe(self.init_ms / 1000, phase='init')
+        logger.info(f'✅ AI 模型初始化完成 ({self.init_ms} ms)，後端探測於背景進行')
     
-    def _check_ollama_connection(self):
-        """檢查 Ollama 是否可用"""
-        try:
-            if self.ollama_enabled:
-                response = requests.get(f'{self.ollama_url}/api/tags', timeout=2)
-                if response.status_code == 200:
-                    logger.info(f'✅ Ollama 連接成功: {self.ollama_url}')
-                    available_models = response.json().get('models', [])
-                    logger.info(f'可用模型: {[m["name"] for m in available_models]}')
-                else:
-                    logger.warning(f'⚠️ Ollama 返回錯誤: {response.status_code}')
-                    self.ollama_enabled = False
-        except Exception as e:
-            logger.warning(f'⚠️ 無法連接到 Ollama ({self.ollama_url}): {str(e)}')
-            self.ollama_enabled = False
+    @property
+    def ollama_enabled(self) -> bool:
+        """
+        Ollama 是否可用：已啟用且至少一個節點健康
+        
+        第一次探測完成前視為可用（查詢時會短暫等待探測結果）；
+        啟動時 Ollama 暫時無法連接也不會永久停用，背景健康檢查恢復節點後自動重新可用
+        """
+        if not self.ollama_configured:
+            return False
+        return self.ollama_pool.healthy or not self.ollama_pool.discovered.is_set()
     
-    def _init_clients(self):
-        """初始化 API 客戶端"""
-        try:
-            if self.qwen_api_key:
-                from dashscope import MultiModalConversation
-                self.qwen_client = MultiModalConversation
-                logger.info('✅ Qwen 客戶端已初始化')
-            
-            if self.openai_api_key:
-                import openai
-                openai.api_key = self.openai_api_key
-                self.openai_client = openai
-                logger.info('✅ OpenAI 客戶端已初始化')
-            
-            if self.claude_api_key:
-                import anthropic
-                self.claude_client = anthropic.Anthropic(api_key=self.claude_api_key)
-                logger.info('✅ Claude 客戶端已初始化')
-        except Exception as e:
-            logger.warning(f'初始化 API 客戶端時出現警告: {str(e)}')
+    @property
+    def session(self):
+        """
+        每個 worker 程序共用的 HTTP Session
+        
+        gunicorn fork 後子程序不可沿用父程序的連線，依 pid 判斷是否重新建立
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = self._build_session()
+            self._session_pid = os.getpid()
+        return self._session
+    
+    def _build_session(self) -> requests.Session:
+        """建立具連線池與重試設定的 Session"""
+        session = requests.Session()
+        # 只重試連線失敗；推論請求已送出後不重送，避免重複生成
+        retry = Retry(
+            total=self.ollama_max_retries,
+            connect=self.ollama_max_retries,
+            read=0,
+            status=0,
+            backoff_factor=0.2
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.ollama_pool_size,
+            pool_maxsize=self.ollama_pool_size,
+            max_retries=retry
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
+    def close(self):
+        """關閉連線池（worker 結束時呼叫）"""
+        if self._session is not None and self._session_pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._session_pid = None
     
-    def process_query(self, question: str, screenshot: str, model_type: str = 'llava') -> str:
+    def _start_discovery(self):
+        """
+        啟動背景的後端探測（每個程序一次；fork 後的 worker 各自重新啟動）
+        
+        - Ollama: 立即以 /api/tags 探測所有節點，之後定期剔除與恢復節點、更新模型列表
+        - 雲端: 已設定密鑰的 SDK 於背景匯入，第一個雲端請求不必等待匯入；定期以模型列表 API 檢查可用狀態
+        """
+        if self._discovery_pid == os.getpid():
+            return
+        self._discovery_pid = os.getpid()
+        if self.ollama_configured:
+            self.ollama_pool.start_probe(lambda: self.session, self.ollama_health_interval,
+                                         on_discovered=self._on_ollama_discovered)
+        if self.cloud_sdk_preload and any(self._sdk_configured().values()):
+            threading.Thread(target=self._preload_sdks, name='cloud-sdk-preload', daemon=True).start()
+        self.model_catalog.start_cloud_probe()
+    
+    def _on_ollama_discovered(self):
+        elapsed = time.perf_counter() - self.boot_started
+        metrics.STARTUP_SECONDS.observe(elapsed, phase='discovery')
+        if not self.ollama_pool.healthy:
+            logger.warning(f'⚠️ 無法連接到 Ollama ({", ".join(self.ollama_urls)})，背景健康檢查恢復後自動啟用')
+        # 知道各節點有哪些模型後才預先載入
+        self.residency.start()
+    
+    def _record_ollama_response(self, model: str, node_url: str, data: dict) -> int:
+        """
+        記錄 Ollama 回應的 token 數與耗時，並交給常駐管理器統計請求組成與冷啟動
+        
+        Returns:
+            重用 KV 快取中系統提示前綴的 token 數
+        """
+        metrics.record_ollama_timing(model, node_url, data)
+        self.residency.record(model, node_url, data)
+        reused = self.prompt_prefixes.record(model, node_url, data)
+        if 'prompt_eval_count' in data:
+            logger.info(f"prompt 處理: {model} {data['prompt_eval_count']} tokens "
+                        f"({data.get('prompt_eval_duration', 0) / 1e6:.0f} ms)，重用前綴 {reused} tokens")
+        return reused
+    
+    def _wait_for_discovery(self):
+        """第一次 Ollama 探測完成前收到的請求，最多等待 OLLAMA_DISCOVERY_WAIT 秒"""
+        self._start_discovery()
+        if not self.ollama_pool.discovered.is_set():
+            self.ollama_pool.discovered.wait(self.discovery_wait)
+    
+    def _sdk_configured(self) -> dict:
+        return {'qwen': bool(self.qwen_api_key), 'gpt': bool(self.openai_api_key), 'claude': bool(self.claude_api_key)}
+    
+    def _load_sdk(self, name: str):
+        """
+        匯入雲端 SDK（只匯入一次）
+        
+        Returns:
+            SDK 模組；未安裝時返回 None
+        """
+        module_name = {'qwen': 'dashscope', 'gpt': 'openai', 'claude': 'anthropic'}[name]
+        with self._sdk_lock:
+            state = self._sdk_state.get(name)
+            if state is not None:
+                return state[1]
+            try:
+                started = time.perf_counter()
+                module = __import__(module_name)
+                self._sdk_state[name] = ('loaded', module)
+                logger.info(f'✅ {module_name} 已匯入 ({(time.perf_counter() - started) * 1000:.0f} ms)')
+            except ImportError:
+                self._sdk_state[name] = ('missing', None)
+                logger.warning(f'⚠️ {module_name} 未安裝')
+            return self._sdk_state[name][1]
+    
+    def _preload_sdks(self):
+        for name, configured in self._sdk_configured().items():
+            if configured:
+                self._load_sdk(name)
+    
+    @property
+    def claude_client(self):
+        """Anthropic 客戶端：第一次呼叫 Claude 時建立"""
+        if self._claude_client is None:
+            anthropic = self._load_sdk('claude')
+            if anthropic is None:
+                raise ModelQueryError("Claude SDK 未安裝，請安裝 anthropic")
+            self._claude_client = anthropic.Anthropic(api_key=self.claude_api_key)
+            logger.info('✅ Claude 客戶端已初始化')
+        return self._claude_client
+    
+    def mark_first_request(self):
+        """記錄從開始匯入應用到收到第一個請求的時間（每個程序一次）"""
+        if self._first_request_ms is not None:
+            return
+        elapsed = time.perf_counter() - self.boot_started
+        self._first_request_ms = round(elapsed * 1000, 2)
+        metrics.STARTUP_SECONDS.observe(elapsed, phase='first_request')
+    
+    def readiness(self) -> dict:
+        """
+        就緒狀態（/health 使用）：ready 表示第一次後端探測已完成
+        
+        Returns:
+            {'ready', 'backends': {...}, 'startup': {...}}
+        """
+        self._start_discovery()
+        pool = self.ollama_pool
+        discovered = pool.discovered.is_set()
+        backends = {
+            'ollama': {
+                'configured': self.ollama_configured,
+                'discovered': discovered,
+                'available': self.ollama_configured and pool.healthy,
+                'nodes_up': sum(1 for node in pool.nodes if node.healthy),
+                'nodes': len(pool.nodes),
+            }
+        }
+        for name, configured in self._sdk_configured().items():
+            state = self._sdk_state.get(name)
+            backends[name] = {
+                'configured': configured,
+                'sdk': state[0] if state else ('pending' if configured else None),
+                'available': configured and (state is None or state[0] == 'loaded'),
+            }
+        return {
+            'ready': discovered or not self.ollama_configured,
+            'backends': backends,
+            'startup': {
+                'init_ms': self.init_ms,
+                'discovery_ms': (round((pool.discovered_at - self.boot_started) * 1000, 2)
+                                 if discovered and pool.discovered_at >= self.boot_started else None),
+                'first_request_ms': self._first_request_ms,
+            },
+        }
+    
+    @staticmethod
+    def _decode_screenshot(screenshot: str) -> bytes:
+        """解碼 base64 截圖（可含 data URL 前綴）"""
+        return base64.b64decode(screenshot.split(',')[1] if ',' in screenshot else screenshot)
+    
+    def _model_spec(self, model: str):
+        """
+        模型的設定：登錄表中的項目，未登錄時由 Ollama 節點回報的模型資訊推斷
+        
+        Returns:
+            ModelSpec，未登錄也未安裝在任何節點上時返回 None
+        """
+        spec = self.model_registry.get(model)
+        if spec is not None or not model:
+            return spec
+        for node in self.ollama_pool.nodes:
+            details = node.model_details.get(model)
+            if details is None and ':' not in model:
+                details = node.model_details.get(f'{model}:latest')
+            if details is not None:
+                return ModelSpec.from_ollama_details(model, details)
+        return None
+    
+    def _resolve_backend(self, model_type: str):
+        """
+        決定請求要交給哪個後端
+        
+        Returns:
+            (後端名稱, 模型名稱)；沒有可用後端時為 (None, UNAVAILABLE_MODEL)，
+            用戶端傳入的任意名稱不會成為指標標籤或路由統計的鍵
+        """
+        spec = self._model_spec(model_type)
+        if spec is not None:
+            return spec.backend, model_type
+        elif self.ollama_enabled:
+            # 未知的模型改用預設的 Ollama 模型
+            return 'ollama', self.ollama_model
+        return None, UNAVAILABLE_MODEL
+    
+    def process_query(self, question: str, screenshot: str = None, model_type: str = 'llava', meta: dict = None,
+                      image_data: bytes = None, context=None) -> str:
         """
         處理使用者查詢
         
@@ -82,159 +396,604 @@ class AIModel:
             question: 使用者的問題
             screenshot: base64 編碼的截圖
             model_type: 使用的模型名稱 (llava/qwen2.5/qwen/gpt/claude)
+            meta: 若提供，寫入回應中繼資料（routed_to、routing_reason、precomputed、cached、semantic_similarity、
+                coalesced、queue_depth、queue_wait_ms）
+            image_data: 已解碼的截圖位元組（二進位上傳端點），提供時忽略 screenshot
+            context: 產生 question 的 RetrievedContext，提供時可使用模型路由、預先產生的回答與語意快取
         
         Returns:
             AI 的回應文本
+        
+        Raises:
+            QueueFullError: 推論佇列已滿或排隊逾時
         """
+        if meta is None:
+            meta = {}
         logger.info(f'處理查詢，模型: {model_type}')
+        backend, model = self._route(model_type, context, meta)
+        metrics.MODEL_REQUESTS.inc(model=model)
+        metrics.MODEL_IN_FLIGHT.inc(model=model)
+        self.router.started(model)
         
         try:
+            precomputed = self._lookup_faq(model, context, meta)
+            if precomputed is not None:
+                return precomputed
+            
             # 解碼截圖
-            image_data = base64.b64decode(screenshot.split(',')[1] if ',' in screenshot else screenshot)
+            if image_data is None:
+                with metrics.STAGE_SECONDS.time(stage='base64_decode'):
+                    image_data = self._decode_screenshot(screenshot)
             
-            # 根據模型類型調用相應的方法
-            if model_type in ['llava', 'llava:34b', 'bakllava', 'qwen2.5', 'qwen:7b', 'qwen:7b-vision', 'qwen2.5vl:7b', 'qwen2.5-vl', 'qwen-vl', 'qwen-vl-chat']:
-                # 所有本地 Ollama 模型
-                return self._query_ollama(question, image_data, model_type)
-            elif model_type == 'gpt':
-                return self._query_gpt(question, image_data)
-            elif model_type == 'claude':
-                return self._query_claude(question, image_data)
-            else:
-                # 默認使用 Ollama 中的 LLaVA
-                if self.ollama_enabled:
-                    return self._query_ollama(question, image_data, 'llava')
-                else:
-                    return "無可用的模型，請檢查配置"
+            cache_entry = self._cache_entry(backend, model, question, image_data)
+            if cache_entry:
+                cached = self.response_cache.get(**cache_entry)
+                if cached is not None:
+                    logger.info(f'✅ 回應快取命中，模型: {model}')
+                    meta['cached'] = True
+                    return cached
+            
+            semantic_entry, cached = self._lookup_semantic(backend, model, context, meta)
+            if cached is not None:
+                return cached
+            
+            def compute():
+                return self._compute_answer(backend, model, question, image_data, cache_entry, meta, semantic_entry)
+            
+            if self.single_flight is None:
+                return compute()
+            answer, coalesced = self.single_flight.do(
+                self._flight_key(model, question, image_data, cache_entry),
+                compute,
+                publishable=self._publishable
+            )
+            if coalesced:
+                logger.info(f'✅ 合併相同的進行中請求，模型: {model}')
+                meta['coalesced'] = True
+            return answer
                 
+        except QueueFullError:
+            # 背壓拒絕是預期中的情況，由路由返回 429
+            metrics.MODEL_ERRORS.inc(model=model, reason='queue_full')
+            raise
         except Exception as e:
             logger.error(f'處理查詢失敗: {str(e)}')
+            metrics.MODEL_ERRORS.inc(model=model, reason='exception')
             raise
+        finally:
+            metrics.MODEL_IN_FLIGHT.dec(model=model)
+            self.router.finished(model)
+    
+    def _compute_answer(self, backend, model, question, image_data, cache_entry, meta, semantic_entry=None):
+        """快取未命中時實際推論並寫入快取；模型錯誤以訊息字串返回且不寫入快取"""
+        computing = time.perf_counter()
+        image_data, image_stats = self._prepare_image(backend, model, image_data)
+        
+        with self._admitted(backend, model, meta):
+            started = time.perf_counter()
+            try:
+                answer = self._dispatch(backend, model, question, image_data)
+            except ModelQueryError as e:
+                # 錯誤訊息直接回給使用者，但不寫入快取
+                metrics.MODEL_ERRORS.inc(model=model, reason='model_error')
+                return ModelErrorMessage(e)
+        self._log_inference(model, time.perf_counter() - started, image_stats)
+        self.router.observe(model, time.perf_counter() - computing)
+        
+        if cache_entry:
+            self.response_cache.set(value=answer, **cache_entry)
+        if semantic_entry:
+            self.semantic_cache.set(answer=answer, **semantic_entry)
+        return answer
+    
+    @staticmethod
+    def _publishable(answer):
+        """只有成功的回答提供給其他 worker；一次暫時的失敗不應傳給所有等待中的請求"""
+        return not isinstance(answer, ModelErrorMessage)
+    
+    @staticmethod
+    def _flight_key(model, question, image_data, cache_entry):
+        """single-flight 的合併鍵，與回應快取的精確鍵相同"""
+        if cache_entry:
+            return cache_entry['key']
+        return ResponseCache.make_key(model, question, ResponseCache.image_digest(image_data))
+    
+    def _cache_entry(self, backend, model, question, image_data):
+        """
+        回應快取的查詢參數：精確鍵、相似比對群組與截圖感知雜湊
+        
+        Returns:
+            get/set 使用的參數字典；快取停用或沒有可用後端時返回 None
+        """
+        if self.response_cache is None or backend is None:
+            return None
+        entry = {'key': ResponseCache.make_key(model, question, ResponseCache.image_digest(image_data))}
+        if self.response_cache.similarity_enabled:
+            # 同一頁面每次截圖的 JPEG 位元組不同，以感知雜湊比對相近的截圖
+            entry['group'] = ResponseCache.make_group(model, question)
+            entry['phash'] = dhash(image_data)
+        return entry
+    
+    def _route(self, model_type, context, meta):
+        """
+        由模型路由決定實際使用的後端與模型；改派時 meta 寫入 routed_to 與 routing_reason
+        
+        Returns:
+            (後端名稱, 模型名稱)
+        """
+        decision = self.router.route(model_type, context)
+        if decision.backend is not None and decision.model != model_type:
+            meta['routed_to'] = decision.model
+            meta['routing_reason'] = decision.reason
+        return decision.backend, decision.model
+    
+    def _lookup_faq(self, model, context, meta):
+        """
+        檢索結果適用時返回預先產生的回答（不解碼截圖、不排隊、不推論）
+        
+        Returns:
+            回答文字，不適用時返回 None；使用時 meta 寫入 precomputed (片段 id)
+        """
+        if self.faq_answers is None or context is None:
+            return None
+        match = self.faq_answers.match(context)
+        if match is None:
+            return None
+        answer, chunk_id = match
+        saved = self.router.expected_latency(model)
+        self.faq_answers.record_hit(saved)
+        logger.info(f'✅ 使用預先產生的回答: {chunk_id}（模型: {model}，估計省下 {saved:.2f}s）')
+        meta['precomputed'] = chunk_id
+        return answer
+    
+    def _lookup_semantic(self, backend, model, context, meta):
+        """
+        查詢語意快取；只用於文本模型（回應不取決於截圖）
+        
+        Returns:
+            (寫入時使用的參數或 None, 快取的回應或 None)；命中時 meta 寫入 cached 與 semantic_similarity
+        """
+        if (self.semantic_cache is None or context is None or backend is None
+                or self._is_vision_model(backend, model)):
+            return None, None
+        with metrics.STAGE_SECONDS.time(stage='semantic_cache'):
+            vector = self.semantic_cache.embed(context.question, context.query_embedding)
+            if vector is None:
+                return None, None
+            entry = {
+                'scope': SemanticCache.scope(model, context.chunk_ids),
+                'question': context.question,
+                'vector': vector,
+            }
+            hit = self.semantic_cache.get(entry['scope'], vector)
+        if hit is None:
+            return entry, None
+        answer, similarity, matched = hit
+        logger.info(f"✅ 語意快取命中，模型: {model}，相似度 {similarity:.3f}（相近問題: '{matched[:30]}'）")
+        meta['cached'] = True
+        meta['semantic_similarity'] = round(similarity, 4)
+        return entry, answer
+    
+    def _queue_priority(self, backend: str, model: str) -> int:
+        """排隊優先度：文本模型推論快得多，排在視覺模型前面（數字越小越優先）"""
+        return 1 if self._is_vision_model(backend, model) else 0
+    
+    @contextmanager
+    def _admitted(self, backend: str, model: str, meta: dict):
+        """
+        在後端的准入控制下執行推論，排隊資訊寫入 meta
+        
+        Raises:
+            QueueFullError: 佇列已滿或排隊逾時
+        """
+        controller = self.admission.get(backend)
+        if controller is None:
+            yield
+            return
+        meta.update(controller.acquire(self._queue_priority(backend, model)))
+        metrics.STAGE_SECONDS.observe(meta['queue_wait_ms'] / 1000, stage='queue_wait')
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            controller.release(time.perf_counter() - started)
+    
+    def _collect_metrics(self):
+        """在指標快照前同步佇列、快取、合併與節點統計"""
+        for backend, controller in self.admission.items():
+            stats = controller.stats()
+            metrics.QUEUE_ACTIVE.set(stats['active'], backend=backend)
+            metrics.QUEUE_DEPTH.set(stats['queued'], backend=backend)
+            metrics.QUEUE_REJECTED.set(stats['rejected'] + stats['timeouts'], backend=backend)
+        if self.response_cache is not None:
+            cache = self.response_cache
+            metrics.CACHE_LOOKUPS.set(cache.hits - cache.similar_hits, result='hit')
+            metrics.CACHE_LOOKUPS.set(cache.similar_hits, result='similar_hit')
+            metrics.CACHE_LOOKUPS.set(cache.misses, result='miss')
+        if self.faq_answers is not None:
+            faq_stats = self.faq_answers.stats()
+            metrics.FAQ_LOOKUPS.set(faq_stats['hits'], result='hit')
+            for reason, count in faq_stats['skipped'].items():
+                metrics.FAQ_LOOKUPS.set(count, result=reason)
+            metrics.FAQ_SAVED_SECONDS.set(faq_stats['saved_seconds'])
+        if self.semantic_cache is not None:
+            metrics.SEMANTIC_CACHE_LOOKUPS.set(self.semantic_cache.hits, result='hit')
+            metrics.SEMANTIC_CACHE_LOOKUPS.set(self.semantic_cache.misses, result='miss')
+        if self.single_flight is not None:
+            metrics.COALESCED.set(self.single_flight.coalesced, scope='local')
+            metrics.COALESCED.set(self.single_flight.coalesced_remote, scope='remote')
+        for node in self.ollama_pool.nodes:
+            metrics.OLLAMA_NODE_UP.set(1 if node.healthy else 0, node=node.url)
+    
+    def queue_stats(self) -> dict:
+        """各後端的推論佇列統計"""
+        return {backend: controller.stats() for backend, controller in self.admission.items()}
+    
+    def _is_vision_model(self, backend: str, model: str) -> bool:
+        """檢查是否是視覺模型（需要圖片）還是文本模型"""
+        if backend is None:
+            return False
+        spec = self._model_spec(model)
+        return spec.vision if spec is not None else backend != 'ollama'
+    
+    def _prepare_image(self, backend: str, model: str, image_data: bytes):
+        """
+        視覺模型的截圖預處理；文本模型不使用圖片，原樣返回
+        
+        Returns:
+            (圖片位元組, 預處理統計或 None)
+        """
+        if not self._is_vision_model(backend, model):
+            return image_data, None
+        with metrics.STAGE_SECONDS.time(stage='image_preprocess'):
+            processed, stats = self.image_preprocessor.process(image_data, model)
+        if stats.get('processed_size'):
+            saved = stats['original_bytes'] - stats['processed_bytes']
+            logger.info(
+                f"圖片預處理: {stats['original_size']} → {stats['processed_size']}, "
+                f"{stats['original_bytes']} → {stats['processed_bytes']} bytes (節省 {saved} bytes), "
+                f"耗時 {stats['preprocess_ms']} ms"
+            )
+        return processed, stats
+    
+    @staticmethod
+    def _log_inference(model: str, elapsed: float, image_stats: dict = None):
+        """記錄推論時間與送出的圖片大小，用來比較預處理前後的推論時間"""
+        if image_stats:
+            logger.info(f"推論完成: {model} 耗時 {elapsed:.2f}s，圖片 {image_stats['processed_bytes']} bytes "
+                        f"(原始 {image_stats['original_bytes']} bytes)")
+        else:
+            logger.info(f'推論完成: {model} 耗時 {elapsed:.2f}s')
+    
+    def _dispatch(self, backend: str, model: str, question: str, image_data: bytes) -> str:
+        """根據模型類型調用相應的方法（Ollama 的耗時在 _query_ollama 中依節點記錄）"""
+        if backend == 'ollama':
+            return self._query_ollama(question, image_data, model)
+        elif backend == 'gpt':
+            with metrics.BACKEND_SECONDS.time(backend=backend, model=model, node=backend):
+                return self._query_gpt(question, image_data)
+        elif backend == 'claude':
+            with metrics.BACKEND_SECONDS.time(backend=backend, model=model, node=backend):
+                return self._query_claude(question, image_data)
+        raise ModelQueryError("無可用的模型，請檢查配置")
+    
+    def stream_query(self, question: str, screenshot: str = None, model_type: str = 'llava', image_data: bytes = None,
+                     context=None):
+        """
+        串流處理使用者查詢，逐步產生回應
+        
+        Args:
+            question: 使用者的問題
+            screenshot: base64 編碼的截圖
+            model_type: 使用的模型名稱
+            image_data: 已解碼的截圖位元組，提供時忽略 screenshot
+            context: 產生 question 的 RetrievedContext，提供時可使用模型路由、預先產生的回答與語意快取
+        
+        Yields:
+            事件字典：
+            - {'type': 'token', 'content': 片段文字}
+            - {'type': 'error', 'message': 錯誤訊息}
+            - {'type': 'done', 'model': 模型名稱, 'timing': 計時資訊}（最後一個事件）
+        
+        Raises:
+            QueueFullError: 推論佇列已滿或排隊逾時（在產生第一個事件之前）
+        """
+        logger.info(f'串流處理查詢，模型: {model_type}')
+        started = time.perf_counter()
+        timing = {}
+        
+        backend, model = self._route(model_type, context, timing)
+        metrics.MODEL_REQUESTS.inc(model=model)
+        with metrics.MODEL_IN_FLIGHT.track(model=model), self.router.track(model):
+            yield from self._stream_events(question, screenshot, image_data, backend, model, started, timing, context)
+    
+    def _stream_events(self, question, screenshot, image_data, backend, model, started, timing, context=None):
+        """stream_query 的主體"""
+        precomputed = self._lookup_faq(model, context, timing)
+        if precomputed is not None:
+            yield {'type': 'token', 'content': precomputed}
+            timing['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            yield {'type': 'done', 'model': model, 'timing': timing}
+            return
+        
+        if image_data is None:
+            with metrics.STAGE_SECONDS.time(stage='base64_decode'):
+                image_data = self._decode_screenshot(screenshot)
+        
+        cache_entry = self._cache_entry(backend, model, question, image_data)
+        cached = self.response_cache.get(**cache_entry) if cache_entry else None
+        semantic_entry = None
+        if cached is None:
+            semantic_entry, cached = self._lookup_semantic(backend, model, context, timing)
+        
+        with ExitStack() as stack:
+            if cached is not None:
+                timing['cached'] = True
+                events = iter([{'type': 'token', 'content': cached}])
+            else:
+                image_data, image_stats = self._prepare_image(backend, model, image_data)
+                if image_stats:
+                    timing['image_bytes'] = image_stats['processed_bytes']
+                    timing['image_original_bytes'] = image_stats['original_bytes']
+                # 串流期間一直佔用推論名額
+                try:
+                    stack.enter_context(self._admitted(backend, model, timing))
+                except QueueFullError:
+                    metrics.MODEL_ERRORS.inc(model=model, reason='queue_full')
+                    raise
+                if backend == 'ollama':
+                    events = self._stream_ollama(question, image_data, model, timing)
+                else:
+                    # 雲端模型不支援串流，整段回應作為單一片段
+                    events = self._single_response(backend, model, question, image_data)
+            
+            parts = []
+            failed = False
+            for event in events:
+                if event['type'] == 'token':
+                    parts.append(event['content'])
+                    if 'first_token_ms' not in timing:
+                        timing['first_token_ms'] = round((time.perf_counter() - started) * 1000, 2)
+                elif event['type'] == 'error':
+                    failed = True
+                    metrics.MODEL_ERRORS.inc(model=model, reason='model_error')
+                yield event
+        
+        # 完整成功的回應寫入快取
+        answer = ''.join(parts).strip()
+        if cached is None and not failed and answer:
+            if cache_entry:
+                self.response_cache.set(value=answer, **cache_entry)
+            if semantic_entry:
+                self.semantic_cache.set(answer=answer, **semantic_entry)
+            self.router.observe(model, time.perf_counter() - started)
+        
+        timing['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        yield {'type': 'done', 'model': model, 'timing': timing}
+    
+    def _single_response(self, backend: str, model: str, question: str, image_data: bytes):
+        """以不串流的方式查詢，整段回應作為單一事件"""
+        try:
+            yield {'type': 'token', 'content': self._dispatch(backend, model, question, image_data)}
+        except ModelQueryError as e:
+            yield {'type': 'error', 'message': str(e)}
+    
+    def _prompt_template(self, backend: str, model: str):
+        """模型使用的 prompt 範本：登錄表指定的範本，未指定時依後端與是否為視覺模型選擇"""
+        spec = self._model_spec(model)
+        if spec is not None and spec.prompt:
+            return get_prompt_template(spec.prompt)
+        return get_prompt_template(default_template_name(backend, self._is_vision_model(backend, model)))
+    
+    def _build_ollama_body(self, question: str, image_data: bytes, model: str, stream: bool = False) -> bytes:
+        """
+        構建 Ollama /api/generate 的 JSON 請求位元組
+        
+        系統提示以 system 欄位送出，每個模型逐位元組相同，Ollama 可重用 KV 快取中的前綴；
+        文本模型（如 Qwen2.5）只發送文字
+        """
+        template = self._prompt_template('ollama', model)
+        # 常駐模型固定在記憶體中，其他模型使用一般的閒置卸載時間
+        keep_alive = self.residency.keep_alive_for(model)
+        self.prompt_prefixes.ensure(model, template, keep_alive)
+        return ollama_body(
+            template,
+            model,
+            question,
+            stream=stream,
+            keep_alive=keep_alive,
+            image_data=image_data if self._is_vision_model('ollama', model) else None
+        )
     
     def _query_ollama(self, question: str, image_data: bytes, model_name: str = None) -> str:
         """
         使用 Ollama 本地模型回應 (推薦!)
         
-        支持的模型:
-        - llava - 視覺語言模型 (推薦用於圖片分析)
-        - qwen2.5 - Qwen 開源版本 (多功能)
-        - qwen:7b - Qwen 7B 版本
-        - bakllava - 輕量視覺模型
+        支持的模型: model_registry.json 中的 Ollama 模型，以及節點上已安裝的其他模型
+        (是否為視覺模型由 /api/tags 的 families 判斷)
         
         無需 API 密鑰，完全本地運行!
+        多個節點時連線失敗的節點會被剔除並改送其他節點
         """
+        url = self.ollama_url
         try:
+            self._wait_for_discovery()
             if not self.ollama_enabled:
-                return "Ollama 未配置或無法連接"
+                raise ModelQueryError("Ollama 未配置或無法連接")
             
             # 使用指定的模型或默認模型
             model = model_name or self.ollama_model
+            body = self._build_ollama_body(question, image_data, model)
             
-            # 編碼圖片為 base64
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
-            
-            # 構建系統提示
-            system_prompt = """你是一個校務系統智能助手。你的職責是幫助成功大學的師生解決校務系統相關的問題。
-
-你的回應應該：
-1. 簡潔明了，直接回答問題
-2. 基於提供的截圖和文本內容
-3. 包含具體的步驟指引（如果適用）
-4. 用繁體中文回應
-5. 如果無法從截圖中獲取足夠信息，請說明
-
-校務系統常見功能：
-- 選課系統
-- 成績查詢
-- 課程表查詢
-- 教室預約
-- 繳費系統
-- 學位查詢"""
-            
-            # 調用 Ollama API
-            logger.info(f'調用 Ollama 模型: {model} ({self.ollama_url})')
-            
-            # 檢查是否是視覺模型（需要圖片）還是文本模型
-            is_vision_model = model.lower() in ['llava', 'bakllava', 'qwen:7b-vision', 'qwen2.5vl:7b', 'qwen2.5-vl', 'qwen-vl', 'qwen-vl-chat']
-            
-            if is_vision_model:
-                # 視覺模型：發送圖片和文字
-                response = requests.post(
-                    f'{self.ollama_url}/api/generate',
-                    json={
-                        'model': model,
-                        'prompt': f"{system_prompt}\n\n用戶問題: {question}",
-                        'stream': False,
-                        'images': [image_base64]  # 發送 base64 編碼的圖片
-                    },
-                    timeout=120  # 給 AI 足夠的時間思考
-                )
-            else:
-                # 文本模型（如 Qwen2.5）：只發送文字
-                response = requests.post(
-                    f'{self.ollama_url}/api/generate',
-                    json={
-                        'model': model,
-                        'prompt': f"{system_prompt}\n\n用戶問題: {question}",
-                        'stream': False
-                    },
-                    timeout=120  # 給 AI 足夠的時間思考
-                )
+            while True:
+                with self.ollama_pool.route(model) as node:
+                    if node is None:
+                        raise ModelQueryError(self._no_ollama_node_message(model))
+                    url = node.url
+                    
+                    # 調用 Ollama API
+                    logger.info(f'調用 Ollama 模型: {model} ({url})')
+                    try:
+                        started = time.perf_counter()
+                        with metrics.BACKEND_SECONDS.time(backend='ollama', model=model, node=url):
+                            response = self.session.post(
+                                f'{url}/api/generate',
+                                data=body,
+                                headers=OLLAMA_JSON_HEADERS,
+                                timeout=120  # 給 AI 足夠的時間思考
+                            )
+                        if response.status_code == 200:
+                            self.ollama_pool.success(node, time.perf_counter() - started)
+                        break
+                    except requests.exceptions.ConnectionError as e:
+                        if is_read_timeout(e):
+                            raise requests.exceptions.ReadTimeout(e)
+                        self.ollama_pool.eject(node, str(e))
+                        if self.ollama_pool.choose(model) is None:
+                            raise
+                        logger.warning(f'改用其他 Ollama 節點重試: {model}')
             
             if response.status_code == 200:
                 result = response.json()
+                self._record_ollama_response(model, url, result)
                 answer = result.get('response', '').strip()
                 logger.info('✅ Ollama 回應成功')
-                return answer if answer else "無法生成回應，請重試"
+                if not answer:
+                    raise ModelQueryError("無法生成回應，請重試")
+                return answer
             else:
                 logger.error(f'Ollama API 錯誤: {response.status_code} - {response.text}')
-                return f"Ollama 回應失敗 ({response.status_code}): {response.text[:200]}"
+                raise ModelQueryError(f"Ollama 回應失敗 ({response.status_code}): {response.text[:200]}")
                 
+        except ModelQueryError:
+            raise
         except requests.exceptions.Timeout:
             logger.error('Ollama 請求超時')
-            return "Ollama 處理超時，請嘗試更簡單的圖片或問題"
+            raise ModelQueryError("Ollama 處理超時，請嘗試更簡單的圖片或問題")
         except requests.exceptions.ConnectionError:
-            logger.error(f'無法連接到 Ollama: {self.ollama_url}')
-            return f"無法連接到 Ollama 服務 ({self.ollama_url})\n\n💡 提示: 確保 Ollama 正在運行:\n  ollama serve"
+            logger.error(f'無法連接到 Ollama: {url}')
+            raise ModelQueryError(f"無法連接到 Ollama 服務 ({url})\n\n💡 提示: 確保 Ollama 正在運行:\n  ollama serve")
         except Exception as e:
             logger.error(f'Ollama 查詢失敗: {str(e)}')
-            return f"Ollama 查詢出錯: {str(e)}"
+            raise ModelQueryError(f"Ollama 查詢出錯: {str(e)}")
+    
+    @staticmethod
+    def _no_ollama_node_message(model: str) -> str:
+        return f"沒有可用的 Ollama 節點提供模型 {model}\n\n💡 提示: 確保 Ollama 正在運行並已下載模型:\n  ollama pull {model}"
+    
+    def _stream_ollama(self, question: str, image_data: bytes, model: str, timing: dict):
+        """
+        以 stream=true 呼叫 Ollama，逐行解析 NDJSON 並產生片段事件
+        
+        讀取逾時只限制「兩個片段之間」的等待時間，不再限制整體生成時間；
+        尚未產生任何片段前連線失敗時改送其他節點
+        
+        Args:
+            timing: 寫入 Ollama 回傳的計時欄位 (eval_count、eval_duration 等)
+        """
+        self._wait_for_discovery()
+        if not self.ollama_enabled:
+            yield {'type': 'error', 'message': "Ollama 未配置或無法連接"}
+            return
+        
+        body = self._build_ollama_body(question, image_data, model, stream=True)
+        while True:
+            with self.ollama_pool.route(model) as node:
+                if node is None:
+                    yield {'type': 'error', 'message': self._no_ollama_node_message(model)}
+                    return
+                
+                logger.info(f'串流調用 Ollama 模型: {model} ({node.url})')
+                emitted = False
+                stream_started = time.perf_counter()
+                try:
+                    with self.session.post(
+                        f'{node.url}/api/generate',
+                        data=body,
+                        headers=OLLAMA_JSON_HEADERS,
+                        timeout=(10, self.ollama_stream_timeout),
+                        stream=True
+                    ) as response:
+                        if response.status_code != 200:
+                            logger.error(f'Ollama API 錯誤: {response.status_code} - {response.text}')
+                            yield {'type': 'error', 'message': f"Ollama 回應失敗 ({response.status_code}): {response.text[:200]}"}
+                            return
+                        
+                        for line in response.iter_lines():
+                            if not line:
+                                continue
+                            try:
+                                data = json.loads(line)
+                            except ValueError:
+                                logger.error(f'Ollama 串流回應無法解析: {line[:200]!r}')
+                                yield {'type': 'error', 'message': "Ollama 串流回應格式錯誤，回應不完整"}
+                                return
+                            if data.get('error'):
+                                yield {'type': 'error', 'message': f"Ollama 查詢出錯: {data['error']}"}
+                                return
+                            if data.get('response'):
+                                emitted = True
+                                yield {'type': 'token', 'content': data['response']}
+                            if data.get('done'):
+                                for key in ('total_duration', 'load_duration', 'prompt_eval_count',
+                                            'prompt_eval_duration', 'eval_count', 'eval_duration'):
+                                    if key in data:
+                                        timing[key] = data[key]
+                                timing['prompt_reused_tokens'] = self._record_ollama_response(model, node.url, data)
+                                break
+                        else:
+                            # 連線正常結束但沒有收到 done=true
+                            logger.error(f'Ollama 串流在完成前結束: {node.url}')
+                            yield {'type': 'error', 'message': "Ollama 串流在完成前結束，回應不完整"}
+                            return
+                    elapsed = time.perf_counter() - stream_started
+                    metrics.BACKEND_SECONDS.observe(elapsed, backend='ollama', model=model, node=node.url)
+                    self.ollama_pool.success(node, elapsed)
+                    logger.info('✅ Ollama 串流回應完成')
+                    return
+                except requests.exceptions.ConnectionError as e:
+                    if is_read_timeout(e):
+                        # 兩個片段之間等待超過 OLLAMA_STREAM_TIMEOUT：節點仍在運作，不暫停也不改送
+                        logger.error(f'Ollama 串流讀取超時: {node.url}')
+                        yield {'type': 'error', 'message': "Ollama 處理超時，請嘗試更簡單的圖片或問題"}
+                        return
+                    # 包含連線逾時；已送出的片段無法撤回，只有尚未產生片段時才改送其他節點
+                    self.ollama_pool.eject(node, str(e))
+                    if emitted or self.ollama_pool.choose(model) is None:
+                        logger.error(f'無法連接到 Ollama: {node.url}')
+                        yield {'type': 'error', 'message': f"無法連接到 Ollama 服務 ({node.url})"}
+                        return
+                    logger.warning(f'改用其他 Ollama 節點重試: {model}')
+                except requests.exceptions.ChunkedEncodingError as e:
+                    # 串流途中連線中斷（Ollama 重啟、節點離線等）
+                    logger.error(f'Ollama 串流連線中斷: {node.url} - {str(e)}')
+                    yield {'type': 'error', 'message': f"Ollama 串流連線中斷 ({node.url})，回應不完整"}
+                    return
+                except requests.exceptions.Timeout:
+                    logger.error('Ollama 串流請求超時')
+                    yield {'type': 'error', 'message': "Ollama 處理超時，請嘗試更簡單的圖片或問題"}
+                    return
     
     def _query_qwen(self, question: str, image_data: bytes) -> str:
         """使用 Qwen 2.5 模型回應"""
         try:
             if not self.qwen_api_key:
-                return "Qwen API 密鑰未配置"
+                raise ModelQueryError("Qwen API 密鑰未配置")
             
+            dashscope = self._load_sdk('qwen')
+            if dashscope is None:
+                raise ModelQueryError("Qwen SDK 未安裝，請安裝 dashscope")
             from dashscope import MultiModalConversation
-            import base64
             
             # 編碼圖片
             image_base64 = base64.b64encode(image_data).decode('utf-8')
-            
-            # 構建系統提示
-            system_prompt = """你是一個校務系統智能助手。你的職責是幫助成功大學的師生解決校務系統相關的問題。
-            
-你的回應應該：
-1. 簡潔明了，直接回答問題
-2. 基於提供的截圖和文本內容
-3. 包含具體的步驟指引（如果適用）
-4. 用繁體中文回應
-5. 如果無法從截圖中獲取足夠信息，請說明
-
-校務系統常見功能：
-- 選課系統
-- 成績查詢
-- 課程表查詢
-- 教室預約
-- 繳費系統
-- 學位查詢"""
+            template = self._prompt_template('qwen', 'qwen')
             
             # 準備消息
             message = {
                 'role': 'user',
                 'content': [
-                    {'type': 'text', 'text': f"系統截圖的問題：{question}"},
+                    {'type': 'text', 'text': template.render(question)},
                     {'type': 'image', 'image': f'data:image/jpeg;base64,{image_base64}'}
                 ]
             }
@@ -243,46 +1002,47 @@ class AIModel:
             response = MultiModalConversation.call(
                 model='qwen-vl-max',
                 messages=[message],
-                system=system_prompt
+                system=template.system
             )
             
             if response.status_code == 200:
                 return response.output.choices[0].message.content[0].text
             else:
                 logger.error(f'Qwen API 錯誤: {response}')
-                return f"Qwen 回應失敗: {response.message}"
+                raise ModelQueryError(f"Qwen 回應失敗: {response.message}")
                 
-        except ImportError:
-            logger.error('dashscope 未安裝')
-            return "Qwen SDK 未安裝，請安裝 dashscope"
+        except ModelQueryError:
+            raise
         except Exception as e:
             logger.error(f'Qwen 查詢失敗: {str(e)}')
-            return f"Qwen 查詢出錯: {str(e)}"
+            raise ModelQueryError(f"Qwen 查詢出錯: {str(e)}")
     
     def _query_gpt(self, question: str, image_data: bytes) -> str:
         """使用 GPT-4V 模型回應"""
         try:
             if not self.openai_api_key:
-                return "OpenAI API 密鑰未配置"
+                raise ModelQueryError("OpenAI API 密鑰未配置")
             
-            import openai
-            import base64
+            openai = self._load_sdk('gpt')
+            if openai is None:
+                raise ModelQueryError("OpenAI SDK 未安裝，請安裝 openai")
+            openai.api_key = self.openai_api_key
             
             # 編碼圖片
             image_base64 = base64.b64encode(image_data).decode('utf-8')
+            template = self._prompt_template('gpt', 'gpt')
             
             response = openai.ChatCompletion.create(
                 model="gpt-4-vision-preview",
                 messages=[
                     {
                         "role": "system",
-                        "content": """你是一個校務系統智能助手。幫助成功大學的師生解決校務系統相關問題。
-回應應簡潔、實用，包含具體步驟（如需要）。使用繁體中文回應。"""
+                        "content": template.system
                     },
                     {
                         "role": "user",
                         "content": [
-                            {"type": "text", "text": f"根據這個校務系統截圖，請回答：{question}"},
+                            {"type": "text", "text": template.render(question)},
                             {
                                 "type": "image_url",
                                 "image_url": {
@@ -297,26 +1057,26 @@ class AIModel:
             
             return response.choices[0].message.content
             
+        except ModelQueryError:
+            raise
         except Exception as e:
             logger.error(f'GPT 查詢失敗: {str(e)}')
-            return f"GPT 查詢出錯: {str(e)}"
+            raise ModelQueryError(f"GPT 查詢出錯: {str(e)}")
     
     def _query_claude(self, question: str, image_data: bytes) -> str:
         """使用 Claude 3 Vision 模型回應"""
         try:
             if not self.claude_api_key:
-                return "Claude API 密鑰未配置"
-            
-            import base64
+                raise ModelQueryError("Claude API 密鑰未配置")
             
             # 編碼圖片
             image_base64 = base64.b64encode(image_data).decode('utf-8')
+            template = self._prompt_template('claude', 'claude')
             
             response = self.claude_client.messages.create(
                 model="claude-3-sonnet-20240229",
                 max_tokens=1024,
-                system="""你是一個校務系統智能助手。幫助成功大學的師生解決校務系統相關問題。
-回應應簡潔、實用，包含具體步驟（如需要）。使用繁體中文回應。""",
+                system=template.system,
                 messages=[
                     {
                         "role": "user",
@@ -331,7 +1091,7 @@ class AIModel:
                             },
                             {
                                 "type": "text",
-                                "text": f"根據這個校務系統截圖，請回答：{question}"
+                                "text": template.render(question)
                             }
                         ]
                     }
@@ -340,48 +1100,20 @@ class AIModel:
             
             return response.content[0].text
             
+        except ModelQueryError:
+            raise
         except Exception as e:
             logger.error(f'Claude 查詢失敗: {str(e)}')
-            return f"Claude 查詢出錯: {str(e)}"
+            raise ModelQueryError(f"Claude 查詢出錯: {str(e)}")
     
     def get_available_models(self) -> dict:
-        """獲取可用的模型列表"""
-        models = {
-            'llava': {
-                'name': '🖥️ LLaVA (本地 Ollama)',
-                'status': 'available' if self.ollama_enabled else 'unconfigured',
-                'description': '視覺模型 - 適合圖片分析',
-                'location': 'local',
-                'url': self.ollama_url if self.ollama_enabled else '未配置'
-            },
-            'qwen2.5': {
-                'name': '🖥️ Qwen 2.5 (本地 Ollama)',
-                'status': 'available' if self.ollama_enabled else 'unconfigured',
-                'description': '多功能模型 - 適合文本分析',
-                'location': 'local',
-                'url': self.ollama_url if self.ollama_enabled else '未配置'
-            },
-            'bakllava': {
-                'name': '🖥️ BakLLaVA (本地 Ollama)',
-                'status': 'available' if self.ollama_enabled else 'unconfigured',
-                'description': '輕量視覺模型 - 快速推理',
-                'location': 'local',
-                'url': self.ollama_url if self.ollama_enabled else '未配置'
-            },
-            'gpt': {
-                'name': '☁️ GPT-4V (雲端)',
-                'status': 'available' if self.openai_api_key else 'unconfigured',
-                'description': 'OpenAI - 需要 API 密鑰',
-                'location': 'cloud'
-            },
-            'claude': {
-                'name': '☁️ Claude 3 Vision (雲端)',
-                'status': 'available' if self.claude_api_key else 'unconfigured',
-                'description': 'Anthropic - 需要 API 密鑰',
-                'location': 'cloud'
-            }
-        }
-        return models
+        """
+        獲取可用的模型列表（背景探測結果的快取，不做網路呼叫）
+        
+        每個模型的 status: available / not_installed / pending / unavailable / unauthorized / unconfigured，
+        本地模型另有 installed、resident (目前載入在記憶體中) 與各節點狀態
+        """
+        return self.model_catalog.get()
     
     @staticmethod
     def validate_image(image_data: bytes) -> bool:
@@ -0,0 +1,441 @@
+"""
+非同步 AI 模型
+以 httpx.AsyncClient 呼叫 Ollama，等待推論時不佔用 worker；
+單一程序即可同時保留數百個進行中的推論請求（ASGI 模式，見 asgi.py）
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+
+import httpx
+
+from . import metrics
+from .admission import QueueFullError
+from .ai_model import OLLAMA_JSON_HEADERS, AIModel, ModelErrorMessage, ModelQueryError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAIModel(AIModel):
+    """
+    AIModel 的非同步版本
+
+    快取、截圖預處理與後端選擇沿用 AIModel；解碼、感知雜湊與預處理等 CPU 工作
+    交給執行緒池，避免阻塞事件迴圈。雲端 SDK 沒有非同步介面，同樣在執行緒池中呼叫。
+    """
+
+    def __init__(self, boot_started: float = None):
+        # 單一程序允許的 Ollama 同時連線數（進行中的推論請求上限）
+        self.async_max_connections = int(os.getenv('ASYNC_MAX_CONNECTIONS', '500'))
+        self._async_client = None
+        self._async_client_loop = None
+        super().__init__(boot_started)
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        目前事件迴圈共用的 AsyncClient
+
+        AsyncClient 的連線綁定在建立它的事件迴圈上，換了迴圈（例如測試時）就重新建立
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = self._build_async_client()
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _build_async_client(self) -> httpx.AsyncClient:
+        """建立具連線池與連線重試設定的 AsyncClient"""
+        limits = httpx.Limits(
+            max_connections=self.async_max_connections,
+            max_keepalive_connections=self.ollama_pool_size
+        )
+        # transport 的 retries 只重試連線失敗，推論請求送出後不重送
+        transport = httpx.AsyncHTTPTransport(retries=self.ollama_max_retries, limits=limits)
+        return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(120, connect=10))
+
+    async def aclose(self):
+        """關閉非同步連線池（ASGI lifespan 結束時呼叫）"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+        self._async_client = None
+        self._async_client_loop = None
+        self.close()
+
+    async def _lookup_cache(self, backend, model, question, image_data):
+        """
+        在執行緒池中計算快取參數並查詢快取
+
+        Returns:
+            (快取參數或 None, 快取的回應或 None)
+        """
+        def lookup():
+            entry = self._cache_entry(backend, model, question, image_data)
+            return entry, (self.response_cache.get(**entry) if entry else None)
+        return await asyncio.to_thread(lookup)
+
+    async def _wait_for_discovery_async(self):
+        """_wait_for_discovery 的非同步版本：等待時不阻塞事件迴圈"""
+        self._start_discovery()
+        if not self.ollama_pool.discovered.is_set():
+            await asyncio.to_thread(self.ollama_pool.discovered.wait, self.discovery_wait)
+
+    @asynccontextmanager
+    async def _admitted_async(self, backend: str, model: str, meta: dict):
+        """_admitted 的非同步版本：排隊時不佔用執行緒"""
+        controller = self.admission.get(backend)
+        if controller is None:
+            yield
+            return
+        meta.update(await controller.acquire_async(self._queue_priority(backend, model)))
+        metrics.STAGE_SECONDS.observe(meta['queue_wait_ms'] / 1000, stage='queue_wait')
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            controller.release(time.perf_counter() - started)
+
+    async def process_query_async(self, question: str, screenshot: str = None, model_type: str = 'llava',
+                                  meta: dict = None, image_data: bytes = None, context=None) -> str:
+        """
+        處理使用者查詢（非同步）
+
+        Args:
+            question: 使用者的問題
+            screenshot: base64 編碼的截圖
+            model_type: 使用的模型名稱
+            meta: 若提供，寫入回應中繼資料（同 process_query）
+            image_data: 已解碼的截圖位元組，提供時忽略 screenshot
+            context: 產生 question 的 RetrievedContext（同 process_query）
+
+        Returns:
+            AI 的回應文本
+
+        Raises:
+            QueueFullError: 推論佇列已滿或排隊逾時
+        """
+        if meta is None:
+            meta = {}
+        logger.info(f'處理查詢 (async)，模型: {model_type}')
+        backend, model = self._route(model_type, context, meta)
+        metrics.MODEL_REQUESTS.inc(model=model)
+        metrics.MODEL_IN_FLIGHT.inc(model=model)
+        self.router.started(model)
+
+        try:
+            precomputed = self._lookup_faq(model, context, meta)
+            if precomputed is not None:
+                return precomputed
+
+            if image_data is None:
+                with metrics.STAGE_SECONDS.time(stage='base64_decode'):
+                    image_data = await asyncio.to_thread(self._decode_screenshot, screenshot)
+
+            cache_entry, cached = await self._lookup_cache(backend, model, question, image_data)
+            if cached is not None:
+                logger.info(f'✅ 回應快取命中，模型: {model}')
+                meta['cached'] = True
+                return cached
+
+            semantic_entry, cached = await asyncio.to_thread(self._lookup_semantic, backend, model, context, meta)
+            if cached is not None:
+                return cached
+
+            def compute():
+                return self._compute_answer_async(backend, model, question, image_data, cache_entry, meta,
+                                                  semantic_entry)
+
+            if self.single_flight is None:
+                return await compute()
+            answer, coalesced = await self.single_flight.do_async(
+                self._flight_key(model, question, image_data, cache_entry),
+                compute,
+                publishable=self._publishable
+            )
+            if coalesced:
+                logger.info(f'✅ 合併相同的進行中請求，模型: {model}')
+                meta['coalesced'] = True
+            return answer
+
+        except QueueFullError:
+            metrics.MODEL_ERRORS.inc(model=model, reason='queue_full')
+            raise
+        except Exception as e:
+            logger.error(f'處理查詢失敗: {str(e)}')
+            metrics.MODEL_ERRORS.inc(model=model, reason='exception')
+            raise
+        finally:
+            metrics.MODEL_IN_FLIGHT.dec(model=model)
+            self.router.finished(model)
+
+    async def _compute_answer_async(self, backend, model, question, image_data, cache_entry, meta,
+                                    semantic_entry=None):
+        """_compute_answer 的非同步版本"""
+        computing = time.perf_counter()
+        image_data, image_stats = await asyncio.to_thread(self._prepare_image, backend, model, image_data)
+
+        async with self._admitted_async(backend, model, meta):
+            started = time.perf_counter()
+            try:
+                answer = await self._dispatch_async(backend, model, question, image_data)
+            except ModelQueryError as e:
+                # 錯誤訊息直接回給使用者，但不寫入快取
+                metrics.MODEL_ERRORS.inc(model=model, reason='model_error')
+                return ModelErrorMessage(e)
+        self._log_inference(model, time.perf_counter() - started, image_stats)
+        self.router.observe(model, time.perf_counter() - computing)
+
+        if cache_entry:
+            await asyncio.to_thread(self.response_cache.set, value=answer, **cache_entry)
+        if semantic_entry:
+            self.semantic_cache.set(answer=answer, **semantic_entry)
+        return answer
+
+    async def _dispatch_async(self, backend: str, model: str, question: str, image_data: bytes) -> str:
+        """根據模型類型調用相應的方法；雲端模型在執行緒池中呼叫同步 SDK"""
+        if backend == 'ollama':
+            return await self._query_ollama_async(question, image_data, model)
+        return await asyncio.to_thread(self._dispatch, backend, model, question, image_data)
+
+    async def stream_query_async(self, question: str, screenshot: str = None, model_type: str = 'llava',
+                                 image_data: bytes = None, context=None):
+        """
+        串流處理使用者查詢（非同步產生器），事件格式與 stream_query 相同
+
+        Raises:
+            QueueFullError: 推論佇列已滿或排隊逾時（在產生第一個事件之前）
+        """
+        logger.info(f'串流處理查詢 (async)，模型: {model_type}')
+        started = time.perf_counter()
+        timing = {}
+
+        backend, model = self._route(model_type, context, timing)
+        metrics.MODEL_REQUESTS.inc(model=model)
+        with metrics.MODEL_IN_FLIGHT.track(model=model), self.router.track(model):
+            async for event in self._stream_events_async(question, screenshot, image_data, backend, model,
+                                                         started, timing, context):
+                yield event
+
+    async def _stream_events_async(self, question, screenshot, image_data, backend, model, started, timing,
+                                   context=None):
+        """stream_query_async 的主體"""
+        precomputed = self._lookup_faq(model, context, timing)
+        if precomputed is not None:
+            yield {'type': 'token', 'content': precomputed}
+            timing['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            yield {'type': 'done', 'model': model, 'timing': timing}
+            return
+
+        if image_data is None:
+            with metrics.STAGE_SECONDS.time(stage='base64_decode'):
+                image_data = await asyncio.to_thread(self._decode_screenshot, screenshot)
+
+        cache_entry, cached = await self._lookup_cache(backend, model, question, image_data)
+        semantic_entry = None
+        if cached is None:
+            semantic_entry, cached = await asyncio.to_thread(self._lookup_semantic, backend, model, context, timing)
+
+        async with AsyncExitStack() as stack:
+            if cached is not None:
+                timing['cached'] = True
+                events = self._single_event({'type': 'token', 'content': cached})
+            else:
+                image_data, image_stats = await asyncio.to_thread(self._prepare_image, backend, model, image_data)
+                if image_stats:
+                    timing['image_bytes'] = image_stats['processed_bytes']
+                    timing['image_original_bytes'] = image_stats['original_bytes']
+                # 串流期間一直佔用推論名額
+                try:
+                    await stack.enter_async_context(self._admitted_async(backend, model, timing))
+                except QueueFullError:
+                    metrics.MODEL_ERRORS.inc(model=model, reason='queue_full')
+                    raise
+                if backend == 'ollama':
+                    events = self._stream_ollama_async(question, image_data, model, timing)
+                else:
+                    # 雲端模型不支援串流，整段回應作為單一片段
+                    events = self._single_response_async(backend, model, question, image_data)
+
+            parts = []
+            failed = False
+            async for event in events:
+                if event['type'] == 'token':
+                    parts.append(event['content'])
+                    if 'first_token_ms' not in timing:
+                        timing['first_token_ms'] = round((time.perf_counter() - started) * 1000, 2)
+                elif event['type'] == 'error':
+                    failed = True
+                    metrics.MODEL_ERRORS.inc(model=model, reason='model_error')
+                yield event
+
+        # 完整成功的回應寫入快取
+        answer = ''.join(parts).strip()
+        if cached is None and not failed and answer:
+            if cache_entry:
+                await asyncio.to_thread(self.response_cache.set, value=answer, **cache_entry)
+            if semantic_entry:
+                self.semantic_cache.set(answer=answer, **semantic_entry)
+            self.router.observe(model, time.perf_counter() - started)
+
+        timing['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        yield {'type': 'done', 'model': model, 'timing': timing}
+
+    @staticmethod
+    async def _single_event(event: dict):
+        yield event
+
+    async def _single_response_async(self, backend: str, model: str, question: str, image_data: bytes):
+        """以不串流的方式查詢，整段回應作為單一事件"""
+        try:
+            yield {'type': 'token', 'content': await self._dispatch_async(backend, model, question, image_data)}
+        except ModelQueryError as e:
+            yield {'type': 'error', 'message': str(e)}
+
+    async def _query_ollama_async(self, question: str, image_data: bytes, model_name: str = None) -> str:
+        """使用 Ollama 本地模型回應（非同步），節點選擇與錯誤訊息同 _query_ollama"""
+        url = self.ollama_url
+        try:
+            await self._wait_for_discovery_async()
+            if not self.ollama_enabled:
+                raise ModelQueryError("Ollama 未配置或無法連接")
+
+            model = model_name or self.ollama_model
+            body = await asyncio.to_thread(self._build_ollama_body, question, image_data, model)
+
+            while True:
+                with self.ollama_pool.route(model) as node:
+                    if node is None:
+                        raise ModelQueryError(self._no_ollama_node_message(model))
+                    url = node.url
+
+                    logger.info(f'調用 Ollama 模型 (async): {model} ({url})')
+                    try:
+                        started = time.perf_counter()
+                        with metrics.BACKEND_SECONDS.time(backend='ollama', model=model, node=url):
+                            response = await self.async_client.post(
+                                f'{url}/api/generate',
+                                content=body,
+                                headers=OLLAMA_JSON_HEADERS,
+                                timeout=httpx.Timeout(120, connect=10)  # 給 AI 足夠的時間思考
+                            )
+                        if response.status_code == 200:
+                            self.ollama_pool.success(node, time.perf_counter() - started)
+                        break
+                    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                        self.ollama_pool.eject(node, str(e))
+                        if self.ollama_pool.choose(model) is None:
+                            raise
+                        logger.warning(f'改用其他 Ollama 節點重試: {model}')
+
+            if response.status_code == 200:
+                result = response.json()
+                self._record_ollama_response(model, url, result)
+                answer = result.get('response', '').strip()
+                logger.info('✅ Ollama 回應成功')
+                if not answer:
+                    raise ModelQueryError("無法生成回應，請重試")
+                return answer
+            else:
+                logger.error(f'Ollama API 錯誤: {response.status_code} - {response.text}')
+                raise ModelQueryError(f"Ollama 回應失敗 ({response.status_code}): {response.text[:200]}")
+
+        except ModelQueryError:
+            raise
+        except httpx.TimeoutException:
+            logger.error('Ollama 請求超時')
+            raise ModelQueryError("Ollama 處理超時，請嘗試更簡單的圖片或問題")
+        except httpx.ConnectError:
+            logger.error(f'無法連接到 Ollama: {url}')
+            raise ModelQueryError(f"無法連接到 Ollama 服務 ({url})\n\n💡 提示: 確保 Ollama 正在運行:\n  ollama serve")
+        except Exception as e:
+            logger.error(f'Ollama 查詢失敗: {str(e)}')
+            raise ModelQueryError(f"Ollama 查詢出錯: {str(e)}")
+
+    async def _stream_ollama_async(self, question: str, image_data: bytes, model: str, timing: dict):
+        """
+        以 stream=true 呼叫 Ollama（非同步），逐行解析 NDJSON 並產生片段事件
+
+        讀取逾時只限制「兩個片段之間」的等待時間；尚未產生任何片段前連線失敗時改送其他節點
+        """
+        await self._wait_for_discovery_async()
+        if not self.ollama_enabled:
+            yield {'type': 'error', 'message': "Ollama 未配置或無法連接"}
+            return
+
+        body = await asyncio.to_thread(self._build_ollama_body, question, image_data, model, True)
+        while True:
+            with self.ollama_pool.route(model) as node:
+                if node is None:
+                    yield {'type': 'error', 'message': self._no_ollama_node_message(model)}
+                    return
+
+                logger.info(f'串流調用 Ollama 模型 (async): {model} ({node.url})')
+                emitted = False
+                stream_started = time.perf_counter()
+                try:
+                    async with self.async_client.stream(
+                        'POST',
+                        f'{node.url}/api/generate',
+                        content=body,
+                        headers=OLLAMA_JSON_HEADERS,
+                        timeout=httpx.Timeout(self.ollama_stream_timeout, connect=10)
+                    ) as response:
+                        if response.status_code != 200:
+                            text = (await response.aread()).decode('utf-8', errors='replace')
+                            logger.error(f'Ollama API 錯誤: {response.status_code} - {text}')
+                            yield {'type': 'error', 'message': f"Ollama 回應失敗 ({response.status_code}): {text[:200]}"}
+                            return
+
+                        async for line in response.aiter_lines():
+                            if not line:
+                                continue
+                            try:
+                                data = json.loads(line)
+                            except ValueError:
+                                logger.error(f'Ollama 串流回應無法解析: {line[:200]!r}')
+                                yield {'type': 'error', 'message': "Ollama 串流回應格式錯誤，回應不完整"}
+                                return
+                            if data.get('error'):
+                                yield {'type': 'error', 'message': f"Ollama 查詢出錯: {data['error']}"}
+                                return
+                            if data.get('response'):
+                                emitted = True
+                                yield {'type': 'token', 'content': data['response']}
+                            if data.get('done'):
+                                for key in ('total_duration', 'load_duration', 'prompt_eval_count',
+                                            'prompt_eval_duration', 'eval_count', 'eval_duration'):
+                                    if key in data:
+                                        timing[key] = data[key]
+                                timing['prompt_reused_tokens'] = self._record_ollama_response(model, node.url, data)
+                                break
+                        else:
+                            # 連線正常結束但沒有收到 done=true
+                            logger.error(f'Ollama 串流在完成前結束: {node.url}')
+                            yield {'type': 'error', 'message': "Ollama 串流在完成前結束，回應不完整"}
+                            return
+                    elapsed = time.perf_counter() - stream_started
+                    metrics.BACKEND_SECONDS.observe(elapsed, backend='ollama', model=model, node=node.url)
+                    self.ollama_pool.success(node, elapsed)
+                    logger.info('✅ Ollama 串流回應完成')
+                    return
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    # 已送出的片段無法撤回，只有尚未產生片段時才改送其他節點
+                    self.ollama_pool.eject(node, str(e))
+                    if emitted or self.ollama_pool.choose(model) is None:
+                        logger.error(f'無法連接到 Ollama: {node.url}')
+                        yield {'type': 'error', 'message': f"無法連接到 Ollama 服務 ({node.url})"}
+                        return
+                    logger.warning(f'改用其他 Ollama 節點重試: {model}')
+                except (httpx.RemoteProtocolError, httpx.ReadError) as e:
+                    # 串流途中連線中斷（Ollama 重啟、節點離線等）
+                    logger.error(f'Ollama 串流連線中斷: {node.url} - {str(e)}')
+                    yield {'type': 'error', 'message': f"Ollama 串流連線中斷 ({node.url})，回應不完整"}
+                    return
+                except httpx.TimeoutException:
+                    logger.error('Ollama 串流請求超時')
+                    yield {'type': 'error', 'message': "Ollama 處理超時，請嘗試更簡單的圖片或問題"}
+                    return
@@ -0,0 +1,195 @@
+"""
+參考資料打包模組
+檢索到的片段整段放進 prompt 時，長文件會拉長 prompt eval 時間，也可能超過小模型的 context 長度。
+這裡依每個模型的 token 預算挑選參考資料：
+- 以針對中文調整的規則估計 token 數（不需載入各模型的 tokenizer）
+- 片段全部放得下時原樣使用；放不下時把片段的 markdown 依段落切開，
+  以「與問題重疊的詞元 × 片段信心度 ÷ token 數」的密度排序，依序放入，最後一段可截到句子邊界
+"""
+import math
+import os
+import re
+from collections import namedtuple
+
+from .scorers import tokenize
+
+# 中日韓文字、假名、諺文與全形標點：大多數模型的 tokenizer 約一字一個 token
+_CJK = r'[⺀-鿿가-힯豈-﫿︰-﹏＀-￯]'
+_TOKEN_PATTERN = re.compile(rf'({_CJK})|([A-Za-z]+)|([0-9]+)|(\n+)|([^\sA-Za-z0-9])')
+
+# 英文單字約每 4 個字母一個 token，數字約每 3 位一個 token
+LETTERS_PER_TOKEN = 4
+DIGITS_PER_TOKEN = 3
+
+# 剩餘預算少於此 token 數時不再截取段落（太短的片段沒有意義）
+MIN_PASSAGE_TOKENS = 24
+
+# 句子邊界：截取段落時保留完整的句子
+_SENTENCE_END = re.compile(r'(?<=[。！？；!?;\n])')
+
+# 打包結果：參考資料文字（每個片段一段，依片段排序）、估計 token 數、未放入的 token 數與使用的預算
+PackedContext = namedtuple('PackedContext', ['texts', 'tokens', 'trimmed_tokens', 'budget'])
+
+
+def estimate_tokens(text):
+    """
+    粗估文字的 token 數
+
+    中日韓字元與全形標點各算一個，英文單字每 4 個字母、數字每 3 位一個，
+    其他符號各一個，連續的換行算一個，空白不計
+    """
+    tokens = 0
+    for cjk, letters, digits, newlines, symbol in _TOKEN_PATTERN.findall(text):
+        if cjk or newlines or symbol:
+            tokens += 1
+        elif letters:
+            tokens += math.ceil(len(letters) / LETTERS_PER_TOKEN)
+        else:
+            tokens += math.ceil(len(digits) / DIGITS_PER_TOKEN)
+    return tokens
+
+
+def split_passages(content):
+    """
+    將片段的 markdown 依空行切成段落，標題行併入其後的段落
+
+    Returns:
+        [(標題或 None, 段落文字), ...]，依原本的順序
+    """
+    passages = []
+    heading = None
+    for block in re.split(r'\n\s*\n', content.strip()):
+        block = block.strip()
+        if not block:
+            continue
+        lines = block.split('\n')
+        if lines[0].startswith('#'):
+            heading = lines[0]
+            block = '\n'.join(lines[1:]).strip()
+            if not block:
+                continue
+        passages.append((heading, block))
+    return passages
+
+
+def trim_to_budget(text, budget):
+    """截取開頭不超過 budget 個 token 的完整句子；第一句就超過時依字元截斷"""
+    kept = []
+    used = 0
+    for sentence in _SENTENCE_END.split(text):
+        cost = estimate_tokens(sentence)
+        if used + cost > budget:
+            break
+        kept.append(sentence)
+        used += cost
+    if kept:
+        return ''.join(kept).rstrip()
+    trimmed = []
+    for ch in text:
+        used += estimate_tokens(ch)
+        if used > budget - 1:
+            break
+        trimmed.append(ch)
+    return ''.join(trimmed).rstrip() + '…'
+
+
+class ContextPacker:
+    """依 token 預算挑選參考資料"""
+
+    def __init__(self, registry, default_budget=1024):
+        """
+        Args:
+            registry: ModelRegistry，各模型的 context_budget
+            default_budget: 未登錄或未設定 context_budget 的模型使用的預算；0 表示不限制
+        """
+        self.registry = registry
+        self.default_budget = default_budget
+
+    def budget_for(self, model):
+        """模型的參考資料 token 預算；0 表示不限制"""
+        spec = self.registry.get(model) if model else None
+        if spec is not None and spec.context_budget is not None:
+            return spec.context_budget
+        return self.default_budget
+
+    def pack(self, question, ranked_chunks, model=None):
+        """
+        依模型的預算挑選參考資料
+
+        Args:
+            question: 用戶問題
+            ranked_chunks: 排序後的片段 [{'chunk', 'score', 'confidence'}, ...]
+            model: 使用的模型名稱
+
+        Returns:
+            PackedContext；片段全部放得下時 texts 為原本的片段內容
+        """
+        budget = self.budget_for(model)
+        contents = [c['chunk']['content'] for c in ranked_chunks]
+        full_tokens = sum(estimate_tokens(content) for content in contents)
+        if budget <= 0 or full_tokens <= budget:
+            return PackedContext(contents, full_tokens, 0, budget)
+
+        selected = self._select(question, ranked_chunks, budget)
+        texts = []
+        used = 0
+        for chunk_index in range(len(contents)):
+            chosen = sorted((p for p in selected if p[0] == chunk_index), key=lambda p: p[1])
+            if not chosen:
+                continue
+            lines = []
+            heading = None
+            for _, _, passage_heading, text, tokens in chosen:
+                if passage_heading and passage_heading != heading:
+                    lines.append(passage_heading)
+                    heading = passage_heading
+                lines.append(text)
+                used += tokens
+            texts.append('\n\n'.join(lines))
+        return PackedContext(texts, used, full_tokens - used, budget)
+
+    @staticmethod
+    def _select(question, ranked_chunks, budget):
+        """
+        以密度排序段落並依序放入預算
+
+        Returns:
+            [(片段序號, 段落序號, 標題, 文字, token 數), ...]
+        """
+        terms = set(tokenize(question))
+        candidates = []
+        for chunk_index, ranked in enumerate(ranked_chunks):
+            for passage_index, (heading, text) in enumerate(split_passages(ranked['chunk']['content'])):
+                tokens = estimate_tokens(text) + (estimate_tokens(heading) if heading else 0)
+                overlap = len(terms & set(tokenize(text if heading is None else f'{heading}\n{text}')))
+                # 沒有重疊詞元的段落仍保留少量分數，讓高信心度片段的說明段落排在其他片段前面
+                density = ranked['confidence'] * (overlap + 0.5) / max(tokens, 1)
+                candidates.append((density, chunk_index, passage_index, heading, text, tokens))
+        candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+
+        selected = []
+        remaining = budget
+        for _, chunk_index, passage_index, heading, text, tokens in candidates:
+            if tokens > remaining:
+                heading_tokens = estimate_tokens(heading) if heading else 0
+                if remaining - heading_tokens < MIN_PASSAGE_TOKENS:
+                    continue
+                text = trim_to_budget(text, remaining - heading_tokens)
+                tokens = heading_tokens + estimate_tokens(text)
+            selected.append((chunk_index, passage_index, heading, text, tokens))
+            remaining -= tokens
+        if not selected and candidates:
+            # 預算小於單一段落的最小長度時，仍截取最相關的段落，不讓 prompt 變成沒有參考資料的格式
+            _, chunk_index, passage_index, heading, text, _ = candidates[0]
+            text = trim_to_budget(text, budget)
+            selected.append((chunk_index, passage_index, None, text, estimate_tokens(text)))
+        return selected
+
+
+def create_context_packer(registry):
+    """
+    依環境變數建立參考資料打包器
+
+    CONTEXT_TOKEN_BUDGET: 未在模型登錄表設定 context_budget 的模型使用的預算（預設 1024，0 表示不限制）
+    """
+    return ContextPacker(registry, default_budget=int(os.getenv('CONTEXT_TOKEN_BUDGET', '1024')))
@@ -0,0 +1,422 @@
+"""
+向量檢索模組
+以本地 Ollama embedding 模型將知識片段向量化，
+向量存成 .npy 檔並以 memory-map 方式載入，重啟時不需重新計算
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import requests
+
+from .retriever import LightweightRetriever
+
+# 不再被 vectors.meta.json 指向、且超過此秒數的向量檔才刪除（其他 worker 可能正要載入）
+_STALE_VECTORS_SECONDS = 60
+
+
+# 共用的 Ollama 節點池與 HTTP session（由 AIModel 設定），未設定時直接連線 OLLAMA_URL
+_shared_pool = None
+_shared_session_factory = None
+
+
+def use_ollama_pool(pool, session_factory):
+    """
+    讓未指定節點池的 OllamaEmbedder 改用模型的節點池與連線池
+
+    Args:
+        pool: OllamaNodePool
+        session_factory: 返回 requests.Session 的函式
+    """
+    global _shared_pool, _shared_session_factory
+    _shared_pool = pool
+    _shared_session_factory = session_factory
+
+
+class OllamaEmbedder:
+    """
+    透過 Ollama /api/embed 批次產生文字向量
+
+    請求經由節點池選擇已安裝 embedding 模型的健康節點，並重用共用的 keep-alive 連線；
+    節點池尚未完成探測時送往第一個節點。舊版 Ollama 沒有 /api/embed 時改用 /api/embeddings 逐筆計算
+    """
+
+    def __init__(self, ollama_url=None, model=None, timeout=30, pool=None, session_factory=None, batch_size=None):
+        """
+        Args:
+            ollama_url: 沒有節點池時使用的 Ollama 位址
+            model: embedding 模型名稱
+            timeout: 每個請求的逾時秒數
+            pool: OllamaNodePool，None 時使用 use_ollama_pool 設定的共用節點池
+            session_factory: 返回 requests.Session 的函式，None 時使用共用或自有的 session
+            batch_size: 每個請求最多送出幾段文字
+        """
+        self.ollama_url = ollama_url or os.getenv('OLLAMA_URL', 'http://localhost:11434')
+        self.model = model or os.getenv('OLLAMA_EMBED_MODEL', 'nomic-embed-text')
+        self.timeout = timeout
+        self.pool = pool
+        self.session_factory = session_factory
+        self.batch_size = batch_size or int(os.getenv('OLLAMA_EMBED_BATCH', '64'))
+        self._legacy = False  # 節點不支援 /api/embed
+        self._session = None
+        self._session_pid = None
+
+    @property
+    def session(self):
+        """共用的 session；沒有時每個程序各自建立一個 keep-alive session"""
+        factory = self.session_factory or _shared_session_factory
+        if factory is not None:
+            return factory()
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = requests.Session()
+            self._session_pid = os.getpid()
+        return self._session
+
+    def embed(self, texts):
+        """
+        將多段文字轉為向量
+
+        Args:
+            texts: 文字列表
+
+        Returns:
+            shape 為 (len(texts), dim) 的 float32 陣列
+        """
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._request(list(texts[start:start + self.batch_size])))
+        return np.asarray(vectors, dtype=np.float32)
+
+    def _request(self, texts):
+        """選擇節點送出一批文字；連線失敗時暫停該節點並改用其他節點重試"""
+        pool = self.pool or _shared_pool
+        if pool is None or not pool.discovered.is_set():
+            url = pool.nodes[0].url if pool is not None else self.ollama_url
+            return self._post(url, texts)
+        while True:
+            with pool.route(self.model) as node:
+                if node is None:
+                    raise RuntimeError(f'沒有可用的 Ollama 節點安裝 embedding 模型 {self.model}')
+                try:
+                    return self._post(node.url, texts)
+                except requests.exceptions.ConnectionError as e:
+                    pool.eject(node, str(e))
+                    if pool.choose(self.model) is None:
+                        raise
+
+    def _post(self, url, texts):
+        session = self.session
+        if not self._legacy:
+            response = session.post(f'{url}/api/embed', json={'model': self.model, 'input': texts},
+                                    timeout=self.timeout)
+            if response.status_code != 404 or not self._embed_unsupported(response):
+                response.raise_for_status()
+                return response.json()['embeddings']
+            self._legacy = True
+        vectors = []
+        for text in texts:
+            response = session.post(f'{url}/api/embeddings', json={'model': self.model, 'prompt': text},
+                                    timeout=self.timeout)
+            response.raise_for_status()
+            vectors.append(response.json()['embedding'])
+        return vectors
+
+    @staticmethod
+    def _embed_unsupported(response):
+        """404 是端點不存在（舊版 Ollama）而不是模型未安裝"""
+        try:
+            return 'model' not in response.json().get('error', '')
+        except ValueError:
+            return True
+
+
+def _normalize(vectors):
+    """將向量正規化為單位長度，使內積即為 cosine 相似度"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def content_hash(text):
+    """計算片段內容的雜湊值，用來判斷是否需要重新向量化"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class VectorIndex:
+    """
+    持久化的片段向量索引
+
+    檔案配置：
+    - vectors-<版本>.npy: shape (片段數, dim) 的正規化 float32 矩陣，以 mmap 唯讀載入
+    - vectors.meta.json: embedding 模型名稱、每列對應的片段 id 與內容雜湊，以及對應的向量檔名
+
+    每次寫入都產生新的向量檔，再替換 vectors.meta.json；替換 meta 是唯一的切換點，
+    其他 worker 讀到的向量與雜湊一定來自同一次寫入
+    """
+
+    def __init__(self, index_dir, embedder):
+        self.index_dir = Path(index_dir)
+        self.embedder = embedder
+        self.meta_path = self.index_dir / 'vectors.meta.json'
+        self.vectors = None
+        self.last_embedded = 0
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def load(self, mmap_mode='r'):
+        """
+        讀取 meta 與其指向的向量檔
+
+        Returns:
+            (meta, 向量矩陣)；沒有索引時為 (None, None)，向量檔不存在時向量為 None
+        """
+        for _ in range(2):
+            meta = self._load_meta()
+            if meta is None:
+                return None, None
+            # 舊版索引沒有 vectors 欄位，向量固定存在 vectors.npy
+            try:
+                return meta, np.load(self.index_dir / meta.get('vectors', 'vectors.npy'), mmap_mode=mmap_mode)
+            except FileNotFoundError:
+                # 讀取 meta 後向量檔被新的寫入清除：重新讀取一次 meta
+                continue
+        return meta, None
+
+    def sync(self, texts, ids):
+        """
+        讓索引與目前的片段內容一致，只重新向量化內容有變動的片段
+
+        Args:
+            texts: 每個片段要向量化的文字
+            ids: 每個片段的 id
+
+        Returns:
+            以 mmap 載入、列順序與 texts 相同的向量矩陣
+        """
+        hashes = [content_hash(text) for text in texts]
+        meta, stored = self.load()
+
+        existing = None
+        if meta and meta.get('model') == self.embedder.model and stored is not None:
+            existing = stored
+            if meta.get('hashes') == hashes:
+                # 內容完全沒變：直接映射現有的向量檔
+                self.vectors = existing
+                self.last_embedded = 0
+                return self.vectors
+
+        # 依內容雜湊沿用舊向量，只計算新增或修改的片段
+        reusable = {}
+        if existing is not None:
+            reusable = {h: row for row, h in enumerate(meta.get('hashes', []))}
+
+        missing = [i for i, h in enumerate(hashes) if h not in reusable]
+        new_vectors = _normalize(self.embedder.embed([texts[i] for i in missing])) if missing else None
+        if existing is not None and new_vectors is not None and existing.shape[1] != new_vectors.shape[1]:
+            # 舊向量的維度與新向量不同（例如空知識庫寫入的 0 維索引）：捨棄舊向量，其餘片段也重新向量化
+            missing_set = set(missing)
+            stale = [i for i in range(len(texts)) if i not in missing_set]
+            if stale:
+                stale_vectors = _normalize(self.embedder.embed([texts[i] for i in stale]))
+                new_vectors = np.vstack([new_vectors, stale_vectors])
+                missing += stale
+            existing, reusable = None, {}
+
+        if existing is not None:
+            dim = existing.shape[1]
+        elif new_vectors is not None:
+            dim = new_vectors.shape[1]
+        else:
+            dim = 0
+        matrix = np.zeros((len(texts), dim), dtype=np.float32)
+        for i, h in enumerate(hashes):
+            if h in reusable:
+                matrix[i] = existing[reusable[h]]
+        for row, i in enumerate(missing):
+            matrix[i] = new_vectors[row]
+
+        vectors_path = self._write(matrix, {'model': self.embedder.model, 'ids': list(ids), 'hashes': hashes})
+        self.vectors = np.load(vectors_path, mmap_mode='r')
+        self.last_embedded = len(missing)
+        return self.vectors
+
+    def _write(self, matrix, meta):
+        """
+        寫入新版本的向量檔，再以替換 meta 切換到新版本
+
+        Returns:
+            新向量檔的路徑
+        """
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        signature = json.dumps([meta['model'], meta['hashes'], matrix.shape]).encode('utf-8')
+        version = hashlib.sha256(signature).hexdigest()[:16]
+        name = f'vectors-{version}.npy'
+        vectors_path = self.index_dir / name
+        tmp_vectors = self.index_dir / f'{name}.{os.getpid()}.tmp'
+        tmp_meta = self.meta_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_vectors, 'wb') as f:
+            np.save(f, matrix)
+        os.replace(tmp_vectors, vectors_path)
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, vectors=name), f, ensure_ascii=False)
+        os.replace(tmp_meta, self.meta_path)
+        self._cleanup()
+        return vectors_path
+
+    def _cleanup(self):
+        """刪除不再被 meta 指向的舊向量檔（已 mmap 的 worker 不受影響）"""
+        current = (self._load_meta() or {}).get('vectors')
+        cutoff = time.time() - _STALE_VECTORS_SECONDS
+        for path in self.index_dir.glob('vectors*.npy'):
+            if path.name == current:
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except OSError:
+                continue
+
+    def search(self, query_vectors, k, vectors=None):
+        """
+        批次 top-k 內積搜尋
+
+        Args:
+            query_vectors: shape (查詢數, dim) 的向量
+            k: 每個查詢返回的結果數
+            vectors: 要搜尋的向量矩陣，預設為最近一次 sync 的結果
+
+        Returns:
+            [(列索引陣列, 分數陣列), ...]，每個查詢一組，分數高的在前
+        """
+        if vectors is None:
+            vectors = self.vectors
+        queries = _normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        num_rows = 0 if vectors is None else vectors.shape[0]
+        if num_rows == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+
+        scores = queries @ np.asarray(vectors).T
+        k = min(k, num_rows)
+        if k < num_rows:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(num_rows), (len(queries), num_rows))
+
+        results = []
+        for query_scores, rows in zip(scores, top):
+            row_scores = query_scores[rows]
+            # 同分時依知識庫順序
+            order = np.lexsort((rows, -row_scores))
+            results.append((rows[order], row_scores[order]))
+        return results
+
+
+class DenseRetriever(LightweightRetriever):
+    """
+    向量檢索器
+
+    與 LightweightRetriever 使用相同的知識庫與 prompt 格式，
+    改以 embedding 相似度排序；向量索引無法使用時退回關鍵字計分
+    """
+
+    def __init__(self, knowledge_base_path=None, embedder=None, index_dir=None, min_score=None):
+        """
+        Args:
+            knowledge_base_path: 知識庫 JSON 路徑
+            embedder: 提供 embed(texts) 與 model 屬性的物件，預設為 OllamaEmbedder
+            index_dir: 向量索引目錄，預設為 app/knowledge/index
+            min_score: cosine 相似度低於此值的片段視為不相關
+        """
+        if index_dir is None:
+            index_dir = os.getenv('DENSE_INDEX_DIR') or Path(__file__).parent.parent / 'knowledge' / 'index'
+        if min_score is None:
+            min_score = float(os.getenv('DENSE_MIN_SCORE', '0.5'))
+        self.embedder = embedder or OllamaEmbedder()
+        self.vector_index = VectorIndex(index_dir, self.embedder)
+        self.min_score = min_score
+        super().__init__(knowledge_base_path)
+
+    @staticmethod
+    def _embedding_text(chunk):
+        return chunk.get('content', '')
+
+    @property
+    def dense_ready(self):
+        return self._snapshot.vectors is not None
+
+    def _build_snapshot(self, chunks, previous):
+        """建立快照並同步向量索引，只重新向量化內容有變動的片段"""
+        snapshot = super()._build_snapshot(chunks, previous)
+        if getattr(chunks, 'vectors', None) is not None and chunks.vector_model == self.embedder.model:
+            # 二進位知識庫已內含向量：直接使用 mmap 的共用頁面
+            return snapshot._replace(vectors=chunks.vectors)
+        try:
+            vectors = self.vector_index.sync(
+                [self._embedding_text(c) for c in chunks],
+                [c.get('id') for c in chunks]
+            )
+            print(f"[Retriever] 向量索引就緒，本次重新向量化 {self.vector_index.last_embedded} 個片段")
+        except Exception as e:
+            vectors = None
+            print(f"[Retriever] 警告: 向量索引建立失敗，改用關鍵字計分 - {e}")
+        return snapshot._replace(vectors=vectors)
+
+    def rank(self, question, max_chunks=2):
+        """以向量相似度排序片段"""
+        return self.rank_batch([question], max_chunks)[0]
+
+    def _rank_with_embedding(self, question, max_chunks):
+        """以向量相似度排序片段，問題向量一併返回供語意快取沿用"""
+        if self._snapshot.chunks and self._snapshot.vectors is not None:
+            try:
+                query_vectors = self.embedder.embed([question])
+            except Exception as e:
+                print(f"[Retriever] 警告: 問題向量化失敗，改用關鍵字計分 - {e}")
+                return super().rank(question, max_chunks), None
+            else:
+                ranked = self.rank_batch([question], max_chunks, query_vectors)[0]
+                return ranked, (self.embedder.model, query_vectors[0])
+        return super()._rank_with_embedding(question, max_chunks)
+
+    def rank_batch(self, questions, max_chunks=2, query_vectors=None):
+        """
+        批次計算多個問題的相關片段
+
+        Args:
+            questions: 問題列表
+            max_chunks: 每個問題最多返回幾個片段
+            query_vectors: 已算好的問題向量，None 時以 embedder 計算
+
+        Returns:
+            每個問題一個 [{'chunk': 片段, 'score': 分數, 'confidence': 信心度}, ...] 列表；
+            向量檢索時信心度即 cosine 相似度
+        """
+        snapshot = self._snapshot
+        if not snapshot.chunks:
+            return [[] for _ in questions]
+
+        if snapshot.vectors is not None:
+            try:
+                if query_vectors is None:
+                    query_vectors = self.embedder.embed(questions)
+            except Exception as e:
+                print(f"[Retriever] 警告: 問題向量化失敗，改用關鍵字計分 - {e}")
+            else:
+                results = []
+                for rows, scores in self.vector_index.search(query_vectors, max_chunks, snapshot.vectors):
+                    results.append([
+                        {'chunk': snapshot.chunks[row], 'score': float(score), 'confidence': max(float(score), 0.0)}
+                        for row, score in zip(rows, scores)
+                        if score >= self.min_score
+                    ])
+                return results
+
+        return [super(DenseRetriever, self).rank(q, max_chunks) for q in questions]
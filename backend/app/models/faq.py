@@ -0,0 +1,123 @@
+"""
+常見問題預先回答模組
+知識庫中大部分片段是有固定答案的常見問題（畢業生權限、選課同步、無法登入），
+送進 7B 視覺模型重新生成答案多半是浪費。precompute_answers.py 離線為每個片段產生標準回答，
+存在片段的 answer 欄位（answer_hash 為產生時的內容雜湊）；
+檢索結果只有一個高信心度片段且問題沒有提到畫面時，直接返回預先產生的回答
+"""
+import logging
+import os
+import threading
+from collections import Counter
+
+from .dense_retriever import content_hash
+from .screen_reference import references_screen
+
+logger = logging.getLogger(__name__)
+
+
+def answer_hash(chunk):
+    """產生回答時的片段內容雜湊；內容修改後預先產生的回答即過期"""
+    return content_hash(chunk.get('content', ''))
+
+
+def stored_answer(chunk):
+    """
+    片段中預先產生的回答
+
+    Returns:
+        回答文字；沒有回答或片段內容在產生後被修改過時返回 None
+    """
+    answer = chunk.get('answer')
+    if not answer or chunk.get('answer_hash') != answer_hash(chunk):
+        return None
+    return answer
+
+
+class FAQAnswers:
+    """決定是否使用預先產生的回答，並記錄命中率與省下的時間"""
+
+    def __init__(self, min_confidence=0.7, min_margin=0.2):
+        """
+        Args:
+            min_confidence: 最相關片段的最低信心度（見 LightweightRetriever.score_confidence）
+            min_margin: 最相關片段與第二個片段的最低信心度差距，確保只有一個片段明顯相關
+        """
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.hits = 0
+        self.skipped = Counter()  # 未使用的原因 -> 次數
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def match(self, context):
+        """
+        檢查檢索結果是否可以直接使用預先產生的回答
+
+        Args:
+            context: RetrievedContext
+
+        Returns:
+            (回答, 片段 id)；不適用時返回 None
+        """
+        reason = None
+        answer = None
+        if not context.chunks or context.confidence < self.min_confidence:
+            reason = 'low_confidence'
+        elif context.margin < self.min_margin:
+            reason = 'ambiguous'
+        elif references_screen(context.question):
+            reason = 'screen_reference'
+        else:
+            answer = stored_answer(context.chunks[0]['chunk'])
+            if answer is None:
+                reason = 'no_answer'
+        if reason is not None:
+            with self._lock:
+                self.skipped[reason] += 1
+            return None
+        return answer, context.chunks[0]['chunk'].get('id')
+
+    def record_hit(self, saved):
+        """
+        記錄一次命中
+
+        Args:
+            saved: 估計省下的秒數（模型路由記錄的此模型預期推論耗時）
+        """
+        with self._lock:
+            self.hits += 1
+            self.saved_seconds += saved
+
+    def stats(self):
+        """命中統計（本程序的計數）"""
+        with self._lock:
+            lookups = self.hits + sum(self.skipped.values())
+            return {
+                'min_confidence': self.min_confidence,
+                'min_margin': self.min_margin,
+                'hits': self.hits,
+                'skipped': dict(self.skipped),
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'saved_seconds': round(self.saved_seconds, 3),
+                'pid': os.getpid(),
+            }
+
+
+def create_faq_answers():
+    """
+    依環境變數建立常見問題預先回答
+
+    FAQ_FAST_PATH: true (預設) / false
+    FAQ_MIN_CONFIDENCE: 最相關片段的最低信心度（預設 0.7）
+    FAQ_MIN_MARGIN: 與第二個片段的最低信心度差距（預設 0.2）
+
+    Returns:
+        FAQAnswers，停用時返回 None
+    """
+    if os.getenv('FAQ_FAST_PATH', 'true').lower() != 'true':
+        return None
+    return FAQAnswers(
+        min_confidence=float(os.getenv('FAQ_MIN_CONFIDENCE', '0.7')),
+        min_margin=float(os.getenv('FAQ_MIN_MARGIN', '0.2')),
+    )
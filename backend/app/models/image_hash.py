@@ -0,0 +1,55 @@
+"""
+截圖感知雜湊模組
+以 dHash 比對「看起來相同」的頁面：同一個 Moodle 頁面每次截圖的 JPEG 位元組都略有不同，
+但縮小後的灰階亮度梯度幾乎一致
+
+dHash 只反映整體版面：頁首與側欄相同、只有文字內容（成績、作業狀態）不同的頁面距離也只有 0~2，
+因此回應快取的相似比對預設停用（見 response_cache.create_response_cache）
+"""
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(image_data, hash_size=16):
+    """
+    計算截圖的 difference hash
+
+    Args:
+        image_data: 已解碼的圖片位元組 (JPEG/PNG)
+        hash_size: 雜湊邊長，產生 hash_size * hash_size 位元
+
+    Returns:
+        雜湊位元組 (長度 hash_size * hash_size / 8)；無法解碼時返回 None
+    """
+    try:
+        img = Image.open(BytesIO(image_data))
+        # JPEG 可在解碼時直接縮小，避免解出整張全解析度圖片
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        # 以浮點灰階縮小，避免整數捨入讓平坦區域的位元因 JPEG 雜訊翻轉
+        img = img.convert('L').convert('F').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    except Exception:
+        return None
+
+    pixels = np.asarray(img, dtype=np.float32)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return np.packbits(bits.ravel()).tobytes()
+
+
+def hamming_distances(hashes, target):
+    """
+    向量化計算多個雜湊與目標雜湊的漢明距離
+
+    Args:
+        hashes: 雜湊位元組列表
+        target: 目標雜湊位元組
+
+    Returns:
+        每個雜湊的漢明距離 (np.ndarray)
+    """
+    if not hashes:
+        return np.empty(0, dtype=np.int64)
+    matrix = np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(len(hashes), -1)
+    target = np.frombuffer(target, dtype=np.uint8)
+    return np.unpackbits(matrix ^ target, axis=1).sum(axis=1)
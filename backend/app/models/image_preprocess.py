@@ -0,0 +1,133 @@
+"""
+截圖預處理模組
+在送進視覺模型之前縮小、裁切並重新編碼截圖；
+視覺模型的推論時間隨輸入圖片大小增加，超過模型原生解析度的像素只是浪費
+"""
+import logging
+import os
+import time
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+logger = logging.getLogger(__name__)
+
+def _parse_target_sizes(value):
+    """解析 'llava=672,qwen2.5vl:7b=1024' 格式的設定"""
+    sizes = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        model, size = item.rsplit('=', 1)
+        sizes[model.strip()] = int(size)
+    return sizes
+
+
+class ImagePreprocessor:
+    """視覺模型輸入的截圖預處理"""
+
+    def __init__(self, enabled=True, target_sizes=None, default_target=1024, quality=85,
+                 trim_borders=True, crop_top=0, border_tolerance=8):
+        """
+        Args:
+            enabled: 是否啟用預處理
+            target_sizes: {模型名稱: 目標長邊像素}，應接近模型原生輸入尺寸
+            default_target: 未列出的模型使用的目標長邊
+            quality: 重新編碼的 JPEG 品質
+            trim_borders: 是否裁掉四周單色邊框
+            crop_top: 固定裁掉頂端的像素數（例如瀏覽器工具列）
+            border_tolerance: 判定單色邊框的色差容許值
+        """
+        self.enabled = enabled
+        self.target_sizes = dict(target_sizes or {})
+        self.default_target = default_target
+        self.quality = quality
+        self.trim_borders = trim_borders
+        self.crop_top = crop_top
+        self.border_tolerance = border_tolerance
+
+    @classmethod
+    def from_env(cls, target_sizes=None):
+        """
+        依環境變數建立預處理器
+
+        Args:
+            target_sizes: 模型登錄表的 {模型名稱: 目標長邊}，IMAGE_TARGET_SIZES 中的設定優先
+        """
+        return cls(
+            enabled=os.getenv('IMAGE_PREPROCESS', 'true').lower() == 'true',
+            target_sizes=dict(target_sizes or {}, **_parse_target_sizes(os.getenv('IMAGE_TARGET_SIZES'))),
+            default_target=int(os.getenv('IMAGE_DEFAULT_TARGET', '1024')),
+            quality=int(os.getenv('IMAGE_JPEG_QUALITY', '85')),
+            trim_borders=os.getenv('IMAGE_TRIM_BORDERS', 'true').lower() == 'true',
+            crop_top=int(os.getenv('IMAGE_CROP_TOP', '0')),
+        )
+
+    def target_for(self, model):
+        return self.target_sizes.get(model, self.default_target)
+
+    def _trim(self, img):
+        """裁掉與左上角顏色相同的四周邊框"""
+        background = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+        diff = ImageChops.difference(img, background).convert('L')
+        bbox = diff.point(lambda p: 255 if p > self.border_tolerance else 0).getbbox()
+        if bbox and bbox != (0, 0) + img.size:
+            return img.crop(bbox)
+        return img
+
+    def process(self, image_data, model):
+        """
+        預處理一張截圖
+
+        Args:
+            image_data: 已解碼的圖片位元組
+            model: 目標模型名稱
+
+        Returns:
+            (處理後的圖片位元組, 統計資訊)；停用、無法解碼或沒有變小時返回原始位元組
+        """
+        stats = {'original_bytes': len(image_data), 'processed_bytes': len(image_data)}
+        if not self.enabled:
+            return image_data, stats
+
+        started = time.perf_counter()
+        target = self.target_for(model)
+        try:
+            img = Image.open(BytesIO(image_data))
+            stats['original_size'] = img.size
+            if img.format == 'JPEG':
+                # JPEG 在 DCT 階段直接以 1/2、1/4、1/8 解碼，不必解出全解析度
+                img.draft('RGB', (target, target))
+            img = img.convert('RGB')
+
+            if self.crop_top:
+                # draft() 可能已縮小圖片，裁切高度依比例換算
+                crop_top = round(self.crop_top * img.height / stats['original_size'][1])
+                if img.height > crop_top:
+                    img = img.crop((0, crop_top, img.width, img.height))
+            if self.trim_borders:
+                img = self._trim(img)
+
+            longest = max(img.size)
+            if longest > target:
+                factor = longest // target
+                if factor >= 2:
+                    # reduce() 以整數倍做 box 縮小，比直接高品質重取樣快得多
+                    img = img.reduce(factor)
+                img.thumbnail((target, target), Image.Resampling.LANCZOS)
+
+            output = BytesIO()
+            img.save(output, format='JPEG', quality=self.quality)
+            processed = output.getvalue()
+        except Exception as e:
+            logger.warning(f'截圖預處理失敗，使用原圖: {str(e)}')
+            return image_data, stats
+
+        stats['processed_size'] = img.size
+        stats['preprocess_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        if len(processed) >= len(image_data) and img.size == stats['original_size']:
+            # 沒有縮小也沒有變小，沿用原圖避免重複壓縮失真
+            return image_data, stats
+
+        stats['processed_bytes'] = len(processed)
+        return processed, stats
@@ -0,0 +1,310 @@
+"""
+知識庫二進位格式
+將 knowledge_base.json 與其計分索引編譯成可直接 mmap 的二進位檔，
+多個 gunicorn worker 透過作業系統的 page cache 共用同一份資料，載入時不需重建索引
+
+檔案配置（little-endian）：
+- 標頭: magic、版本、片段數、片段關鍵字數、向量維度、來源檔資訊、中繼資料 (JSON) 的位移與長度
+- 中繼資料: 各區段的位移與元素數、BM25 參數、向量模型名稱
+- 字串表: 所有 UTF-8 字串串接而成
+- 片段表: 每個片段的 id / 內容 / 其他欄位(JSON) 在字串表中的位移與長度，以及關鍵字範圍
+- 片段關鍵字表: 每個片段原始關鍵字字串的位移與長度
+- 片段雜湊: 每個片段的 SHA-256，用於增量重新索引
+- 關鍵字自動機: KeywordIndex.to_arrays 的扁平陣列（ac_ 開頭的區段）
+- BM25 索引: 依 (term_hash, 詞元) 排序的詞彙表、倒排列表與預先計算的權重（bm25_ 開頭的區段）
+- 向量（選用）: shape (片段數, dim) 的 float32 矩陣
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+from collections.abc import Sequence
+
+import numpy as np
+
+from .keyword_index import FlatKeywordIndex, KeywordIndex
+from .scorers import BM25Scorer, chunk_hash, term_hash
+
+MAGIC = b'KBIN'
+VERSION = 2
+
+# magic, version, num_chunks, num_chunk_keywords, vector_dim, source_size, source_mtime_ns, source_sha256,
+# meta_offset, meta_length
+_HEADER = struct.Struct('<4sIIII QQ 32s QQ')
+
+# 片段表每列: id_off, id_len, content_off, content_len, extra_off, extra_len, kw_start, kw_count
+_CHUNK_FIELDS = 8
+
+# 區段名稱 → (dtype, 每列欄位數)
+_SECTION_TYPES = {
+    'strings': ('u1', 1),
+    'chunks': ('<u8', _CHUNK_FIELDS),
+    'chunk_keywords': ('<u8', 2),
+    'hashes': ('u1', 32),
+    'vectors': ('<f4', None),
+    'ac_goto_indptr': ('<u4', 1),
+    'ac_goto_chars': ('<u4', 1),
+    'ac_goto_next': ('<u4', 1),
+    'ac_fail': ('<u4', 1),
+    'ac_output_indptr': ('<u4', 1),
+    'ac_output': ('<u4', 1),
+    'ac_postings_indptr': ('<u4', 1),
+    'ac_postings': ('<u4', 1),
+    'ac_always_match': ('<u4', 1),
+    'bm25_hashes': ('<u4', 1),
+    'bm25_terms': ('<u8', 2),
+    'bm25_indptr': ('<i8', 1),
+    'bm25_doc_ids': ('<u4', 1),
+    'bm25_weights': ('<f8', 1),
+}
+
+_BASE_FIELDS = ('id', 'keywords', 'content')
+
+
+def default_binary_path(json_path):
+    """預設的二進位檔路徑：與 JSON 同目錄、副檔名改為 .bin"""
+    return os.path.splitext(str(json_path))[0] + '.bin'
+
+
+class _StringTable:
+    def __init__(self):
+        self.buffer = bytearray()
+        self._offsets = {}
+
+    def add(self, text):
+        data = text.encode('utf-8')
+        if data not in self._offsets:
+            self._offsets[data] = len(self.buffer)
+            self.buffer.extend(data)
+        return self._offsets[data], len(data)
+
+
+def _align(f, alignment=8):
+    padding = (-f.tell()) % alignment
+    f.write(b'\0' * padding)
+    return f.tell()
+
+
+def compile_knowledge_base(json_path, output_path=None, vectors=None, vector_model=None):
+    """
+    將知識庫 JSON 與其關鍵字、BM25 索引編譯為二進位檔
+
+    Args:
+        json_path: knowledge_base.json 路徑
+        output_path: 輸出路徑，預設為同目錄的 .bin
+        vectors: 選用，shape (片段數, dim) 的向量矩陣，列順序須與片段相同
+        vector_model: 產生向量的 embedding 模型名稱
+
+    Returns:
+        輸出檔路徑
+    """
+    output_path = output_path or default_binary_path(json_path)
+    with open(json_path, 'rb') as f:
+        source = f.read()
+    stat = os.stat(json_path)
+    chunks = json.loads(source.decode('utf-8')).get('chunks', [])
+
+    strings = _StringTable()
+    chunk_rows = []
+    chunk_keyword_rows = []
+    for chunk in chunks:
+        id_ref = strings.add(str(chunk.get('id', '')))
+        content_ref = strings.add(chunk.get('content', ''))
+        extra = {k: v for k, v in chunk.items() if k not in _BASE_FIELDS}
+        extra_ref = strings.add(json.dumps(extra, ensure_ascii=False)) if extra else (0, 0)
+        keywords = chunk.get('keywords', [])
+        chunk_rows.append((*id_ref, *content_ref, *extra_ref, len(chunk_keyword_rows), len(keywords)))
+        for keyword in keywords:
+            chunk_keyword_rows.append(strings.add(keyword))
+
+    sections = {
+        'chunks': chunk_rows,
+        'chunk_keywords': chunk_keyword_rows,
+        'hashes': np.frombuffer(b''.join(bytes.fromhex(chunk_hash(c)) for c in chunks), dtype=np.uint8),
+    }
+    for name, values in KeywordIndex(chunks).to_arrays().items():
+        sections[f'ac_{name}'] = values
+
+    bm25 = BM25Scorer(chunks)
+    terms, term_hashes, indptr, doc_ids, weights = bm25.to_arrays()
+    sections.update(
+        bm25_hashes=term_hashes,
+        bm25_terms=[strings.add(term) for term in terms],
+        bm25_indptr=indptr,
+        bm25_doc_ids=doc_ids,
+        bm25_weights=weights,
+    )
+
+    vector_dim = 0
+    if vectors is not None:
+        vectors = np.ascontiguousarray(vectors, dtype='<f4')
+        if vectors.shape[0] != len(chunks):
+            raise ValueError('向量數量與片段數量不一致')
+        vector_dim = vectors.shape[1]
+        sections['vectors'] = vectors
+    sections['strings'] = np.frombuffer(bytes(strings.buffer), dtype=np.uint8)
+
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    layout = {}
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        for name, values in sections.items():
+            dtype, _ = _SECTION_TYPES[name]
+            data = np.ascontiguousarray(np.asarray(values, dtype=dtype).reshape(-1))
+            layout[name] = (_align(f, 64 if name == 'vectors' else 8), int(data.size))
+            f.write(data.tobytes())
+        meta = json.dumps({
+            'sections': layout,
+            'bm25_params': bm25.params,
+            'vector_model': vector_model,
+        }, ensure_ascii=False).encode('utf-8')
+        meta_offset = _align(f)
+        f.write(meta)
+
+        f.seek(0)
+        f.write(_HEADER.pack(
+            MAGIC, VERSION, len(chunks), len(chunk_keyword_rows), vector_dim,
+            stat.st_size, stat.st_mtime_ns, hashlib.sha256(source).digest(), meta_offset, len(meta)
+        ))
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+class MappedVocabulary:
+    """
+    mmap 上的 BM25 詞彙表：詞元 → 詞元編號
+
+    詞元依 (term_hash, 詞元) 排序，查詢時以二分搜尋找出相同雜湊的範圍再比對字串
+    """
+
+    def __init__(self, hashes, terms, string_at):
+        self._hashes = hashes
+        self._terms = terms
+        self._string_at = string_at
+
+    def get(self, term, default=None):
+        target = term_hash(term)
+        index = bisect_left(self._hashes, target)
+        while index < len(self._hashes) and self._hashes[index] == target:
+            if self._string_at(self._terms[2 * index], self._terms[2 * index + 1]) == term:
+                return index
+            index += 1
+        return default
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+class MappedKnowledgeBase(Sequence):
+    """
+    以唯讀 mmap 載入的知識庫
+
+    可當作片段列表使用；片段只在被存取時才從共用頁面解碼，
+    關鍵字自動機與 BM25 索引也直接使用共用頁面，worker 不需各自保存片段字串或重建索引
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        if sys.byteorder != 'little':
+            raise ValueError('二進位知識庫僅支援 little-endian 平台')
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.num_chunks, num_chunk_keywords, self.vector_dim, self.source_size,
+         self.source_mtime_ns, self.source_sha256, meta_offset, meta_length) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'不支援的知識庫二進位格式: {self.path}（請重新執行 compile_knowledge.py）')
+
+        self._buffer = memoryview(self._mmap)
+        meta = json.loads(bytes(self._buffer[meta_offset:meta_offset + meta_length]).decode('utf-8'))
+        self._layout = meta['sections']
+        self.bm25_params = meta.get('bm25_params')
+        self.vector_model = meta.get('vector_model')
+
+        self._strings = self._view('strings')
+        self._chunk_table = self._array('chunks').reshape(-1, _CHUNK_FIELDS)
+        self._chunk_keywords = self._array('chunk_keywords').reshape(-1, 2)
+        self._hashes = self._array('hashes').reshape(-1, 32)
+        self.vectors = None
+        if self.vector_dim:
+            self.vectors = self._array('vectors').reshape(-1, self.vector_dim)
+
+    def _array(self, name):
+        """區段的 NumPy 陣列（不複製）"""
+        offset, count = self._layout[name]
+        return np.frombuffer(self._buffer, dtype=_SECTION_TYPES[name][0], count=count, offset=offset)
+
+    def _view(self, name):
+        """區段的 memoryview，逐一讀取時直接返回 Python 整數（不複製）"""
+        offset, count = self._layout[name]
+        dtype = np.dtype(_SECTION_TYPES[name][0])
+        view = self._buffer[offset:offset + count * dtype.itemsize]
+        return view.cast(dtype.char) if dtype.itemsize > 1 else view
+
+    def _string(self, offset, length):
+        return str(self._strings[offset:offset + length], 'utf-8')
+
+    def is_fresh(self, json_path):
+        """檢查二進位檔是否由目前的 JSON 內容編譯而成"""
+        try:
+            stat = os.stat(json_path)
+        except OSError:
+            # 只有二進位檔時直接使用
+            return True
+        if (stat.st_size, stat.st_mtime_ns) == (self.source_size, self.source_mtime_ns):
+            return True
+        with open(json_path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest() == self.source_sha256
+
+    def __len__(self):
+        return self.num_chunks
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.num_chunks))]
+        if index < 0:
+            index += self.num_chunks
+        if not 0 <= index < self.num_chunks:
+            raise IndexError(index)
+
+        id_off, id_len, content_off, content_len, extra_off, extra_len, kw_start, kw_count = \
+            (int(v) for v in self._chunk_table[index])
+        chunk = {
+            'id': self._string(id_off, id_len),
+            'keywords': [self._string(int(off), int(length))
+                         for off, length in self._chunk_keywords[kw_start:kw_start + kw_count]],
+            'content': self._string(content_off, content_len),
+        }
+        if extra_len:
+            chunk.update(json.loads(self._string(extra_off, extra_len)))
+        return chunk
+
+    def chunk_hashes(self):
+        """每個片段的雜湊值（與 scorers.chunk_hash 相同）"""
+        return [row.tobytes().hex() for row in self._hashes]
+
+    def keyword_index(self):
+        """預先編譯的關鍵字自動機"""
+        return FlatKeywordIndex({name[len('ac_'):]: self._view(name)
+                                 for name in self._layout if name.startswith('ac_')})
+
+    def bm25_index(self, params):
+        """
+        預先計算的 BM25 索引
+
+        Args:
+            params: BM25Scorer.params；與編譯時的參數不同時需重新計算
+
+        Returns:
+            (詞彙表, indptr, 文件索引, 權重)，參數不符時返回 None
+        """
+        if params != self.bm25_params:
+            return None
+        vocabulary = MappedVocabulary(self._view('bm25_hashes'), self._view('bm25_terms'), self._string)
+        return vocabulary, self._array('bm25_indptr'), self._array('bm25_doc_ids'), self._array('bm25_weights')
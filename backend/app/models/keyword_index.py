@@ -0,0 +1,200 @@
+"""
+關鍵字索引模組
+以 Aho-Corasick 自動機在載入時建立關鍵字索引，
+查詢時只需掃描一次問題文字即可找出所有出現的關鍵字
+
+KeywordIndex 可匯出成扁平陣列（見 to_arrays），由 FlatKeywordIndex 直接在 mmap 的陣列上比對，
+worker 不需各自建立自動機
+"""
+from bisect import bisect_left
+from collections import deque
+
+
+class KeywordIndex:
+    """關鍵字 → 片段索引 (Aho-Corasick 自動機)"""
+
+    def __init__(self, chunks=None):
+        """
+        初始化索引
+
+        Args:
+            chunks: 知識片段列表，每個片段可包含 keywords 欄位
+        """
+        # 自動機狀態：goto 轉移表、失敗連結、輸出（關鍵字編號）
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        # 關鍵字編號 → 含有此關鍵字的片段索引（保留重複，與逐一比對的計分一致）
+        self.keyword_postings = []
+        # 空字串關鍵字永遠匹配，另外記錄
+        self._always_match = []
+
+        if chunks:
+            self.build(chunks)
+
+    def build(self, chunks):
+        """依照片段的 keywords 建立自動機"""
+        keyword_ids = {}
+        for chunk_index, chunk in enumerate(chunks):
+            for keyword in chunk.get('keywords', []):
+                keyword_lower = keyword.lower()
+                if not keyword_lower:
+                    self._always_match.append(chunk_index)
+                    continue
+                if keyword_lower not in keyword_ids:
+                    keyword_ids[keyword_lower] = len(self.keyword_postings)
+                    self.keyword_postings.append([])
+                    self._insert(keyword_lower, keyword_ids[keyword_lower])
+                self.keyword_postings[keyword_ids[keyword_lower]].append(chunk_index)
+
+        self._build_failure_links()
+
+    def _insert(self, keyword, keyword_id):
+        """將關鍵字加入 trie"""
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state].append(keyword_id)
+
+    def _build_failure_links(self):
+        """以 BFS 建立失敗連結並合併輸出"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def match_keywords(self, text):
+        """
+        掃描一次文字，返回出現過的關鍵字編號集合
+
+        Args:
+            text: 已轉為小寫的文字
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+    def score(self, question):
+        """
+        計算每個片段命中的關鍵字數
+
+        Args:
+            question: 用戶問題
+
+        Returns:
+            {片段索引: 分數} 字典，只包含分數大於 0 的片段
+        """
+        scores = {}
+        for chunk_index in self._always_match:
+            scores[chunk_index] = scores.get(chunk_index, 0) + 1
+
+        for keyword_id in self.match_keywords(question.lower()):
+            for chunk_index in self.keyword_postings[keyword_id]:
+                scores[chunk_index] = scores.get(chunk_index, 0) + 1
+        return scores
+
+    def to_arrays(self):
+        """
+        匯出為扁平陣列（每個狀態的轉移依字元碼排序）
+
+        Returns:
+            {名稱: 整數列表}：goto_indptr / goto_chars / goto_next 為轉移表，fail 為失敗連結，
+            output_indptr / output 為各狀態的輸出，postings_indptr / postings 為關鍵字 → 片段索引，
+            always_match 為空字串關鍵字的片段索引
+        """
+        arrays = {name: [] for name in ('goto_chars', 'goto_next', 'output', 'postings')}
+        goto_indptr = [0]
+        output_indptr = [0]
+        for transitions, output in zip(self._goto, self._output):
+            for char, next_state in sorted(transitions.items(), key=lambda item: ord(item[0])):
+                arrays['goto_chars'].append(ord(char))
+                arrays['goto_next'].append(next_state)
+            goto_indptr.append(len(arrays['goto_chars']))
+            arrays['output'].extend(output)
+            output_indptr.append(len(arrays['output']))
+        postings_indptr = [0]
+        for chunk_indexes in self.keyword_postings:
+            arrays['postings'].extend(chunk_indexes)
+            postings_indptr.append(len(arrays['postings']))
+        arrays.update(goto_indptr=goto_indptr, fail=list(self._fail), output_indptr=output_indptr,
+                      postings_indptr=postings_indptr, always_match=list(self._always_match))
+        return arrays
+
+
+class FlatKeywordIndex:
+    """
+    以扁平陣列表示的 Aho-Corasick 自動機（KeywordIndex.to_arrays 的輸出）
+
+    陣列可以是 mmap 上的 memoryview，比對時逐一讀取，不需複製到 Python 物件
+    """
+
+    def __init__(self, arrays):
+        self._goto_indptr = arrays['goto_indptr']
+        self._goto_chars = arrays['goto_chars']
+        self._goto_next = arrays['goto_next']
+        self._fail = arrays['fail']
+        self._output_indptr = arrays['output_indptr']
+        self._output = arrays['output']
+        self._postings_indptr = arrays['postings_indptr']
+        self._postings = arrays['postings']
+        self._always_match = arrays['always_match']
+
+    def _next(self, state, code):
+        """狀態 state 讀入字元碼 code 的轉移，沒有轉移時返回 None"""
+        lo, hi = self._goto_indptr[state], self._goto_indptr[state + 1]
+        i = bisect_left(self._goto_chars, code, lo, hi)
+        if i < hi and self._goto_chars[i] == code:
+            return self._goto_next[i]
+        return None
+
+    def match_keywords(self, text):
+        """掃描一次文字，返回出現過的關鍵字編號集合（text 需已轉為小寫）"""
+        output_indptr = self._output_indptr
+        found = set()
+        state = 0
+        for char in text:
+            code = ord(char)
+            next_state = self._next(state, code)
+            while next_state is None and state:
+                state = self._fail[state]
+                next_state = self._next(state, code)
+            state = next_state or 0
+            start, end = output_indptr[state], output_indptr[state + 1]
+            if start != end:
+                found.update(self._output[start:end])
+        return found
+
+    def score(self, question):
+        """與 KeywordIndex.score 相同"""
+        scores = {}
+        for chunk_index in self._always_match:
+            scores[chunk_index] = scores.get(chunk_index, 0) + 1
+
+        for keyword_id in self.match_keywords(question.lower()):
+            for chunk_index in self._postings[self._postings_indptr[keyword_id]:self._postings_indptr[keyword_id + 1]]:
+                scores[chunk_index] = scores.get(chunk_index, 0) + 1
+        return scores
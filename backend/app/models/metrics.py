@@ -0,0 +1,466 @@
+"""
+Prometheus 格式指標模組
+計數器、量測值與直方圖，以 /metrics 端點輸出 Prometheus 文字格式
+
+多個 gunicorn worker：設定 METRICS_DIR 後，每個 worker 定期把自己的指標快照寫入
+METRICS_DIR/<pid>.json，/metrics 讀取所有快照彙總 ——
+計數器與直方圖加總所有 worker（含已結束的，確保數值單調遞增），
+量測值 (進行中請求數等) 只加總仍在執行的 worker
+"""
+import atexit
+import functools
+import inspect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 延遲直方圖的預設區間（秒）：從毫秒級的前處理到數十秒的推論
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.touch()
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """鏡射其他模組自行累計的單調計數（例如快取命中次數）"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        self.registry.touch()
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """區塊執行期間 +1"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.registry.touch()
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            entry['buckets'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']}]
+                    for key, v in self._values.items()]
+
+    @contextmanager
+    def time(self, **labels):
+        """記錄區塊的執行秒數"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class MetricsRegistry:
+    """指標登錄表，負責快照、跨 worker 彙總與輸出文字格式"""
+
+    def __init__(self, directory=None, flush_interval=5.0, from_env=False):
+        """
+        Args:
+            directory: 多 worker 快照目錄；None 表示只輸出本程序的指標
+            flush_interval: 背景寫入快照的間隔秒數
+            from_env: 第一次寫入或輸出時才由 METRICS_DIR / METRICS_FLUSH_INTERVAL 決定上面兩個值；
+                本模組在 .env 載入前就會被匯入，建立時讀取環境變數會漏掉 .env 的設定
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._from_env = from_env
+        self._metrics = {}
+        self._collectors = []
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(self, name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(self, name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help_text, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """登記在快照前呼叫的函式，用來把其他模組的統計同步到指標"""
+        self._collectors.append(collector)
+
+    def _configure(self):
+        """依環境變數設定快照目錄與寫入間隔（只在第一次呼叫時讀取）"""
+        if not self._from_env:
+            return
+        with self._lock:
+            if not self._from_env:
+                return
+            self.directory = os.getenv('METRICS_DIR') or None
+            self.flush_interval = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+            self._from_env = False
+
+    def touch(self):
+        """指標更新時確認本程序的背景寫入執行緒已啟動（fork 後的 worker 各自啟動）"""
+        self._configure()
+        if self.directory and self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        def loop():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        threading.Thread(target=loop, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def snapshot(self):
+        """本程序所有指標的快照"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f'收集指標失敗: {str(e)}')
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            'pid': os.getpid(),
+            'metrics': {
+                m.name: {
+                    'type': m.kind,
+                    'help': m.help,
+                    'labels': list(m.labelnames),
+                    'buckets': list(m.buckets) if m.kind == 'histogram' else None,
+                    'samples': m.samples(),
+                }
+                for m in metrics
+            },
+        }
+
+    def flush(self):
+        """把本程序的快照寫入快照目錄（先寫暫存檔再改名，讀取端不會讀到半份檔案）"""
+        self._configure()
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{os.getpid()}.json')
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f'寫入指標快照失敗: {str(e)}')
+
+    def _snapshots(self):
+        self._configure()
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'r', encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    @staticmethod
+    def _alive(pid):
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def collect(self):
+        """
+        彙總所有 worker 的快照
+
+        Returns:
+            {指標名稱: {'type', 'help', 'labels', 'buckets', 'samples': {標籤值 tuple: 值}}}
+        """
+        merged = {}
+        for snapshot in self._snapshots():
+            alive = self._alive(snapshot.get('pid'))
+            for name, metric in snapshot['metrics'].items():
+                if metric['type'] == 'gauge' and not alive:
+                    # 已結束 worker 的量測值（例如進行中請求數）不再有意義
+                    continue
+                target = merged.setdefault(name, dict(metric, samples={}))
+                for labels, value in metric['samples']:
+                    key = tuple(labels)
+                    current = target['samples'].get(key)
+                    if metric['type'] == 'histogram':
+                        if current is None:
+                            current = target['samples'][key] = {
+                                'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0}
+                        current['buckets'] = [a + b for a, b in zip(current['buckets'], value['buckets'])]
+                        current['sum'] += value['sum']
+                        current['count'] += value['count']
+                    else:
+                        target['samples'][key] = (current or 0) + value
+        return merged
+
+    def render(self):
+        """輸出 Prometheus 文字格式"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            for labels, value in sorted(metric['samples'].items()):
+                pairs = list(zip(metric['labels'], labels))
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{_format_labels(pairs)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                bounds = [_format_value(b) for b in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(pairs + [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(pairs)} {_format_value(value["sum"])}')
+                lines.append(f'{name}_count{_format_labels(pairs)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry(from_env=True)
+
+# ===== /api/ask 流程 =====
+REQUESTS = REGISTRY.counter(
+    'campus_ai_http_requests_total', 'HTTP 請求數', ('endpoint', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'campus_ai_http_request_duration_seconds', 'HTTP 請求處理秒數', ('endpoint',))
+IN_FLIGHT = REGISTRY.gauge(
+    'campus_ai_http_in_flight_requests', '進行中的 HTTP 請求數', ('endpoint',))
+STAGE_SECONDS = REGISTRY.histogram(
+    'campus_ai_stage_duration_seconds',
+    '各處理階段秒數 (json_parse / upload_read / base64_decode / retrieve / prompt_build / '
+    'image_preprocess / queue_wait / serialize)',
+    ('stage',))
+
+CONTEXT_TOKENS = REGISTRY.histogram(
+    'campus_ai_context_tokens', '放入 prompt 的參考資料估計 token 數', ('model',),
+    buckets=(64, 128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192))
+CONTEXT_TRIMMED_TOKENS = REGISTRY.counter(
+    'campus_ai_context_trimmed_tokens_total', '因超過模型預算而未放入 prompt 的參考資料估計 token 數', ('model',))
+
+STARTUP_SECONDS = REGISTRY.histogram(
+    'campus_ai_startup_duration_seconds',
+    '從開始匯入應用起算的啟動耗時 (init: 可以開始服務 / discovery: 第一次後端探測完成 / first_request: 收到第一個請求)',
+    ('phase',))
+
+# ===== 模型 =====
+MODEL_REQUESTS = REGISTRY.counter(
+    'campus_ai_model_requests_total', '各模型的查詢數', ('model',))
+MODEL_ERRORS = REGISTRY.counter(
+    'campus_ai_model_errors_total', '各模型的錯誤數 (model_error / queue_full / exception)', ('model', 'reason'))
+MODEL_IN_FLIGHT = REGISTRY.gauge(
+    'campus_ai_model_in_flight_requests', '各模型進行中的查詢數', ('model',))
+BACKEND_SECONDS = REGISTRY.histogram(
+    'campus_ai_backend_duration_seconds', '呼叫模型後端的秒數', ('backend', 'model', 'node'))
+
+# ===== 佇列、快取與節點（由 AIModel 在快照前同步） =====
+QUEUE_ACTIVE = REGISTRY.gauge(
+    'campus_ai_queue_active', '各後端進行中的推論數', ('backend',))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'campus_ai_queue_depth', '各後端排隊中的請求數', ('backend',))
+QUEUE_REJECTED = REGISTRY.counter(
+    'campus_ai_queue_rejected_total', '各後端因佇列已滿或排隊逾時被拒絕的請求數', ('backend',))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'campus_ai_cache_lookups_total', '回應快取查詢數 (hit / similar_hit / miss)', ('result',))
+FAQ_LOOKUPS = REGISTRY.counter(
+    'campus_ai_faq_lookups_total',
+    '預先產生回答的查詢數 (hit / low_confidence / ambiguous / screen_reference / no_answer)', ('result',))
+FAQ_SAVED_SECONDS = REGISTRY.counter(
+    'campus_ai_faq_saved_seconds_total', '使用預先產生的回答估計省下的推論秒數')
+ROUTING_DECISIONS = REGISTRY.counter(
+    'campus_ai_routing_decisions_total', '模型路由決策數（指定的模型、實際使用的模型與原因）',
+    ('requested', 'model', 'reason'))
+SEMANTIC_CACHE_LOOKUPS = REGISTRY.counter(
+    'campus_ai_semantic_cache_lookups_total', '語意快取查詢數 (hit / miss)，只計文本模型', ('result',))
+COALESCED = REGISTRY.counter(
+    'campus_ai_coalesced_requests_total', '合併到進行中相同請求的請求數 (local / remote)', ('scope',))
+OLLAMA_NODE_UP = REGISTRY.gauge(
+    'campus_ai_ollama_node_up', 'Ollama 節點是否健康', ('node',))
+
+# ===== Ollama 回傳的計時欄位 =====
+OLLAMA_EVAL_TOKENS = REGISTRY.counter(
+    'campus_ai_ollama_eval_tokens_total', 'Ollama 生成的 token 數 (eval_count)', ('model', 'node'))
+OLLAMA_PROMPT_TOKENS = REGISTRY.counter(
+    'campus_ai_ollama_prompt_eval_tokens_total', 'Ollama 處理的 prompt token 數 (prompt_eval_count)', ('model', 'node'))
+OLLAMA_EVAL_SECONDS = REGISTRY.histogram(
+    'campus_ai_ollama_eval_duration_seconds', 'Ollama 生成耗時 (eval_duration)', ('model',))
+OLLAMA_PROMPT_EVAL_SECONDS = REGISTRY.histogram(
+    'campus_ai_ollama_prompt_eval_duration_seconds', 'Ollama prompt 處理耗時 (prompt_eval_duration)', ('model',))
+OLLAMA_PROMPT_REUSED_TOKENS = REGISTRY.counter(
+    'campus_ai_ollama_prompt_reused_tokens_total', '重用 KV 快取中系統提示前綴而不需處理的 prompt token 數', ('model',))
+OLLAMA_PROMPT_SAVED_SECONDS = REGISTRY.counter(
+    'campus_ai_ollama_prompt_saved_seconds_total', '重用系統提示前綴估計省下的 prompt 處理秒數', ('model',))
+OLLAMA_LOAD_SECONDS = REGISTRY.histogram(
+    'campus_ai_ollama_load_duration_seconds', 'Ollama 載入模型耗時 (load_duration)', ('model',))
+OLLAMA_COLD_STARTS = REGISTRY.counter(
+    'campus_ai_ollama_cold_starts_total', '需要從磁碟載入模型的 Ollama 呼叫數 (request / preload)', ('model', 'source'))
+
+
+def record_ollama_timing(model, node, data):
+    """記錄 Ollama 回應中的 token 數與耗時 (奈秒)"""
+    if 'eval_count' in data:
+        OLLAMA_EVAL_TOKENS.inc(data['eval_count'], model=model, node=node)
+    if 'prompt_eval_count' in data:
+        OLLAMA_PROMPT_TOKENS.inc(data['prompt_eval_count'], model=model, node=node)
+    if 'eval_duration' in data:
+        OLLAMA_EVAL_SECONDS.observe(data['eval_duration'] / 1e9, model=model)
+    if 'prompt_eval_duration' in data:
+        OLLAMA_PROMPT_EVAL_SECONDS.observe(data['prompt_eval_duration'] / 1e9, model=model)
+    if 'load_duration' in data:
+        OLLAMA_LOAD_SECONDS.observe(data['load_duration'] / 1e9, model=model)
+
+
+def _status_of(response):
+    if isinstance(response, tuple):
+        return response[1] if len(response) > 1 and isinstance(response[1], int) else 200
+    return getattr(response, 'status_code', 200)
+
+
+def track_request(endpoint):
+    """
+    路由裝飾器：記錄請求數 (依狀態碼)、處理秒數與進行中請求數；同時支援 Flask 與 ASGI (async) 路由
+
+    串流回應只計到開始串流為止，生成期間由 campus_ai_model_in_flight_requests 反映
+    """
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                status = 500
+                started = time.perf_counter()
+                IN_FLIGHT.inc(endpoint=endpoint)
+                try:
+                    response = await view(*args, **kwargs)
+                    status = _status_of(response)
+                    return response
+                finally:
+                    IN_FLIGHT.dec(endpoint=endpoint)
+                    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+                    REQUESTS.inc(endpoint=endpoint, status=status)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            status = 500
+            started = time.perf_counter()
+            IN_FLIGHT.inc(endpoint=endpoint)
+            try:
+                response = view(*args, **kwargs)
+                status = _status_of(response)
+                return response
+            finally:
+                IN_FLIGHT.dec(endpoint=endpoint)
+                REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+                REQUESTS.inc(endpoint=endpoint, status=status)
+        return wrapper
+    return decorator
@@ -0,0 +1,246 @@
+"""
+模型目錄快取模組
+/api/models 的內容在背景探測後預先組好，請求時直接返回，不做任何網路呼叫：
+- Ollama: 各節點 /api/tags (已安裝的模型) 與 /api/ps (目前載入在記憶體中的模型)，由 OllamaNodePool 定期探測
+- 雲端: 定期呼叫 OpenAI / Anthropic 的模型列表 API 確認密鑰與連線是否正常
+探測資料超過 TTL 時（例如健康檢查停用）在背景重新探測，期間先返回舊資料（freshness() 標記 stale）
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# 雲端後端的健康檢查：列出模型的 API（不產生推論費用）
+CLOUD_PROBES = {
+    'gpt': ('https://api.openai.com/v1/models', lambda key: {'Authorization': f'Bearer {key}'}),
+    'claude': ('https://api.anthropic.com/v1/models',
+               lambda key: {'x-api-key': key, 'anthropic-version': '2023-06-01'}),
+}
+
+
+def _short_name(name):
+    """llava:latest -> llava"""
+    return name[:-len(':latest')] if name.endswith(':latest') else name
+
+
+class ModelCatalog:
+    """/api/models 的模型目錄快取"""
+
+    def __init__(self, pool, session_factory, cloud_keys, registry, ttl=60.0, cloud_interval=300.0,
+                 ollama_configured=True):
+        """
+        Args:
+            pool: OllamaNodePool
+            session_factory: 返回 requests.Session 的函式
+            cloud_keys: {'gpt': API 密鑰或 None, 'claude': ...}
+            registry: ModelRegistry，提供顯示名稱、說明與固定列出的模型
+            ttl: Ollama 探測資料的有效秒數
+            cloud_interval: 雲端健康檢查間隔秒數，0 表示不檢查（只看是否設定密鑰）
+        """
+        self.pool = pool
+        self.session_factory = session_factory
+        self.cloud_keys = cloud_keys
+        self.registry = registry
+        self.ttl = ttl
+        self.cloud_interval = cloud_interval
+        self.ollama_configured = ollama_configured
+        self._cloud_state = {}
+        self._snapshot = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._cloud_thread = None
+        pool.add_listener(self.rebuild)
+
+    def get(self):
+        """
+        返回預先組好的模型目錄（不做網路呼叫）
+
+        Returns:
+            {模型名稱: {'name', 'status', 'description', 'location', ...}}
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.rebuild()
+        if self.ollama_configured and self._data_age() > self.ttl:
+            self._refresh_in_background()
+        return snapshot
+
+    def freshness(self):
+        """
+        Returns:
+            {'checked_at': 最舊的節點探測時間, 'stale': 探測資料是否超過 TTL}
+        """
+        checked = [node.last_checked for node in self.pool.nodes if node.last_checked]
+        return {
+            'checked_at': datetime.fromtimestamp(min(checked)).isoformat() if checked else None,
+            'stale': self.ollama_configured and self._data_age() > self.ttl,
+        }
+
+    def _data_age(self):
+        checked = [node.last_checked for node in self.pool.nodes if node.last_checked]
+        return time.time() - min(checked) if checked else 0.0
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.pool.probe(self.session_factory())
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, name='model-catalog-refresh', daemon=True).start()
+
+    def rebuild(self):
+        """依目前的節點與雲端狀態重新組出模型目錄"""
+        catalog = {}
+        for name, installed in self._ollama_models().items():
+            title, description = self._describe(name, f'🖥️ {name} (本地 Ollama)', '本地 Ollama 模型')
+            catalog[name] = {'name': title, 'description': description, 'location': 'local', **installed}
+        for spec in self.registry.listed():
+            if spec.backend in CLOUD_PROBES:
+                title, description = self._describe(spec.name, spec.name, '')
+                catalog[spec.name] = {'name': title, 'description': description, 'location': 'cloud',
+                                      **self._cloud_entry(spec.backend)}
+        self._snapshot = catalog
+        self._built_at = time.time()
+        return catalog
+
+    def _describe(self, name, title, description):
+        """登錄表中的顯示名稱與說明，未設定時使用預設值"""
+        spec = self.registry.get(name)
+        if spec is None:
+            return title, description
+        return spec.title or title, spec.description or description
+
+    def _ollama_models(self):
+        """
+        Returns:
+            {模型名稱: {'status', 'url', 'resident', 'nodes', ...}}；固定列出登錄表中標記 listed 的本地模型，
+            再加上其他已安裝的模型
+        """
+        names = [spec.name for spec in self.registry.listed() if spec.backend == 'ollama']
+        for node in self.pool.nodes:
+            for full_name, details in node.model_details.items():
+                name = _short_name(full_name)
+                # embedding 模型不能回答問題
+                if name not in names and 'embed' not in name and 'bert' not in (details.get('family') or ''):
+                    names.append(name)
+
+        healthy = [node for node in self.pool.nodes if node.healthy]
+        models = {}
+        for name in names:
+            nodes = [node for node in healthy if node.has_model(name)]
+            if not self.ollama_configured:
+                status = 'unconfigured'
+            elif not healthy and not self.pool.discovered.is_set():
+                status = 'pending'
+            elif not healthy:
+                status = 'unavailable'
+            elif not nodes:
+                status = 'not_installed'
+            else:
+                status = 'available'
+            entry = {
+                'status': status,
+                'url': nodes[0].url if nodes else (self.pool.nodes[0].url if self.ollama_configured else '未配置'),
+                'installed': bool(nodes),
+                'resident': any(node.is_resident(name) for node in nodes),
+                'nodes': [self._node_entry(node, name) for node in nodes],
+            }
+            details = next((self._details(node, name) for node in nodes), None)
+            if details:
+                entry['size'] = details.get('size')
+                entry['parameter_size'] = details.get('parameter_size')
+                entry['quantization_level'] = details.get('quantization_level')
+            models[name] = entry
+        return models
+
+    @staticmethod
+    def _details(node, name):
+        return node.model_details.get(name) or node.model_details.get(f'{name}:latest')
+
+    @staticmethod
+    def _node_entry(node, name):
+        resident = node.resident.get(name) or node.resident.get(f'{name}:latest')
+        return {
+            'url': node.url,
+            'resident': resident is not None,
+            'expires_at': resident.get('expires_at') if resident else None,
+            'size_vram': resident.get('size_vram') if resident else None,
+        }
+
+    def _cloud_entry(self, name):
+        if not self.cloud_keys.get(name):
+            return {'status': 'unconfigured'}
+        state = self._cloud_state.get(name)
+        if state is None:
+            return {'status': 'available', 'checked_at': None}
+        return {'status': state['status'], 'checked_at': state['checked_at'], 'error': state['error']}
+
+    def probe_cloud(self, session, timeout=5):
+        """呼叫已設定密鑰的雲端後端的模型列表 API，更新其可用狀態"""
+        for name, (url, headers) in CLOUD_PROBES.items():
+            key = self.cloud_keys.get(name)
+            if not key:
+                continue
+            error = None
+            try:
+                response = session.get(url, headers=headers(key), timeout=timeout)
+                if response.status_code == 200:
+                    status = 'available'
+                elif response.status_code in (401, 403):
+                    status, error = 'unauthorized', f'HTTP {response.status_code}'
+                else:
+                    status, error = 'unavailable', f'HTTP {response.status_code}'
+            except Exception as e:
+                status, error = 'unreachable', str(e)
+            previous = self._cloud_state.get(name, {}).get('status')
+            if status != previous and status != 'available':
+                logger.warning(f'⚠️ 雲端後端 {name} 狀態: {status} ({error})')
+            self._cloud_state[name] = {'status': status, 'error': error, 'checked_at': datetime.now().isoformat()}
+        self.rebuild()
+
+    def start_cloud_probe(self):
+        """啟動雲端後端的背景健康檢查（每個程序一次）"""
+        if self.cloud_interval <= 0 or not any(self.cloud_keys.values()):
+            return
+        if self._cloud_thread and self._cloud_thread.is_alive():
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.probe_cloud(self.session_factory())
+                except Exception as e:
+                    logger.warning(f'雲端後端健康檢查失敗: {str(e)}')
+                time.sleep(self.cloud_interval)
+
+        self._cloud_thread = threading.Thread(target=loop, name='cloud-probe', daemon=True)
+        self._cloud_thread.start()
+
+
+def create_model_catalog(pool, session_factory, cloud_keys, registry, ollama_configured=True):
+    """
+    依環境變數建立模型目錄
+
+    MODEL_CATALOG_TTL: Ollama 探測資料的有效秒數（預設 60）
+    CLOUD_HEALTH_INTERVAL: 雲端健康檢查間隔秒數（預設 300，0 表示停用）
+    """
+    return ModelCatalog(
+        pool,
+        session_factory,
+        cloud_keys,
+        registry,
+        ttl=float(os.getenv('MODEL_CATALOG_TTL', '60')),
+        cloud_interval=float(os.getenv('CLOUD_HEALTH_INTERVAL', '300')),
+        ollama_configured=ollama_configured,
+    )
@@ -0,0 +1,106 @@
+"""
+模型登錄表
+每個模型的後端、是否為視覺模型、截圖目標尺寸、延遲估計、參考資料預算與顯示名稱集中在 model_registry.json，
+後端選擇、截圖預處理、模型目錄與路由都從這裡讀取，新增模型只需修改設定檔；
+未列在登錄表、但已安裝在 Ollama 節點上的模型，依 /api/tags 的 families 判斷是否為視覺模型
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REGISTRY_PATH = Path(__file__).parent / 'model_registry.json'
+
+# /api/tags details.families 中代表模型含圖片編碼器的名稱
+VISION_FAMILIES = ('clip', 'mllama')
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """單一模型的設定"""
+    name: str
+    backend: str
+    vision: bool = False
+    image_target: Optional[int] = None  # 截圖預處理的目標長邊（像素）
+    latency_hint: Optional[float] = None  # 尚無實測延遲時的估計秒數
+    listed: bool = False  # 未安裝時也列在 /api/models
+    prompt: Optional[str] = None  # prompt_templates 中的範本名稱，未設定時依後端與是否為視覺模型選擇
+    context_budget: Optional[int] = None  # 參考資料的 token 預算，未設定時使用 CONTEXT_TOKEN_BUDGET
+    title: Optional[str] = None
+    description: Optional[str] = None
+
+    @classmethod
+    def from_ollama_details(cls, name, details):
+        """由 /api/tags 的模型資訊推斷未登錄的 Ollama 模型"""
+        families = details.get('families') or [details.get('family')]
+        return cls(name=name, backend='ollama', vision=any(f in VISION_FAMILIES for f in families if f))
+
+
+class ModelRegistry:
+    """模型名稱 → ModelSpec"""
+
+    def __init__(self, specs):
+        self._specs = {spec.name: spec for spec in specs}
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        讀取登錄表 JSON
+
+        Args:
+            path: 設定檔路徑，預設為 MODEL_REGISTRY_PATH 或內建的 model_registry.json
+        """
+        path = path or os.getenv('MODEL_REGISTRY_PATH') or DEFAULT_REGISTRY_PATH
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        registry = cls(ModelSpec(**entry) for entry in data.get('models', []))
+        logger.info(f'✅ 模型登錄表: {len(registry)} 個模型 ({path})')
+        return registry
+
+    def get(self, name):
+        """
+        以名稱查詢；未指定標籤時視為 latest，反之 'llava:latest' 也對應到 'llava'
+
+        Returns:
+            ModelSpec，未登錄時返回 None
+        """
+        if not name:
+            return None
+        spec = self._specs.get(name)
+        if spec is None and name.endswith(':latest'):
+            spec = self._specs.get(name[:-len(':latest')])
+        return spec
+
+    def models(self, backend=None, vision=None):
+        """依後端與是否為視覺模型篩選，保留設定檔中的順序"""
+        return [
+            spec for spec in self._specs.values()
+            if (backend is None or spec.backend == backend) and (vision is None or spec.vision == vision)
+        ]
+
+    def listed(self):
+        """未安裝時也列在 /api/models 的模型"""
+        return [spec for spec in self._specs.values() if spec.listed]
+
+    def image_targets(self):
+        """{模型名稱: 截圖目標長邊}"""
+        return {spec.name: spec.image_target for spec in self._specs.values() if spec.image_target}
+
+    def __len__(self):
+        return len(self._specs)
+
+
+# 單例模式：全域共享一個登錄表
+_registry_instance = None
+
+
+def get_model_registry():
+    """獲取全域模型登錄表（MODEL_REGISTRY_PATH 指定自訂設定檔）"""
+    global _registry_instance
+    if _registry_instance is None:
+        _registry_instance = ModelRegistry.load()
+    return _registry_instance
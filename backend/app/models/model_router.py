@@ -0,0 +1,213 @@
+"""
+模型路由模組
+依每個請求的訊號決定實際使用的本地模型：
+- 問題提到畫面 → 視覺模型
+- 指定視覺模型，但檢索到高信心度的片段且問題沒有提到畫面 → 文本模型即可回答，省下圖片編碼與視覺推論
+- 指定文本模型且問題沒有提到畫面時不因信心度改用視覺模型：各評分器的信心度尺度不同
+  （關鍵詞命中一個即為 0.5），低信心度不代表答案在截圖上
+- 同一類模型中，依各模型目前的進行中請求數與實測延遲估計完成時間，選擇較快的模型
+雲端模型（需付費）只在使用者指定時使用，不會自動改派；每個路由決策都寫入日誌與 /api/router/stats
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+
+from . import metrics
+from .screen_reference import references_screen
+
+logger = logging.getLogger(__name__)
+
+# 實測延遲指數移動平均的權重
+LATENCY_EWMA_ALPHA = 0.2
+
+# 沒有實測延遲也沒有登錄表估計時使用的秒數
+DEFAULT_LATENCY = 5.0
+
+# 路由結果；signals 為做決策時參考的訊號，供稽核
+RoutingDecision = namedtuple('RoutingDecision', ['requested', 'model', 'backend', 'reason', 'signals'])
+
+
+class ModelRouter:
+    """為每個請求選擇模型，並追蹤各模型的進行中請求數與延遲"""
+
+    def __init__(self, registry, resolve, spec_for, available, mode='auto', text_min_confidence=0.6,
+                 switch_ratio=1.5, history=200):
+        """
+        Args:
+            registry: ModelRegistry
+            resolve: 模型名稱 → (後端名稱, 模型名稱)，沒有可用後端時後端名稱為 None
+            spec_for: 模型名稱 → ModelSpec 或 None（含未登錄但已安裝的 Ollama 模型）
+            available: 模型名稱 → 目前是否有健康且安裝了此模型的節點
+            mode: auto (依訊號改派) / off (一律使用指定的模型)
+            text_min_confidence: 指定視覺模型時，改用文本模型所需的最低檢索信心度
+            switch_ratio: 同一類模型中，其他模型的估計時間要快這個倍數以上才改派
+            history: 保留最近幾筆路由決策
+        """
+        self.registry = registry
+        self.resolve = resolve
+        self.spec_for = spec_for
+        self.available = available
+        self.mode = mode
+        self.text_min_confidence = text_min_confidence
+        self.switch_ratio = switch_ratio
+        self.in_flight = Counter()
+        self._latency = {}  # 模型 -> 實測延遲的指數移動平均（秒）
+        self._decisions = deque(maxlen=history)
+        self._reasons = Counter()
+        self._lock = threading.Lock()
+
+    def expected_latency(self, model):
+        """模型的預期推論秒數：實測平均，沒有時用登錄表的估計"""
+        with self._lock:
+            latency = self._latency.get(model)
+        if latency is not None:
+            return latency
+        spec = self.spec_for(model)
+        return spec.latency_hint if spec and spec.latency_hint else DEFAULT_LATENCY
+
+    def estimate(self, model):
+        """估計新請求的完成秒數：前面每個進行中的請求都要等一次推論時間"""
+        return self.expected_latency(model) * (1 + self.in_flight[model])
+
+    def observe(self, model, seconds):
+        """記錄一次實際推論的耗時（含排隊與圖片預處理）"""
+        with self._lock:
+            previous = self._latency.get(model)
+            self._latency[model] = seconds if previous is None else previous + LATENCY_EWMA_ALPHA * (seconds - previous)
+
+    def started(self, model):
+        with self._lock:
+            self.in_flight[model] += 1
+
+    def finished(self, model):
+        with self._lock:
+            self.in_flight[model] -= 1
+
+    @contextmanager
+    def track(self, model):
+        """區塊執行期間計入模型的進行中請求"""
+        self.started(model)
+        try:
+            yield
+        finally:
+            self.finished(model)
+
+    def route(self, requested, context=None):
+        """
+        決定請求實際使用的模型
+
+        Args:
+            requested: 使用者指定的模型名稱
+            context: RetrievedContext；沒有時不改派
+
+        Returns:
+            RoutingDecision
+        """
+        backend, model = self.resolve(requested)
+        reason = 'requested' if model == requested else 'default'
+        signals = {}
+        if self.mode == 'auto' and backend == 'ollama' and context is not None:
+            routed, switch, signals = self._route_local(model, context)
+            if routed != model:
+                model, reason = routed, switch
+        decision = RoutingDecision(requested, model, backend, reason, signals)
+        self._record(decision)
+        return decision
+
+    def _route_local(self, model, context):
+        """
+        在本地 Ollama 模型之間選擇
+
+        問題提到畫面時需要視覺模型；指定視覺模型且信心度達到 text_min_confidence 時改用文本模型，
+        其餘情況維持指定模型的類別。
+        指定的模型類別（視覺 / 文本）不符時改用同類中登錄表順序最前面的可用模型；
+        選定的模型有進行中的請求、且同類其他模型的估計完成時間快 switch_ratio 倍以上時改派
+
+        Returns:
+            (模型名稱, 改派原因, 訊號)
+        """
+        screen = references_screen(context.question)
+        current = self.spec_for(model)
+        requested_vision = current is not None and current.vision
+        vision = screen or (requested_vision and context.confidence < self.text_min_confidence)
+        signals = {
+            'screen_reference': screen,
+            'confidence': round(context.confidence, 3),
+            'needs_vision': vision,
+        }
+
+        fits = current is not None and current.vision == vision
+        candidates = [spec.name for spec in self.registry.models(backend='ollama', vision=vision)]
+        if fits and model not in candidates:
+            candidates.insert(0, model)
+        candidates = [name for name in candidates if self.available(name)]
+        signals['estimates'] = {name: round(self.estimate(name), 2) for name in candidates}
+        if not candidates:
+            return model, 'no_alternative', signals
+
+        if model in candidates:
+            preferred, reason = model, 'requested'
+        elif fits:
+            preferred, reason = candidates[0], 'unavailable'
+        elif vision:
+            preferred, reason = candidates[0], 'screen_reference'
+        else:
+            preferred, reason = candidates[0], 'text_sufficient'
+
+        best = min(candidates, key=self.estimate)
+        if self.in_flight[preferred] and self.estimate(best) * self.switch_ratio < self.estimate(preferred):
+            signals['in_flight'] = {name: self.in_flight[name] for name in candidates if self.in_flight[name]}
+            return best, 'load_balance', signals
+        return preferred, reason, signals
+
+    def _record(self, decision):
+        """寫入日誌、計數與最近的決策紀錄（未登錄也未安裝的模型名稱記為 default，避免任意輸入成為指標標籤）"""
+        routed = decision.model != decision.requested
+        log = logger.info if routed else logger.debug
+        log(f'🧭 模型路由: {decision.requested} → {decision.model} ({decision.reason}) {decision.signals}')
+        spec = self.spec_for(decision.requested)
+        requested = spec.name if spec is not None else 'default'
+        metrics.ROUTING_DECISIONS.inc(requested=requested, model=decision.model, reason=decision.reason)
+        with self._lock:
+            self._reasons[decision.reason] += 1
+            self._decisions.append({'time': time.time(), **decision._asdict()})
+
+    def stats(self):
+        """路由統計（本程序）：各原因的次數、各模型的延遲與進行中請求、最近的決策"""
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'text_min_confidence': self.text_min_confidence,
+                'switch_ratio': self.switch_ratio,
+                'reasons': dict(self._reasons),
+                'latency_seconds': {m: round(s, 3) for m, s in self._latency.items()},
+                'in_flight': {m: n for m, n in self.in_flight.items() if n},
+                'recent': list(self._decisions)[-20:],
+                'pid': os.getpid(),
+            }
+
+
+def create_model_router(registry, resolve, spec_for, available):
+    """
+    依環境變數建立模型路由
+
+    MODEL_ROUTING: auto (預設) / off
+    ROUTER_TEXT_MIN_CONFIDENCE: 指定視覺模型時，改用文本模型所需的最低檢索信心度（預設 0.6）
+    ROUTER_SWITCH_RATIO: 同類模型估計時間快幾倍以上才改派（預設 1.5）
+    """
+    mode = os.getenv('MODEL_ROUTING', 'auto').lower()
+    if mode not in ('auto', 'off'):
+        logger.warning(f'未知的 MODEL_ROUTING {mode}，改用 auto')
+        mode = 'auto'
+    return ModelRouter(
+        registry,
+        resolve,
+        spec_for,
+        available,
+        mode=mode,
+        text_min_confidence=float(os.getenv('ROUTER_TEXT_MIN_CONFIDENCE', '0.6')),
+        switch_ratio=float(os.getenv('ROUTER_SWITCH_RATIO', '1.5')),
+    )
@@ -0,0 +1,242 @@
+"""
+Ollama 多節點負載平衡模組
+在多台 Ollama 主機之間分配推論請求：
+- 只送往已安裝該模型的健康節點 (依 /api/tags)
+- least_outstanding: 進行中請求最少的節點，相同時取延遲較低者
+- latency: 以延遲移動平均 × (進行中請求 + 1) 加權
+背景健康檢查定期呼叫 /api/tags，失敗的節點暫停使用，恢復後重新加入；
+同時以 /api/ps 記錄各節點目前載入在記憶體中的模型
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('least_outstanding', 'latency')
+
+
+class OllamaNode:
+    """單一 Ollama 節點的狀態"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.healthy = False
+        self.models = set()
+        self.model_details = {}  # 模型名稱 -> /api/tags 的 size 與 details
+        self.resident = {}  # 模型名稱 -> /api/ps 的 expires_at 與 size_vram
+        self.outstanding = 0
+        self.latency = None  # 推論延遲的指數移動平均（秒）
+        self.requests = 0
+        self.failures = 0
+        self.last_checked = None
+        self.last_error = None
+
+    def has_model(self, model):
+        """/api/tags 的名稱帶有標籤 (llava:latest)，未指定標籤時視為 latest"""
+        return model in self.models or (':' not in model and f'{model}:latest' in self.models)
+
+    def is_resident(self, model):
+        """模型目前是否載入在此節點的記憶體中"""
+        return model in self.resident or (':' not in model and f'{model}:latest' in self.resident)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'models': sorted(self.models),
+            'resident': sorted(self.resident),
+            'outstanding': self.outstanding,
+            'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+            'requests': self.requests,
+            'failures': self.failures,
+            'last_checked': self.last_checked,
+            'last_error': self.last_error,
+        }
+
+
+class OllamaNodePool:
+    """多個 Ollama 節點的路由與健康檢查"""
+
+    def __init__(self, urls, strategy='least_outstanding'):
+        """
+        Args:
+            urls: 節點 URL 列表
+            strategy: 路由策略 (least_outstanding / latency)
+        """
+        if strategy not in STRATEGIES:
+            logger.warning(f'未知的 Ollama 路由策略 {strategy}，改用 least_outstanding')
+            strategy = 'least_outstanding'
+        self.nodes = [OllamaNode(url) for url in urls]
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._probe_thread = None
+        self._listeners = []
+        # 第一次探測完成（不論結果）後設定
+        self.discovered = threading.Event()
+        self.discovered_at = None
+
+    @property
+    def healthy(self):
+        return any(node.healthy for node in self.nodes)
+
+    def add_listener(self, listener):
+        """登記在每次探測完成與節點被剔除後呼叫的函式（例如重建模型目錄）"""
+        self._listeners.append(listener)
+
+    def _notify(self):
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.warning(f'Ollama 節點狀態通知失敗: {str(e)}')
+
+    def probe(self, session, timeout=2):
+        """
+        以 /api/tags 檢查所有節點，更新可用模型並剔除 / 恢復節點；/api/ps 取得目前載入的模型
+
+        Args:
+            session: requests.Session
+        """
+        for node in self.nodes:
+            try:
+                response = session.get(f'{node.url}/api/tags', timeout=timeout)
+                if response.status_code != 200:
+                    raise RuntimeError(f'HTTP {response.status_code}')
+                details = {
+                    m['name']: {'size': m.get('size'), **(m.get('details') or {})}
+                    for m in response.json().get('models', [])
+                }
+                models = set(details)
+            except Exception as e:
+                if node.healthy or node.last_checked is None:
+                    logger.warning(f'⚠️ Ollama 節點不可用 ({node.url}): {str(e)}')
+                with self._lock:
+                    node.healthy = False
+                    node.last_error = str(e)
+                    node.last_checked = time.time()
+                continue
+            resident = self._probe_resident(session, node, timeout)
+            if not node.healthy:
+                logger.info(f'✅ Ollama 節點可用: {node.url}，模型: {sorted(models)}')
+            with self._lock:
+                node.healthy = True
+                node.models = models
+                node.model_details = details
+                if resident is not None:
+                    node.resident = resident
+                node.last_error = None
+                node.last_checked = time.time()
+        self._notify()
+
+    @staticmethod
+    def _probe_resident(session, node, timeout):
+        """
+        Returns:
+            {模型名稱: {'expires_at', 'size_vram'}}；舊版 Ollama 沒有 /api/ps 時返回 None
+        """
+        try:
+            response = session.get(f'{node.url}/api/ps', timeout=timeout)
+            if response.status_code != 200:
+                return None
+            return {
+                m['name']: {'expires_at': m.get('expires_at'), 'size_vram': m.get('size_vram')}
+                for m in response.json().get('models', [])
+            }
+        except Exception:
+            return None
+
+    def start_probe(self, session_factory, interval=15, on_discovered=None):
+        """
+        啟動背景健康檢查執行緒：立即探測一次，之後每 interval 秒重新探測
+
+        Args:
+            session_factory: 返回 requests.Session 的函式（每個程序各自的 Session）
+            interval: 檢查間隔秒數，0 表示只探測一次
+            on_discovered: 第一次探測完成後呼叫的函式
+        """
+        if self._probe_thread and self._probe_thread.is_alive():
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.probe(session_factory())
+                except Exception as e:
+                    logger.warning(f'Ollama 健康檢查失敗: {str(e)}')
+                if not self.discovered.is_set():
+                    self.discovered_at = time.perf_counter()
+                    self.discovered.set()
+                    if on_discovered is not None:
+                        on_discovered()
+                if interval <= 0:
+                    return
+                time.sleep(interval)
+
+        self._probe_thread = threading.Thread(target=loop, name='ollama-probe', daemon=True)
+        self._probe_thread.start()
+
+    def _score(self, node):
+        latency = node.latency if node.latency is not None else 0.0
+        if self.strategy == 'latency':
+            return (latency * (node.outstanding + 1), node.outstanding)
+        return (node.outstanding, latency)
+
+    def choose(self, model):
+        """
+        選出負責此模型的節點
+
+        Returns:
+            OllamaNode；沒有健康且安裝了此模型的節點時返回 None
+        """
+        with self._lock:
+            candidates = [n for n in self.nodes if n.healthy and n.has_model(model)]
+            if not candidates:
+                return None
+            return min(candidates, key=self._score)
+
+    @contextmanager
+    def route(self, model):
+        """
+        選出節點並在使用期間計入進行中請求；延遲由呼叫端在取得成功的回應後以 success() 記錄
+
+        Yields:
+            OllamaNode 或 None（沒有可用節點）
+        """
+        node = self.choose(model)
+        if node is None:
+            yield None
+            return
+        with self._lock:
+            node.outstanding += 1
+            node.requests += 1
+        try:
+            yield node
+        finally:
+            with self._lock:
+                node.outstanding -= 1
+
+    def success(self, node, seconds):
+        """
+        以一次成功推論的耗時更新節點的延遲移動平均
+
+        連線失敗、逾時與錯誤回應不計入，避免失敗的嘗試扭曲延遲加權路由
+        """
+        with self._lock:
+            node.latency = seconds if node.latency is None else 0.8 * node.latency + 0.2 * seconds
+
+    def eject(self, node, reason):
+        """連線失敗的節點立即停止使用，等待健康檢查恢復"""
+        with self._lock:
+            node.failures += 1
+            if not node.healthy:
+                return
+            node.healthy = False
+            node.last_error = reason
+        logger.warning(f'⚠️ Ollama 節點暫停使用 ({node.url}): {reason}')
+        self._notify()
+
+    def stats(self):
+        with self._lock:
+            return {'strategy': self.strategy, 'nodes': [node.stats() for node in self.nodes]}
@@ -0,0 +1,176 @@
+"""
+Ollama 靜態前綴重用模組
+每個模型的系統提示逐位元組相同（見 prompt_templates），Ollama 執行器會保留上一個請求的 KV 快取，
+新請求與其相同的開頭 token 不需重新處理。這個模組：
+- 第一次使用某個模型時在背景量測系統提示的 token 數與處理秒數（raw 模式，不套用 chat 範本，
+  開頭與快取中的前綴不同，一定完整處理），再以正式範本在每個節點上預先處理一次前綴
+- 依各節點的前綴是否已在 KV 快取中（處理過且之後沒有重新載入模型），記錄每個回應重用的 token 數
+  與估計省下的 prompt eval 時間
+
+Ollama 的 context 欄位不適合用來重用前綴：它包含上一次的回答，且伺服器會把它解回文字重新編碼，
+實際省下時間的是執行器的 KV 快取，而這只需要逐位元組相同的前綴
+"""
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+from .prompt_templates import ollama_body
+from .residency import COLD_START_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 量測與預熱請求只生成一個 token
+WARMUP_OPTIONS = {'num_predict': 1}
+
+# raw 量測的 token 數少於系統提示字數的這個比例時，視為命中了其他前綴而無法量測
+MIN_TOKENS_PER_CHAR = 0.2
+
+
+class PromptPrefixCache:
+    """各模型系統提示的量測、預熱與重用統計"""
+
+    def __init__(self, pool, session_factory, warmup=True):
+        """
+        Args:
+            pool: OllamaNodePool
+            session_factory: 返回 requests.Session 的函式
+            warmup: 第一次使用模型時是否量測並預熱前綴
+        """
+        self.pool = pool
+        self.session_factory = session_factory
+        self.warmup = warmup
+        self._prefixes = {}  # 模型 -> {'template', 'tokens', 'seconds'}
+        self._pending = set()
+        self._warm = {}  # (節點 URL, 模型) -> 前綴處理完成的時間（之後沒有重新載入模型）
+        self._stats = {}  # 模型 -> 累計統計
+        self._lock = threading.Lock()
+
+    def ensure(self, model, template, keep_alive=None):
+        """第一次使用模型時在背景量測並預熱前綴（不阻塞請求）"""
+        if not self.warmup:
+            return
+        with self._lock:
+            known = self._prefixes.get(model)
+            if model in self._pending or (known is not None and known['template'] == template.name):
+                return
+            self._pending.add(model)
+        threading.Thread(target=self._compile, args=(model, template, keep_alive),
+                         name=f'prompt-prefix-{model}', daemon=True).start()
+
+    def _compile(self, model, template, keep_alive):
+        try:
+            nodes = [node for node in self.pool.nodes if node.healthy and node.has_model(model)]
+            if not nodes:
+                return
+            session = self.session_factory()
+            prefix = self._measure(session, nodes[0].url, model, template, keep_alive)
+            with self._lock:
+                self._prefixes[model] = prefix
+            for node in nodes:
+                body = ollama_body(template, model, '.', keep_alive=keep_alive, options=WARMUP_OPTIONS)
+                response = session.post(f'{node.url}/api/generate', data=body, timeout=300,
+                                        headers={'Content-Type': 'application/json'})
+                response.raise_for_status()
+                with self._lock:
+                    self._warm.setdefault((node.url, model), time.time())
+            tokens = prefix['tokens'] if prefix['tokens'] is not None else '?'
+            logger.info(f'✅ 系統提示前綴已預熱: {model} ({template.name}, {tokens} tokens, '
+                        f"{prefix['seconds'] * 1000:.0f} ms, {len(nodes)} 個節點)")
+        except Exception as e:
+            logger.warning(f'⚠️ 系統提示前綴預熱失敗 ({model}): {str(e)}')
+        finally:
+            with self._lock:
+                self._pending.discard(model)
+
+    @staticmethod
+    def _measure(session, url, model, template, keep_alive):
+        """以 raw 模式處理系統提示，取得完整處理前綴的 token 數與秒數"""
+        payload = {'model': model, 'prompt': template.system, 'raw': True, 'stream': False,
+                   'options': WARMUP_OPTIONS}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        response = session.post(f'{url}/api/generate', json=payload, timeout=300)
+        response.raise_for_status()
+        data = response.json()
+        tokens = data.get('prompt_eval_count')
+        if tokens is not None and tokens < len(template.system) * MIN_TOKENS_PER_CHAR:
+            tokens = None
+        return {
+            'template': template.name,
+            'tokens': tokens,
+            'seconds': data.get('prompt_eval_duration', 0) / 1e9 if tokens is not None else 0.0,
+        }
+
+    def record(self, model, node, data):
+        """
+        記錄一次 Ollama 回應的 prompt 處理量
+
+        Args:
+            data: Ollama 回應中 done=true 的事件
+
+        Returns:
+            重用的前綴 token 數（未重用或尚未量測時為 0）
+        """
+        if 'prompt_eval_count' not in data:
+            return 0
+        now = time.time()
+        cold = data.get('load_duration', 0) / 1e9 > COLD_START_SECONDS
+        # 前綴要在這個請求送達 Ollama 之前就已處理好
+        started = now - data.get('total_duration', 0) / 1e9
+        with self._lock:
+            stats = self._stats.setdefault(model, {
+                'requests': 0, 'prompt_eval_tokens': 0, 'prompt_eval_seconds': 0.0,
+                'prefix_hits': 0, 'saved_tokens': 0, 'saved_seconds': 0.0,
+            })
+            stats['requests'] += 1
+            stats['prompt_eval_tokens'] += data['prompt_eval_count']
+            stats['prompt_eval_seconds'] += data.get('prompt_eval_duration', 0) / 1e9
+            # 模型重新載入時 KV 快取是空的；處理完這個請求後前綴就在快取中
+            warm_since = self._warm.get((node, model))
+            hit = warm_since is not None and warm_since <= started and not cold
+            if cold or warm_since is None:
+                self._warm[(node, model)] = now
+            prefix = self._prefixes.get(model)
+            if not hit or prefix is None or prefix['tokens'] is None:
+                return 0
+            stats['prefix_hits'] += 1
+            stats['saved_tokens'] += prefix['tokens']
+            stats['saved_seconds'] += prefix['seconds']
+        metrics.OLLAMA_PROMPT_REUSED_TOKENS.inc(prefix['tokens'], model=model)
+        metrics.OLLAMA_PROMPT_SAVED_SECONDS.inc(prefix['seconds'], model=model)
+        return prefix['tokens']
+
+    def stats(self):
+        """各模型的前綴大小、平均 prompt_eval_count 與估計省下的時間（本程序）"""
+        with self._lock:
+            models = {}
+            for model, stats in self._stats.items():
+                prefix = self._prefixes.get(model) or {}
+                requests = stats['requests']
+                models[model] = {
+                    'template': prefix.get('template'),
+                    'prefix_tokens': prefix.get('tokens'),
+                    'prefix_ms': round(prefix['seconds'] * 1000, 2) if prefix else None,
+                    'requests': requests,
+                    'avg_prompt_eval_count': round(stats['prompt_eval_tokens'] / requests, 1),
+                    'avg_prompt_eval_ms': round(stats['prompt_eval_seconds'] * 1000 / requests, 2),
+                    'prefix_hits': stats['prefix_hits'],
+                    'saved_tokens': stats['saved_tokens'],
+                    'saved_seconds': round(stats['saved_seconds'], 3),
+                }
+            return {'warmup': self.warmup, 'models': models, 'pid': os.getpid()}
+
+
+def create_prompt_prefix_cache(pool, session_factory):
+    """
+    依環境變數建立前綴重用統計
+
+    OLLAMA_PREFIX_WARMUP: true (預設) / false，第一次使用模型時量測並預熱系統提示前綴
+    """
+    return PromptPrefixCache(
+        pool,
+        session_factory,
+        warmup=os.getenv('OLLAMA_PREFIX_WARMUP', 'true').lower() == 'true',
+    )
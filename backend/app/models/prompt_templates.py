@@ -0,0 +1,123 @@
+"""
+Prompt 範本模組
+各後端的系統提示集中在這裡，每個模型固定使用一個範本，系統提示逐位元組相同：
+- Ollama 以 system 欄位送出系統提示，由模型的 chat 範本放在最前面；
+  每個請求的開頭 token 都相同，Ollama 執行器保留在 KV 快取中的前綴不需重新處理 (prompt eval)
+- /api/generate 請求體中固定的部分（模型、系統提示、keep_alive）預先編碼成 JSON 位元組，
+  請求時只編碼問題與截圖
+"""
+import base64
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+
+# 視覺模型：依截圖與參考資料回答
+CAMPUS_SYSTEM_PROMPT = """你是一個校務系統智能助手。你的職責是幫助成功大學的師生解決校務系統相關的問題。
+
+你的回應應該：
+1. 簡潔明了，直接回答問題
+2. 基於提供的截圖和文本內容
+3. 包含具體的步驟指引（如果適用）
+4. 用繁體中文回應
+5. 如果無法從截圖中獲取足夠信息，請說明
+
+校務系統常見功能：
+- 選課系統
+- 成績查詢
+- 課程表查詢
+- 教室預約
+- 繳費系統
+- 學位查詢"""
+
+# 文本模型：不會收到截圖，只依參考資料回答
+CAMPUS_TEXT_SYSTEM_PROMPT = """你是一個校務系統智能助手。你的職責是幫助成功大學的師生解決校務系統相關的問題。
+
+你的回應應該：
+1. 簡潔明了，直接回答問題
+2. 基於提供的參考資料
+3. 包含具體的步驟指引（如果適用）
+4. 用繁體中文回應
+5. 如果參考資料中沒有足夠信息，請說明
+
+校務系統常見功能：
+- 選課系統
+- 成績查詢
+- 課程表查詢
+- 教室預約
+- 繳費系統
+- 學位查詢"""
+
+# 雲端模型（GPT-4V / Claude）
+CLOUD_SYSTEM_PROMPT = """你是一個校務系統智能助手。幫助成功大學的師生解決校務系統相關問題。
+回應應簡潔、實用，包含具體步驟（如需要）。使用繁體中文回應。"""
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """系統提示與使用者訊息的格式；user 中的 {question} 代入問題（含檢索到的參考資料）"""
+    name: str
+    system: str
+    user: str = '{question}'
+
+    def render(self, question):
+        return self.user.format(question=question)
+
+
+PROMPT_TEMPLATES = {template.name: template for template in (
+    PromptTemplate('campus_vision', CAMPUS_SYSTEM_PROMPT, '用戶問題: {question}'),
+    PromptTemplate('campus_text', CAMPUS_TEXT_SYSTEM_PROMPT, '用戶問題: {question}'),
+    PromptTemplate('qwen_cloud', CAMPUS_SYSTEM_PROMPT, '系統截圖的問題：{question}'),
+    PromptTemplate('cloud_vision', CLOUD_SYSTEM_PROMPT, '根據這個校務系統截圖，請回答：{question}'),
+)}
+
+
+def default_template_name(backend, vision):
+    """模型登錄表未指定 prompt 時依後端與是否為視覺模型選擇範本"""
+    if backend == 'ollama':
+        return 'campus_vision' if vision else 'campus_text'
+    if backend == 'qwen':
+        return 'qwen_cloud'
+    return 'cloud_vision'
+
+
+def get_prompt_template(name):
+    """
+    Raises:
+        KeyError: 沒有此名稱的範本
+    """
+    return PROMPT_TEMPLATES[name]
+
+
+@lru_cache(maxsize=256)
+def _compiled_head(template_name, model, stream, keep_alive):
+    """請求體中 prompt 之前的固定部分：'{"model": ..., "system": ..., "prompt": '"""
+    payload = {'model': model, 'stream': stream}
+    if keep_alive is not None:
+        payload['keep_alive'] = keep_alive
+    payload['system'] = PROMPT_TEMPLATES[template_name].system
+    encoded = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return encoded[:-1] + b', "prompt": '
+
+
+def ollama_body(template, model, question, stream=False, keep_alive=None, image_data=None, options=None):
+    """
+    構建 Ollama /api/generate 的 JSON 請求位元組
+
+    固定部分預先編碼並快取；視覺模型的圖片在送出前才 base64 編碼一次，直接接到 JSON 位元組後面，
+    base64 字元不需跳脫，省去 decode 成 str 再經 json.dumps 與 encode 的多份圖片複本
+
+    Args:
+        template: PromptTemplate
+        image_data: 截圖位元組，文本模型為 None
+        options: Ollama 的 options（例如 num_predict）
+    """
+    parts = [
+        _compiled_head(template.name, model, stream, keep_alive),
+        json.dumps(template.render(question), ensure_ascii=False).encode('utf-8'),
+    ]
+    if options:
+        parts.append(b', "options": ' + json.dumps(options).encode('utf-8'))
+    if image_data is not None:
+        parts.extend((b', "images": ["', base64.b64encode(image_data), b'"]'))
+    parts.append(b'}')
+    return b''.join(parts)
@@ -0,0 +1,417 @@
+"""
+Ollama 模型常駐管理模組
+閒置後的第一個請求要從磁碟載入模型（llava 常超過 10 秒），因此：
+- 啟動時以空 prompt 預先載入設定的模型 (OLLAMA_WARM_MODELS)
+- 依最近的請求組成與可用記憶體選出常用模型，以 keep_alive 固定在記憶體中；
+  不再常用的模型改回一般的 keep_alive，由 Ollama 在閒置後卸載
+- 記錄每次回應的 load_duration，冷啟動可在日誌與 /metrics 中看到
+
+多個 worker：Ollama 以最後收到的 keep_alive 為準，各 worker 各自決定常駐模型會讓固定狀態來回切換。
+設定共用目錄時，各 worker 定期寫入自己的請求組成，只有取得 leader.lock 的 worker 負責預先載入與重新選擇，
+結果寫入 pinned.json，所有 worker 依同一份常駐模型決定 keep_alive；leader 結束時由其他 worker 接手
+"""
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from urllib.parse import urlparse
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# load_duration 超過此秒數視為冷啟動（模型從磁碟載入）
+COLD_START_SECONDS = 0.5
+
+_LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+# 重新讀取共用 pinned.json 的最短間隔（秒）
+_PINNED_REFRESH_SECONDS = 1.0
+
+
+def _lookup(mapping, model):
+    """以模型名稱查表；未指定標籤時視為 latest"""
+    if model in mapping:
+        return mapping[model]
+    if ':' not in model:
+        return mapping.get(f'{model}:latest')
+    return None
+
+
+def parse_keep_alive(value):
+    """keep_alive 為純數字時以數字 (秒) 送出，Ollama 不接受沒有單位的字串；'5m' 等時間字串原樣送出"""
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def available_memory():
+    """
+    本機可用記憶體（位元組），讀取 /proc/meminfo 的 MemAvailable
+
+    Returns:
+        位元組數；無法取得時返回 None
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class ResidencyManager:
+    """決定哪些 Ollama 模型常駐記憶體，並負責預先載入"""
+
+    def __init__(self, pool, session_factory, warm_models=(), keep_alive=None, pinned_keep_alive=-1,
+                 ram_budget=None, max_pinned=2, window=3600.0, interval=60.0, directory=None):
+        """
+        Args:
+            pool: OllamaNodePool
+            session_factory: 返回 requests.Session 的函式
+            warm_models: 啟動時預先載入的模型
+            keep_alive: 一般模型的 keep_alive（None 表示使用 Ollama 預設的 5 分鐘）
+            pinned_keep_alive: 常駐模型的 keep_alive（-1 表示不卸載）
+            ram_budget: 常駐模型的記憶體預算（位元組）；None 表示 Ollama 在本機時依可用記憶體估算
+            max_pinned: 最多常駐的模型數
+            window: 統計請求組成的時間範圍（秒）
+            interval: 重新選擇常駐模型的間隔秒數，0 表示只在啟動時預先載入
+            directory: worker 之間共用常駐決策的目錄；None 表示每個程序各自決定
+        """
+        self.pool = pool
+        self.session_factory = session_factory
+        self.warm_models = list(warm_models)
+        self.keep_alive = keep_alive
+        self.pinned_keep_alive = pinned_keep_alive
+        self.ram_budget = ram_budget
+        self.max_pinned = max_pinned
+        self.window = window
+        self.interval = interval
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # 所有 worker 的初始常駐模型相同（同一份設定），共用決策寫入前送出的 keep_alive 也一致
+        self._pinned = set(self.warm_models[:max_pinned])
+        self._pinned_mtime = None
+        self._pinned_checked = 0.0
+        self.leader = directory is None
+        self._leader_fd = None
+        self._requests = deque()  # (時間, 模型)
+        self._loads = {}  # 模型 -> {'last_load_ms', 'cold_starts', 'preloads'}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def pinned(self):
+        """目前的常駐模型；共用目錄中有較新的決策時先重新讀取"""
+        if self.directory is not None and not self.leader:
+            now = time.monotonic()
+            if now - self._pinned_checked >= _PINNED_REFRESH_SECONDS:
+                self._pinned_checked = now
+                self._load_pinned()
+        return self._pinned
+
+    @pinned.setter
+    def pinned(self, models):
+        self._pinned = set(models)
+        if self.directory is not None:
+            self._write_json('pinned.json', {'pinned': sorted(self._pinned), 'pid': os.getpid(), 'time': time.time()})
+
+    def _load_pinned(self):
+        path = os.path.join(self.directory, 'pinned.json')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self._pinned_mtime:
+                return
+            with open(path, 'r', encoding='utf-8') as f:
+                self._pinned = set(json.load(f)['pinned'])
+            self._pinned_mtime = mtime
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _write_json(self, name, data):
+        """先寫暫存檔再改名，其他 worker 不會讀到半份檔案"""
+        path = os.path.join(self.directory, name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'⚠️ 無法寫入常駐模型狀態 {name}: {str(e)}')
+
+    def _try_lead(self):
+        """
+        嘗試成為負責預先載入與重新選擇的 worker；鎖檔保持開啟直到程序結束，
+        程序結束時作業系統釋放鎖，其他 worker 下一輪即可接手
+        """
+        if self.leader:
+            return True
+        fd = os.open(os.path.join(self.directory, 'leader.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._leader_fd = fd
+        self.leader = True
+        logger.info(f'🧭 由此 worker ({os.getpid()}) 負責模型常駐管理')
+        return True
+
+    def _publish_mix(self):
+        """寫入本程序最近的請求組成，供 leader 彙總"""
+        self._write_json(f'mix-{os.getpid()}.json', {'time': time.time(), 'mix': dict(self.request_mix())})
+
+    def shared_mix(self):
+        """所有 worker 最近 window 秒內寫入的請求組成加總；沒有共用目錄時為本程序的請求組成"""
+        if self.directory is None:
+            return self.request_mix()
+        self._publish_mix()
+        mix = Counter()
+        cutoff = time.time() - self.window
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith('mix-') and filename.endswith('.json')):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    mix.update(json.load(f)['mix'])
+            except (OSError, ValueError, KeyError):
+                continue
+        return mix
+
+    def keep_alive_for(self, model):
+        """
+        推論請求要帶的 keep_alive
+
+        Returns:
+            常駐模型返回 pinned_keep_alive，其他返回 keep_alive（可能為 None，表示不指定）
+        """
+        return self.pinned_keep_alive if model in self.pinned else self.keep_alive
+
+    def record(self, model, node, data, source='request'):
+        """
+        記錄一次 Ollama 回應：計入請求組成，並從 load_duration 判斷是否冷啟動
+
+        Args:
+            data: Ollama 回應中 done=true 的事件（含 load_duration，單位奈秒）
+            source: request / preload
+        """
+        now = time.time()
+        load_seconds = data.get('load_duration', 0) / 1e9
+        with self._lock:
+            if source == 'request':
+                self._requests.append((now, model))
+            stats = self._loads.setdefault(model, {'last_load_ms': None, 'cold_starts': 0, 'preloads': 0})
+            if source == 'preload':
+                stats['preloads'] += 1
+            if load_seconds > COLD_START_SECONDS:
+                stats['last_load_ms'] = round(load_seconds * 1000, 2)
+                stats['cold_starts'] += 1
+        if load_seconds > COLD_START_SECONDS:
+            metrics.OLLAMA_COLD_STARTS.inc(model=model, source=source)
+            if source == 'request':
+                logger.warning(f'🐢 Ollama 冷啟動: {model} ({node}) 載入 {load_seconds:.1f} 秒')
+
+    def request_mix(self):
+        """最近 window 秒內各模型的請求數"""
+        cutoff = time.time() - self.window
+        with self._lock:
+            while self._requests and self._requests[0][0] < cutoff:
+                self._requests.popleft()
+            return Counter(model for _, model in self._requests)
+
+    def _model_size(self, model):
+        """模型佔用的記憶體：已載入時用 /api/ps 的 size_vram，否則用 /api/tags 的模型大小"""
+        for node in self.pool.nodes:
+            resident = _lookup(node.resident, model)
+            if resident and resident.get('size_vram'):
+                return resident['size_vram']
+        for node in self.pool.nodes:
+            details = _lookup(node.model_details, model)
+            if details and details.get('size'):
+                return details['size']
+        return None
+
+    def budget(self):
+        """
+        常駐模型可用的記憶體預算（位元組）
+
+        未設定 OLLAMA_RAM_BUDGET_GB 且所有節點都在本機時，以本機可用記憶體加上已載入模型佔用的記憶體估算
+        """
+        if self.ram_budget is not None:
+            return self.ram_budget
+        if not all(urlparse(node.url).hostname in _LOCAL_HOSTS for node in self.pool.nodes):
+            return None
+        free = available_memory()
+        if free is None:
+            return None
+        loaded = sum(r.get('size_vram') or 0 for node in self.pool.nodes for r in node.resident.values())
+        return free + loaded
+
+    def choose(self):
+        """
+        依請求組成選出常駐模型：請求數多的優先，總大小不超過記憶體預算
+
+        尚無請求時沿用啟動預先載入的模型
+        """
+        mix = self.shared_mix()
+        ranked = [model for model, _ in mix.most_common()]
+        for model in self.warm_models:
+            if model not in ranked:
+                ranked.append(model)
+        budget = self.budget()
+        chosen, used = [], 0
+        for model in ranked:
+            if len(chosen) >= self.max_pinned:
+                break
+            size = self._model_size(model) or 0
+            if budget is not None and chosen and used + size > budget:
+                continue
+            chosen.append(model)
+            used += size
+        return set(chosen)
+
+    def preload(self, model, keep_alive, resident_only=False):
+        """
+        在所有已安裝此模型的健康節點上以空 prompt 載入模型（或更新 keep_alive）
+
+        Args:
+            resident_only: 只更新已載入此模型的節點（不觸發載入）
+
+        Returns:
+            成功的節點數
+        """
+        session = self.session_factory()
+        loaded = 0
+        for node in self.pool.nodes:
+            if not node.healthy or not node.has_model(model):
+                continue
+            if resident_only and not node.is_resident(model):
+                continue
+            payload = {'model': model, 'prompt': '', 'stream': False}
+            if keep_alive is not None:
+                payload['keep_alive'] = keep_alive
+            try:
+                response = session.post(f'{node.url}/api/generate', json=payload, timeout=300)
+                if response.status_code != 200:
+                    raise RuntimeError(f'HTTP {response.status_code}')
+                self.record(model, node.url, response.json(), source='preload')
+                loaded += 1
+            except Exception as e:
+                logger.warning(f'⚠️ 預先載入 {model} 失敗 ({node.url}): {str(e)}')
+        return loaded
+
+    def rebalance(self):
+        """重新選出常駐模型：新選上的預先載入並固定，落選的改回一般 keep_alive"""
+        chosen = self.choose()
+        added, removed = chosen - self.pinned, self.pinned - chosen
+        self.pinned = chosen
+        for model in removed:
+            logger.info(f'📤 {model} 不再常駐記憶體')
+            self.preload(model, self.keep_alive if self.keep_alive is not None else '5m', resident_only=True)
+        for model in added:
+            logger.info(f'📌 {model} 常駐記憶體')
+            self.preload(model, self.pinned_keep_alive)
+        return {'pinned': sorted(chosen), 'added': sorted(added), 'removed': sorted(removed)}
+
+    def warm(self):
+        """啟動時預先載入設定的模型"""
+        for model in self.warm_models:
+            started = time.perf_counter()
+            keep_alive = self.pinned_keep_alive if model in self.pinned else self.keep_alive
+            if self.preload(model, keep_alive):
+                logger.info(f'🔥 已預先載入 {model} ({time.perf_counter() - started:.1f} 秒)')
+
+    def start(self):
+        """
+        背景預先載入並定期重新選擇常駐模型（每個程序一次）
+
+        有共用目錄時只有 leader 預先載入與重新選擇，其他 worker 只寫入請求組成並在 leader 結束時接手
+        """
+        if self._thread and self._thread.is_alive():
+            return
+
+        def loop():
+            try:
+                if self._try_lead():
+                    # 啟動時以設定的模型為準，覆寫上一次執行留下的決策
+                    self.pinned = self._pinned
+                    self.warm()
+            except Exception as e:
+                logger.warning(f'預先載入模型失敗: {str(e)}')
+            while self.interval > 0:
+                time.sleep(self.interval)
+                try:
+                    if self.leader:
+                        self.rebalance()
+                    elif self._try_lead():
+                        # 接手結束的 leader：沿用它最後的決策，再依彙總的請求組成重新選擇
+                        self._load_pinned()
+                        self.rebalance()
+                    else:
+                        self._publish_mix()
+                except Exception as e:
+                    logger.warning(f'重新選擇常駐模型失敗: {str(e)}')
+
+        self._thread = threading.Thread(target=loop, name='ollama-residency', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        budget = self.budget()
+        with self._lock:
+            loads = {model: dict(stats) for model, stats in self._loads.items()}
+        return {
+            'pinned': sorted(self.pinned),
+            'leader': self.leader,
+            'pid': os.getpid(),
+            'warm_models': self.warm_models,
+            'keep_alive': self.keep_alive,
+            'pinned_keep_alive': self.pinned_keep_alive,
+            'ram_budget_gb': round(budget / 2**30, 2) if budget is not None else None,
+            'request_mix': dict(self.request_mix()),
+            'loads': loads,
+        }
+
+
+def create_residency_manager(pool, session_factory, default_model):
+    """
+    依環境變數建立常駐管理器
+
+    OLLAMA_WARM_MODELS: 啟動時預先載入的模型，逗號分隔（預設 OLLAMA_MODEL，設為空字串停用）
+    OLLAMA_KEEP_ALIVE: 一般模型的 keep_alive（預設不指定，使用 Ollama 的 5 分鐘）
+    OLLAMA_PINNED_KEEP_ALIVE: 常駐模型的 keep_alive（預設 -1，不卸載）
+    OLLAMA_RAM_BUDGET_GB: 常駐模型的記憶體預算（預設依本機可用記憶體估算）
+    OLLAMA_MAX_PINNED: 最多常駐的模型數（預設 2）
+    OLLAMA_RESIDENCY_WINDOW / OLLAMA_RESIDENCY_INTERVAL: 請求組成的統計範圍與重新選擇間隔（秒）
+    OLLAMA_RESIDENCY_DIR: worker 之間共用常駐決策的目錄（預設為暫存目錄下的 campus_ai_residency，
+        設為 off 時每個程序各自決定，只適用於單一程序）
+    """
+    warm_models = [m.strip() for m in os.getenv('OLLAMA_WARM_MODELS', default_model).split(',') if m.strip()]
+    budget = os.getenv('OLLAMA_RAM_BUDGET_GB')
+    directory = os.getenv('OLLAMA_RESIDENCY_DIR') or os.path.join(tempfile.gettempdir(), 'campus_ai_residency')
+    return ResidencyManager(
+        pool,
+        session_factory,
+        warm_models=warm_models,
+        keep_alive=parse_keep_alive(os.getenv('OLLAMA_KEEP_ALIVE') or None),
+        pinned_keep_alive=parse_keep_alive(os.getenv('OLLAMA_PINNED_KEEP_ALIVE', '-1')),
+        ram_budget=float(budget) * 2**30 if budget else None,
+        max_pinned=int(os.getenv('OLLAMA_MAX_PINNED', '2')),
+        window=float(os.getenv('OLLAMA_RESIDENCY_WINDOW', '3600')),
+        interval=float(os.getenv('OLLAMA_RESIDENCY_INTERVAL', '60')),
+        directory=None if directory.lower() == 'off' else directory,
+    )
@@ -0,0 +1,289 @@
+"""
+回應快取模組
+以 (模型, 增強後的 prompt, 截圖摘要) 為鍵快取 AI 回應，支援 TTL 與 LRU 淘汰；
+精確比對未命中時，可再以截圖感知雜湊找出「同一頁面 + 同一問題」的先前回應
+
+後端:
+- memory: 單一程序內的 OrderedDict，依項目數與總位元組數限制大小
+- sqlite: 以 SQLite 檔案讓同一台機器上的 gunicorn worker 共用
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .image_hash import hamming_distances
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryCacheBackend:
+    """程序內 LRU 快取"""
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # 群組 (模型 + prompt) → {快取鍵: 感知雜湊}，供相似截圖查詢
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(value.encode('utf-8'))
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, _ = entry
+            if expires_at <= now:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def find_similar(self, group, phash, max_distance):
+        """在同一群組中找出感知雜湊距離最近且不超過 max_distance 的回應"""
+        with self._lock:
+            members = self._groups.get(group)
+            if not members:
+                return None
+            keys = [k for k, h in members.items() if len(h) == len(phash)]
+            distances = hamming_distances([members[k] for k in keys], phash)
+            if not len(distances) or distances.min() > max_distance:
+                return None
+            key = keys[int(distances.argmin())]
+        return self.get(key)
+
+    def set(self, key, value, ttl, group=None, phash=None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time() + ttl, group)
+            self._bytes += self._size(key, value)
+            if group is not None and phash is not None:
+                self._groups.setdefault(group, {})[key] = phash
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        value, _, group = self._entries.pop(key)
+        self._bytes -= self._size(key, value)
+        members = self._groups.get(group)
+        if members is not None:
+            members.pop(key, None)
+            if not members:
+                del self._groups[group]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """以 SQLite 檔案在多個 worker 之間共用的 LRU 快取"""
+
+    def __init__(self, path=None, max_entries=10000):
+        self.path = path or os.path.join(tempfile.gettempdir(), 'campus_ai_response_cache.sqlite3')
+        self.max_entries = max_entries
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS response_cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL, '
+            'group_key TEXT, phash BLOB)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_access ON response_cache (last_access)')
+        # 舊版快取檔沒有相似比對欄位時補上
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(response_cache)')}
+        for column, column_type in (('group_key', 'TEXT'), ('phash', 'BLOB')):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE response_cache ADD COLUMN {column} {column_type}')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_group ON response_cache (group_key)')
+        conn.commit()
+
+    def _connection(self):
+        """每個執行緒各自一條連線；fork 後的子程序重新連線"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute('SELECT value, expires_at FROM response_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at <= now:
+            conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+            conn.commit()
+            return None
+        conn.execute('UPDATE response_cache SET last_access = ? WHERE key = ?', (now, key))
+        conn.commit()
+        return value
+
+    def find_similar(self, group, phash, max_distance):
+        """在同一群組中找出感知雜湊距離最近且不超過 max_distance 的回應"""
+        rows = self._connection().execute(
+            'SELECT key, phash FROM response_cache WHERE group_key = ? AND phash IS NOT NULL AND expires_at > ?',
+            (group, time.time())
+        ).fetchall()
+        rows = [(k, bytes(h)) for k, h in rows if len(h) == len(phash)]
+        distances = hamming_distances([h for _, h in rows], phash)
+        if not len(distances) or distances.min() > max_distance:
+            return None
+        return self.get(rows[int(distances.argmin())][0])
+
+    def set(self, key, value, ttl, group=None, phash=None):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_access, group_key, phash) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, value, now + ttl, now, group, phash)
+        )
+        conn.execute(
+            'DELETE FROM response_cache WHERE key IN ('
+            'SELECT key FROM response_cache ORDER BY last_access '
+            'LIMIT MAX(0, (SELECT COUNT(*) FROM response_cache) - ?))',
+            (self.max_entries,)
+        )
+        conn.commit()
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+
+
+class ResponseCache:
+    """AI 回應快取，記錄命中與未命中次數"""
+
+    def __init__(self, backend, ttl=3600, phash_distance=-1):
+        """
+        Args:
+            backend: 快取後端
+            ttl: 快取秒數
+            phash_distance: 相似截圖的漢明距離上限，負數表示停用相似比對
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.phash_distance = phash_distance
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def similarity_enabled(self):
+        return self.phash_distance >= 0
+
+    @staticmethod
+    def image_digest(image_data):
+        """截圖內容摘要"""
+        return hashlib.sha256(image_data).hexdigest()
+
+    @staticmethod
+    def make_key(model, prompt, image_digest):
+        """由模型、增強後的 prompt 與截圖摘要組成快取鍵"""
+        payload = '\0'.join((model, prompt, image_digest))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def make_group(model, prompt):
+        """相似截圖比對的群組：同一模型與同一 prompt"""
+        return hashlib.sha256('\0'.join((model, prompt)).encode('utf-8')).hexdigest()
+
+    def get(self, key, group=None, phash=None):
+        """
+        查詢快取：先比對精確鍵，未命中時在同一群組內找感知雜湊相近的截圖
+
+        Args:
+            key: 精確快取鍵
+            group: make_group 產生的群組
+            phash: 截圖的感知雜湊
+        """
+        similar = False
+        try:
+            value = self.backend.get(key)
+            if value is None and self.similarity_enabled and group is not None and phash is not None:
+                value = self.backend.find_similar(group, phash, self.phash_distance)
+                similar = value is not None
+        except Exception as e:
+            logger.warning(f'讀取回應快取失敗: {str(e)}')
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if similar:
+                    self.similar_hits += 1
+        return value
+
+    def set(self, key, value, group=None, phash=None):
+        try:
+            self.backend.set(key, value, self.ttl, group=group, phash=phash)
+        except Exception as e:
+            logger.warning(f'寫入回應快取失敗: {str(e)}')
+
+    def stats(self):
+        """快取統計（命中 / 未命中次數為本程序的計數）"""
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend),
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'similar_hits': self.similar_hits,
+            'misses': self.misses,
+            'phash_distance': self.phash_distance,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'pid': os.getpid(),
+        }
+
+
+def create_response_cache():
+    """
+    依環境變數建立回應快取
+
+    RESPONSE_CACHE: memory (預設) / sqlite / off
+    RESPONSE_CACHE_TTL: 快取秒數
+    RESPONSE_CACHE_MAX_ENTRIES: 最多項目數
+    RESPONSE_CACHE_MAX_BYTES: memory 後端的總位元組上限
+    RESPONSE_CACHE_PATH: sqlite 後端的檔案路徑
+    RESPONSE_CACHE_PHASH_DISTANCE: 相似截圖的漢明距離上限（256 位元 dHash），負數停用（預設）
+
+    Returns:
+        ResponseCache，停用時返回 None
+    """
+    backend_name = os.getenv('RESPONSE_CACHE', 'memory').lower()
+    ttl = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+    max_entries = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1024'))
+
+    if backend_name == 'off':
+        return None
+    if backend_name == 'sqlite':
+        backend = SQLiteCacheBackend(os.getenv('RESPONSE_CACHE_PATH'), max_entries=max_entries)
+    else:
+        backend = MemoryCacheBackend(
+            max_entries=max_entries,
+            max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+        )
+    phash_distance = int(os.getenv('RESPONSE_CACHE_PHASH_DISTANCE', '-1'))
+    logger.info(f'✅ 回應快取已啟用: {backend_name} (TTL {ttl}s, 上限 {max_entries} 筆)')
+    if phash_distance >= 0:
+        # 版面相同、內容不同的頁面（成績、作業狀態）dHash 幾乎相同，群組也不區分頁面網址或使用者
+        logger.warning(f'⚠️ 已啟用相似截圖比對 (距離 {phash_distance})：不同頁面或其他使用者畫面的回應'
+                       f'可能被重用，只適合沒有個人資料的公開頁面')
+    return ResponseCache(backend, ttl=ttl, phash_distance=phash_distance)
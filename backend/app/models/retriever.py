@@ -4,96 +4,355 @@
 """
 import json
 import os
+import threading
+import time
+from collections import namedtuple
 from pathlib import Path
 
+from . import metrics
+from .context_packer import create_context_packer
+from .kb_binary import MappedKnowledgeBase, default_binary_path
+from .model_registry import get_model_registry
+from .scorers import SCORERS, KeywordScorer, chunk_hash
+
+# 知識庫快照：片段、計分索引與每個片段的雜湊值
+# 重新載入時建立新的快照再整個替換，查詢中的請求不會看到建到一半的索引
+KnowledgeSnapshot = namedtuple('KnowledgeSnapshot', ['chunks', 'scorer', 'hashes', 'vectors'])
+
+# BM25 分數換算信心度 s / (s + BM25_CONFIDENCE_HALF)：分數等於此值時信心度為 0.5
+BM25_CONFIDENCE_HALF = 5.0
+
+
+class RetrievedContext(namedtuple('RetrievedContext', ['question', 'prompt', 'chunks', 'query_embedding'])):
+    """
+    一次檢索的結果：原始問題、組好的 prompt、排序後的片段 [{'chunk', 'score', 'confidence'}, ...]，
+    以及檢索時算出的問題向量 (embedding 模型名稱, 向量)，關鍵字檢索時為 None
+    """
+    __slots__ = ()
+    
+    @property
+    def chunk_ids(self):
+        return tuple(c['chunk'].get('id') for c in self.chunks)
+    
+    @property
+    def confidence(self):
+        """最相關片段的信心度 (0~1)，沒有相關片段時為 0"""
+        return self.chunks[0]['confidence'] if self.chunks else 0.0
+    
+    @property
+    def margin(self):
+        """最相關片段與第二個片段的信心度差距；只有一個片段時等於其信心度"""
+        if len(self.chunks) < 2:
+            return self.confidence
+        return self.chunks[0]['confidence'] - self.chunks[1]['confidence']
+
+
 class LightweightRetriever:
-    def __init__(self, knowledge_base_path=None):
-        """初始化檢索器"""
+    def __init__(self, knowledge_base_path=None, scorer=None):
+        """
+        初始化檢索器
+        
+        Args:
+            knowledge_base_path: 知識庫 JSON 路徑
+            scorer: 計分後端名稱 (keywords/bm25)，預設讀取環境變數 RETRIEVER_SCORER
+        """
         if knowledge_base_path is None:
             # 預設路徑：app/knowledge/knowledge_base.json
             current_dir = Path(__file__).parent.parent  # 從 models/ 回到 app/
             knowledge_base_path = current_dir / "knowledge" / "knowledge_base.json"
         
         self.knowledge_base_path = knowledge_base_path
-        self.chunks = []
+        # 已編譯的二進位知識庫（見 compile_knowledge.py），KNOWLEDGE_BINARY=off 可停用
+        self.binary_path = os.getenv('KNOWLEDGE_BINARY_PATH') or default_binary_path(knowledge_base_path)
+        self.use_binary = os.getenv('KNOWLEDGE_BINARY', 'auto').lower() != 'off'
+        self.load_stats = {}
+        self.scorer_name = (scorer or os.getenv('RETRIEVER_SCORER', 'keywords')).lower()
+        if self.scorer_name not in SCORERS:
+            print(f"[Retriever] 警告: 未知的計分後端 '{self.scorer_name}'，改用 keywords")
+            self.scorer_name = KeywordScorer.name
+        self._snapshot = KnowledgeSnapshot([], None, [], None)
+        self._reload_lock = threading.Lock()
+        self._mtime = None
+        self._watcher = None
+        self.last_reload = None
+        # 每次檢索的片段數與各模型的參考資料 token 預算（見 context_packer）
+        self.max_chunks = int(os.getenv('CONTEXT_MAX_CHUNKS', '2'))
+        self.packer = create_context_packer(get_model_registry())
         self.load_knowledge_base()
     
-    def load_knowledge_base(self):
-        """載入知識庫"""
+    @property
+    def chunks(self):
+        return self._snapshot.chunks
+    
+    @property
+    def scorer(self):
+        return self._snapshot.scorer
+    
+    def _file_mtime(self):
+        """知識庫 JSON 與二進位檔的修改時間，任一變動都會觸發重新載入"""
+        mtimes = []
+        for path in (self.knowledge_base_path, self.binary_path):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+    
+    def _read_binary(self):
+        """若有與 JSON 內容一致的二進位知識庫，以 mmap 載入"""
+        if not self.use_binary or not os.path.exists(self.binary_path):
+            return None
         try:
+            mapped = MappedKnowledgeBase(self.binary_path)
+        except Exception as e:
+            print(f"[Retriever] 警告: 無法載入二進位知識庫，改用 JSON - {e}")
+            return None
+        if not mapped.is_fresh(self.knowledge_base_path):
+            print(f"[Retriever] 警告: 二進位知識庫已過期，改用 JSON（請重新執行 compile_knowledge.py）")
+            return None
+        return mapped
+    
+    def _read_chunks(self):
+        """讀取知識庫檔案中的片段"""
+        started = time.perf_counter()
+        chunks = self._read_binary()
+        source = 'binary'
+        if chunks is None:
             with open(self.knowledge_base_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                self.chunks = data.get('chunks', [])
-            print(f"[Retriever] 已載入 {len(self.chunks)} 個知識片段")
+            chunks = data.get('chunks', [])
+            source = 'json'
+        self.load_stats = {
+            'format': source,
+            'read_ms': round((time.perf_counter() - started) * 1000, 2),
+        }
+        return chunks
+    
+    def load_knowledge_base(self):
+        """載入知識庫"""
+        self._mtime = self._file_mtime()
+        try:
+            chunks = self._read_chunks()
+            print(f"[Retriever] 已載入 {len(chunks)} 個知識片段 ({self.load_stats['format']})")
         except FileNotFoundError:
             print(f"[Retriever] 警告: 找不到知識庫檔案 {self.knowledge_base_path}")
-            self.chunks = []
+            chunks = []
         except Exception as e:
             print(f"[Retriever] 錯誤: 載入知識庫失敗 - {e}")
-            self.chunks = []
+            chunks = []
+        
+        # 載入時建立計分索引，查詢時只需處理問題本身
+        started = time.perf_counter()
+        self._snapshot = self._build_snapshot(chunks, previous=None)
+        self.load_stats['index_ms'] = round((time.perf_counter() - started) * 1000, 2)
     
-    def retrieve(self, question, max_chunks=2):
+    def _build_snapshot(self, chunks, previous):
         """
-        根據問題檢索相關片段
+        建立新的知識庫快照
+        
+        Args:
+            chunks: 片段列表
+            previous: 目前使用中的快照，可用來沿用未變動片段的索引資料
+        """
+        return KnowledgeSnapshot(
+            chunks=chunks,
+            scorer=self._build_scorer(chunks, previous.scorer if previous else None),
+            hashes=chunks.chunk_hashes() if hasattr(chunks, 'chunk_hashes') else [chunk_hash(c) for c in chunks],
+            vectors=None
+        )
+    
+    def _build_scorer(self, chunks, previous=None):
+        """依設定建立計分後端"""
+        scorer_cls = SCORERS[self.scorer_name]
+        if not isinstance(previous, scorer_cls):
+            previous = None
+        if scorer_cls.name == 'bm25':
+            return scorer_cls(chunks, min_score=float(os.getenv('RETRIEVER_MIN_SCORE', '1.0')),
+                              previous=previous)
+        return scorer_cls(chunks, previous=previous)
+    
+    def reload(self, force=False):
+        """
+        重新讀取知識庫並增量更新索引
+        
+        只重新計算新增或修改過的片段，完成後一次替換整個快照。
+        
+        Args:
+            force: 即使檔案修改時間沒變也重新讀取
+        
+        Returns:
+            變更摘要：新增 / 刪除 / 修改的片段 id 與重建耗時
+        """
+        with self._reload_lock:
+            started = time.perf_counter()
+            mtime = self._file_mtime()
+            if not force and mtime == self._mtime:
+                return {'reloaded': False, 'reason': 'unchanged', 'chunks': len(self.chunks)}
+            
+            try:
+                chunks = self._read_chunks()
+            except Exception as e:
+                # 檔案可能正在寫入中，保留目前的索引
+                print(f"[Retriever] 錯誤: 重新載入知識庫失敗，沿用現有索引 - {e}")
+                return {'reloaded': False, 'reason': 'error', 'error': str(e), 'chunks': len(self.chunks)}
+            
+            previous = self._snapshot
+            old = {c.get('id'): h for c, h in zip(previous.chunks, previous.hashes)}
+            snapshot = self._build_snapshot(chunks, previous=previous)
+            new = {c.get('id'): h for c, h in zip(snapshot.chunks, snapshot.hashes)}
+            
+            self._snapshot = snapshot
+            self._mtime = mtime
+            
+            report = {
+                'reloaded': True,
+                'added': [i for i in new if i not in old],
+                'removed': [i for i in old if i not in new],
+                'modified': [i for i in new if i in old and old[i] != new[i]],
+                'chunks': len(chunks),
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+            }
+            self.last_reload = report
+            print(f"[Retriever] 知識庫已重新載入: 新增 {len(report['added'])}、刪除 {len(report['removed'])}、"
+                  f"修改 {len(report['modified'])}，耗時 {report['duration_ms']} ms")
+            return report
+    
+    def start_watcher(self, interval):
+        """
+        啟動背景執行緒，定期檢查知識庫檔案修改時間並自動重新載入
+        
+        Args:
+            interval: 檢查間隔（秒）
+        """
+        if self._watcher is not None or interval <= 0:
+            return
+        
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    print(f"[Retriever] 錯誤: 自動重新載入失敗 - {e}")
+        
+        self._watcher = threading.Thread(target=watch, name='knowledge-watcher', daemon=True)
+        self._watcher.start()
+    
+    def rank(self, question, max_chunks=2):
+        """
+        計算問題與片段的相關分數並排序
         
         Args:
             question: 用戶問題
-            max_chunks: 最多返回幾個片段（預設2個，避免 token 過多）
+            max_chunks: 最多返回幾個片段
         
         Returns:
-            相關文檔片段的列表
+            [{'chunk': 片段, 'score': 分數, 'confidence': 信心度}, ...]，分數高的在前
         """
-        if not self.chunks:
+        snapshot = self._snapshot
+        if not snapshot.chunks:
             return []
         
-        # 將問題轉為小寫以便匹配
-        question_lower = question.lower()
+        # 以計分後端計算每個片段的相關分數（同分時依知識庫順序）
+        scores = snapshot.scorer.score(question)
+        scored_chunks = [
+            {'chunk': snapshot.chunks[chunk_index], 'score': score, 'confidence': self.score_confidence(score)}
+            for chunk_index, score in sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        ]
         
-        # 計算每個片段的相關分數
-        scored_chunks = []
-        for chunk in self.chunks:
-            score = 0
-            keywords = chunk.get('keywords', [])
-            
-            # 計算有多少關鍵字出現在問題中
-            for keyword in keywords:
-                if keyword.lower() in question_lower:
-                    score += 1
-            
-            if score > 0:
-                scored_chunks.append({
-                    'chunk': chunk,
-                    'score': score
-                })
+        # 返回前 max_chunks 個片段
+        return scored_chunks[:max_chunks]
+    
+    def score_confidence(self, score):
+        """
+        將計分後端的分數換算為 0~1 的信心度，讓不同計分後端可用同一個門檻
         
-        # 按分數排序（分數高的在前）
-        scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+        - keywords: 命中 n 個關鍵字 → 1 - 0.5^n（1 個 0.5、2 個 0.75、3 個 0.875）
+        - bm25: s / (s + BM25_CONFIDENCE_HALF)
+        """
+        if self.scorer_name == 'bm25':
+            return score / (score + BM25_CONFIDENCE_HALF)
+        return 1 - 0.5 ** score
+    
+    def retrieve(self, question, max_chunks=2):
+        """
+        根據問題檢索相關片段
         
-        # 返回前 max_chunks 個片段
-        top_chunks = scored_chunks[:max_chunks]
+        Args:
+            question: 用戶問題
+            max_chunks: 最多返回幾個片段（預設2個，避免 token 過多）
         
-        # 記錄檢索結果
+        Returns:
+            相關文檔片段的列表
+        """
+        top_chunks = self.rank(question, max_chunks)
+        self._log_retrieval(question, top_chunks)
+        return [c['chunk']['content'] for c in top_chunks]
+    
+    @staticmethod
+    def _log_retrieval(question, top_chunks):
+        """記錄檢索結果"""
         if top_chunks:
             chunk_ids = [c['chunk']['id'] for c in top_chunks]
             print(f"[Retriever] 問題: '{question[:30]}...' 匹配到: {chunk_ids}")
         else:
             print(f"[Retriever] 問題: '{question[:30]}...' 沒有匹配到相關知識")
+    
+    def _rank_with_embedding(self, question, max_chunks):
+        """
+        排序片段，並返回排序時算出的問題向量
         
-        return [c['chunk']['content'] for c in top_chunks]
+        Returns:
+            (排序結果, (embedding 模型名稱, 向量) 或 None)
+        """
+        return self.rank(question, max_chunks), None
     
-    def get_context_prompt(self, question):
+    def get_context(self, question, model=None):
+        """
+        檢索相關片段並組合 prompt
+        
+        Args:
+            question: 用戶問題
+            model: 使用者指定的模型，決定參考資料的 token 預算
+        
+        Returns:
+            RetrievedContext
+        """
+        with metrics.STAGE_SECONDS.time(stage='retrieve'):
+            top_chunks, query_embedding = self._rank_with_embedding(question, self.max_chunks)
+            self._log_retrieval(question, top_chunks)
+        
+        with metrics.STAGE_SECONDS.time(stage='prompt_build'):
+            packed = self.packer.pack(question, top_chunks, model)
+            prompt = self._build_prompt(question, packed.texts)
+        self._record_packing(model, packed)
+        return RetrievedContext(question, prompt, top_chunks, query_embedding)
+    
+    def _record_packing(self, model, packed):
+        """記錄放入 prompt 的參考資料 token 數（未登錄的模型名稱記為 default，避免任意輸入成為指標標籤）"""
+        spec = self.packer.registry.get(model)
+        label = spec.name if spec is not None else 'default'
+        metrics.CONTEXT_TOKENS.observe(packed.tokens, model=label)
+        if packed.trimmed_tokens:
+            metrics.CONTEXT_TRIMMED_TOKENS.inc(packed.trimmed_tokens, model=label)
+            print(f"[Retriever] 參考資料超過 {label} 的預算 {packed.budget} tokens，"
+                  f"放入 {packed.tokens} tokens，略過 {packed.trimmed_tokens} tokens")
+    
+    def get_context_prompt(self, question, model=None):
         """
         生成帶有參考資料的完整 prompt
         
         Args:
             question: 用戶問題
+            model: 使用者指定的模型，決定參考資料的 token 預算
         
         Returns:
             完整的 prompt 字串
         """
-        # 檢索相關片段
-        relevant_chunks = self.retrieve(question, max_chunks=2)
-        
+        return self.get_context(question, model).prompt
+    
+    def _build_prompt(self, question, relevant_chunks):
+        """以檢索到的片段組合 prompt"""
         if not relevant_chunks:
             # 沒有相關資料，返回基礎 prompt
             base_prompt = f"""請根據截圖回答以下問題：
@@ -130,8 +389,20 @@ class LightweightRetriever:
 _retriever_instance = None
 
 def get_retriever():
-    """獲取全域檢索器實例"""
+    """
+    獲取全域檢索器實例
+    
+    環境變數 RETRIEVER_BACKEND 決定檢索器類型：
+    - lightweight (預設): 關鍵字 / BM25 計分
+    - dense: 本地 embedding 向量檢索
+    """
     global _retriever_instance
     if _retriever_instance is None:
-        _retriever_instance = LightweightRetriever()
+        if os.getenv('RETRIEVER_BACKEND', 'lightweight').lower() == 'dense':
+            from .dense_retriever import DenseRetriever
+            _retriever_instance = DenseRetriever()
+        else:
+            _retriever_instance = LightweightRetriever()
+        # 每個 worker 各自輪詢檔案修改時間，內容更新後不需重啟
+        _retriever_instance.start_watcher(float(os.getenv('KNOWLEDGE_RELOAD_INTERVAL', '10')))
     return _retriever_instance
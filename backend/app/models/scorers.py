@@ -0,0 +1,213 @@
+"""
+知識片段計分模組
+提供可替換的計分後端：
+- keywords: 關鍵字命中數（Aho-Corasick 索引）
+- bm25: 以字元 n-gram 對片段內容與關鍵字做 BM25 排序
+"""
+import hashlib
+import json
+import re
+import zlib
+
+import numpy as np
+
+from .keyword_index import KeywordIndex
+
+# 中日韓統一表意文字（含擴充 A 區與相容字）與英數字詞
+_CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def term_hash(term):
+    """詞元的固定雜湊值（不受 PYTHONHASHSEED 影響），用於二進位知識庫中的詞彙表查詢"""
+    return zlib.crc32(term.encode('utf-8'))
+
+
+def chunk_hash(chunk):
+    """計算片段（內容、關鍵字等所有欄位）的雜湊值，用來判斷片段是否變動"""
+    payload = json.dumps(chunk, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def tokenize(text, ngram_range=(2, 3)):
+    """
+    將文字切成詞元：中文連續字串取字元 n-gram，英數字取整個單字
+
+    Args:
+        text: 原始文字
+        ngram_range: 中文字元 n-gram 的長度範圍 (最小, 最大)
+
+    Returns:
+        詞元列表
+    """
+    text = text.lower()
+    min_n, max_n = ngram_range
+    tokens = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        if len(run) < min_n:
+            # 過短的字串整段保留，避免單字問題完全無法匹配
+            tokens.append(run)
+            continue
+        for n in range(min_n, max_n + 1):
+            for start in range(len(run) - n + 1):
+                tokens.append(run[start:start + n])
+    return tokens
+
+
+class KeywordScorer:
+    """關鍵字命中數計分"""
+
+    name = 'keywords'
+
+    def __init__(self, chunks, previous=None):
+        # 自動機建置成本與關鍵字總長度成正比，直接整個重建
+        if hasattr(chunks, 'keyword_index'):
+            # 已編譯的二進位知識庫：直接在 mmap 的自動機陣列上比對
+            self.index = chunks.keyword_index()
+        else:
+            self.index = KeywordIndex(chunks)
+
+    def score(self, question):
+        """返回 {片段索引: 分數}，只包含分數大於 0 的片段"""
+        return self.index.score(question)
+
+
+class BM25Scorer:
+    """
+    BM25 計分
+
+    載入時預先計算詞元-文件矩陣（以詞元為列的稀疏格式），
+    查詢時只取出問題詞元對應的列並以 NumPy 累加分數
+    """
+
+    name = 'bm25'
+
+    def __init__(self, chunks, k1=1.5, b=0.75, keyword_boost=2,
+                 ngram_range=(2, 3), min_score=1.0, previous=None):
+        """
+        Args:
+            chunks: 知識片段列表
+            k1, b: BM25 參數
+            keyword_boost: 片段 keywords 詞元的詞頻倍數
+            ngram_range: 中文字元 n-gram 範圍
+            min_score: 低於此分數的片段視為不相關
+            previous: 舊的 BM25Scorer，未變動片段的詞頻直接沿用
+        """
+        self.k1 = k1
+        self.b = b
+        self.keyword_boost = keyword_boost
+        self.ngram_range = ngram_range
+        self.min_score = min_score
+        self.num_docs = len(chunks)
+        self.vocabulary = {}
+        self._term_counts = {}
+
+        precompiled = chunks.bm25_index(self.params) if hasattr(chunks, 'bm25_index') else None
+        if precompiled is not None:
+            # 已編譯的二進位知識庫：詞彙表與倒排列表直接使用 mmap 的陣列
+            self.vocabulary, self._indptr, self._doc_ids, self._weights = precompiled
+            return
+
+        cached = {}
+        if previous is not None and (previous.ngram_range, previous.keyword_boost) == (ngram_range, keyword_boost):
+            cached = previous._term_counts
+        doc_term_counts = []
+        hashes = chunks.chunk_hashes() if hasattr(chunks, 'chunk_hashes') else None
+        for index, chunk in enumerate(chunks):
+            key = hashes[index] if hashes else chunk_hash(chunk)
+            counts = cached.get(key)
+            if counts is None:
+                counts = self._chunk_term_counts(chunk)
+            self._term_counts[key] = counts
+            doc_term_counts.append(counts)
+        self._build(doc_term_counts)
+
+    @property
+    def params(self):
+        """影響預先計算權重的參數；二進位知識庫中的索引只在參數相同時使用"""
+        return {'k1': self.k1, 'b': self.b, 'keyword_boost': self.keyword_boost,
+                'ngram_range': list(self.ngram_range)}
+
+    def _chunk_term_counts(self, chunk):
+        """計算單一片段的詞頻（內容 + 加權後的關鍵字）"""
+        counts = {}
+        for token in tokenize(chunk.get('content', ''), self.ngram_range):
+            counts[token] = counts.get(token, 0) + 1
+        for keyword in chunk.get('keywords', []):
+            for token in tokenize(keyword, self.ngram_range):
+                counts[token] = counts.get(token, 0) + self.keyword_boost
+        return counts
+
+    def _build(self, doc_term_counts):
+        """建立每個詞元的 (文件索引, BM25 權重) 倒排列表"""
+        postings = {}
+        doc_lengths = np.zeros(self.num_docs, dtype=np.float64)
+        for doc_id, counts in enumerate(doc_term_counts):
+            doc_lengths[doc_id] = sum(counts.values())
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((doc_id, count))
+
+        avg_length = doc_lengths.mean() if self.num_docs else 0.0
+        if avg_length <= 0:
+            avg_length = 1.0
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / avg_length)
+
+        indptr = [0]
+        doc_ids = []
+        term_freqs = []
+        for term_id, (term, entries) in enumerate(postings.items()):
+            self.vocabulary[term] = term_id
+            for doc_id, count in entries:
+                doc_ids.append(doc_id)
+                term_freqs.append(count)
+            indptr.append(len(doc_ids))
+
+        self._indptr = np.asarray(indptr, dtype=np.int64)
+        self._doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        tf = np.asarray(term_freqs, dtype=np.float64)
+
+        doc_freq = np.diff(self._indptr).astype(np.float64)
+        idf = np.log(1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        term_idf = np.repeat(idf, np.diff(self._indptr))
+        self._weights = term_idf * tf * (self.k1 + 1) / (tf + length_norm[self._doc_ids])
+
+    def to_arrays(self):
+        """
+        匯出詞彙表與倒排列表（見 kb_binary）；詞元依 (term_hash, 詞元) 排序，詞元編號即排序後的位置
+
+        Returns:
+            (詞元列表, 詞元雜湊, indptr, 文件索引, 權重)
+        """
+        terms = sorted(self.vocabulary, key=lambda t: (term_hash(t), t))
+        old_ids = np.asarray([self.vocabulary[t] for t in terms], dtype=np.int64)
+        lengths = np.diff(self._indptr)[old_ids]
+        indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        positions = np.concatenate([np.arange(self._indptr[i], self._indptr[i + 1]) for i in old_ids]) \
+            if len(old_ids) else np.zeros(0, dtype=np.int64)
+        hashes = np.asarray([term_hash(t) for t in terms], dtype=np.uint32)
+        return terms, hashes, indptr, self._doc_ids[positions], self._weights[positions]
+
+    def score(self, question):
+        """返回 {片段索引: 分數}，只包含分數不低於 min_score 的片段"""
+        term_ids = {self.vocabulary.get(t) for t in tokenize(question, self.ngram_range)}
+        term_ids.discard(None)
+        if not term_ids:
+            return {}
+
+        term_ids = np.fromiter(term_ids, dtype=np.int64)
+        starts = self._indptr[term_ids]
+        lengths = self._indptr[term_ids + 1] - starts
+        # 將多個 [start, end) 區間展開成一個索引陣列
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+
+        scores = np.bincount(self._doc_ids[positions], weights=self._weights[positions],
+                             minlength=self.num_docs)
+        matched = np.flatnonzero((scores > 0) & (scores >= self.min_score))
+        return {int(doc_id): float(scores[doc_id]) for doc_id in matched}
+
+
+SCORERS = {
+    KeywordScorer.name: KeywordScorer,
+    BM25Scorer.name: BM25Scorer,
+}
@@ -0,0 +1,32 @@
+"""
+問題是否提到畫面
+「這個按鈕是什麼」「畫面上的錯誤訊息」這類問題需要看截圖才能回答；
+「忘記密碼怎麼辦」這類問題只靠知識庫即可回答，不需要視覺模型
+"""
+import re
+
+# 指涉畫面內容的用語（繁體與簡體、英文）
+SCREEN_REFERENCE_PATTERNS = (
+    r'畫面', r'画面', r'截圖', r'截图', r'螢幕', r'屏幕', r'圖片', r'图片', r'圖中', r'图中',
+    r'這個', r'这个', r'這裡', r'这里', r'這邊', r'这边', r'這頁', r'这页', r'這一頁', r'此頁',
+    r'上面', r'下面', r'左邊', r'右邊', r'左上', r'右上', r'左下', r'右下', r'旁邊',
+    r'按鈕', r'按钮', r'圖示', r'图标', r'選單', r'菜单', r'視窗', r'窗口', r'彈出', r'弹出',
+    r'紅色', r'綠色', r'藍色', r'黃色', r'灰色', r'顯示的', r'出現的', r'看到的', r'錯誤訊息', r'錯誤代碼',
+    r'\bthis (page|button|screen|icon|message|error)\b', r'\bon (the )?screen\b', r'\bscreenshot\b',
+    r'\bwhat does (this|that)\b', r'\bwhere is\b', r'\bclick\b',
+)
+
+_SCREEN_REFERENCE = re.compile('|'.join(SCREEN_REFERENCE_PATTERNS), re.IGNORECASE)
+
+
+def references_screen(question):
+    """
+    問題是否提到畫面內容（需要截圖才能回答）
+
+    Args:
+        question: 使用者的原始問題（不是增強後的 prompt）
+
+    Returns:
+        提到畫面時返回 True
+    """
+    return bool(_SCREEN_REFERENCE.search(question or ''))
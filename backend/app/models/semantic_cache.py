@@ -0,0 +1,167 @@
+"""
+語意回應快取模組
+同一個問題有許多問法（「忘記密碼怎麼辦」與「密碼忘了無法登入」），精確快取鍵不會命中。
+文本模型不使用截圖，回應只取決於增強後的 prompt，因此對文本模型：
+以問題向量的 cosine 相似度找出最相近的已快取問題，
+相似度超過門檻且檢索到的知識片段相同時直接返回先前的回應
+
+向量存放在預先配置的 NumPy 矩陣中，查詢為一次矩陣乘法的 top-1 搜尋；
+項目數達上限時淘汰最久未使用的項目
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .dense_retriever import OllamaEmbedder, _normalize
+
+logger = logging.getLogger(__name__)
+
+# 問題向量化失敗後暫停語意快取的秒數（例如 embedding 模型尚未安裝）
+EMBED_RETRY_SECONDS = 60
+
+
+class SemanticCache:
+    """以問題向量相似度查詢的程序內回應快取"""
+
+    def __init__(self, embedder, threshold=0.92, max_entries=512, ttl=3600):
+        """
+        Args:
+            embedder: 提供 embed(texts) 與 model 屬性的物件
+            threshold: 命中所需的最低 cosine 相似度
+            max_entries: 最多項目數，超過時淘汰最久未使用的項目
+            ttl: 快取秒數
+        """
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None  # (max_entries, dim)，第一次寫入時依向量維度配置
+        self._scopes = np.zeros(max_entries, dtype=np.int64)  # 模型 + 片段 id 的雜湊，0 表示空位
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._entries = [None] * max_entries  # (問題, 回應)
+        self._embed_disabled_until = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def scope(model, chunk_ids):
+        """同一模型且檢索到相同片段的問題才能互相命中；以 64 位元雜湊表示，0 保留給空位"""
+        payload = '\0'.join([model, *map(str, chunk_ids)])
+        value = int.from_bytes(hashlib.sha256(payload.encode('utf-8')).digest()[:8], 'little', signed=True)
+        return value or 1
+
+    def embed(self, question, query_embedding=None):
+        """
+        問題向量（單位長度）
+
+        Args:
+            query_embedding: 檢索時已算好的 (embedding 模型名稱, 向量)，模型相同時直接沿用
+
+        Returns:
+            float32 向量；向量化失敗時返回 None
+        """
+        if query_embedding is not None and query_embedding[0] == self.embedder.model:
+            return _normalize(np.asarray(query_embedding[1], dtype=np.float32))
+        if time.time() < self._embed_disabled_until:
+            return None
+        try:
+            return _normalize(self.embedder.embed([question]))[0]
+        except Exception as e:
+            self._embed_disabled_until = time.time() + EMBED_RETRY_SECONDS
+            logger.warning(f'⚠️ 問題向量化失敗，語意快取暫停 {EMBED_RETRY_SECONDS} 秒: {str(e)}')
+            return None
+
+    def get(self, scope, vector):
+        """
+        找出同一 scope 中與 vector 最相近的已快取問題
+
+        Returns:
+            (回應, 相似度, 命中的問題)；未命中時返回 None
+        """
+        now = time.time()
+        with self._lock:
+            if self._vectors is not None and self._vectors.shape[1] == vector.shape[0]:
+                scores = self._vectors @ vector
+                scores[(self._scopes != scope) | (self._expires <= now)] = -np.inf
+                slot = int(scores.argmax())
+                if scores[slot] >= self.threshold:
+                    self._last_used[slot] = now
+                    self.hits += 1
+                    question, answer = self._entries[slot]
+                    return answer, float(scores[slot]), question
+            self.misses += 1
+        return None
+
+    def set(self, scope, question, vector, answer):
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                # embedding 模型更換後維度不同，舊向量無法比較
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+                self._scopes[:] = 0
+                self._entries = [None] * self.max_entries
+            same = np.flatnonzero(self._scopes == scope)
+            slot = next((int(i) for i in same if self._entries[i][0] == question), None)
+            if slot is None:
+                # 優先使用空位或已過期的項目，否則淘汰最久未使用的項目
+                free = np.flatnonzero((self._scopes == 0) | (self._expires <= now))
+                slot = int(free[0]) if len(free) else int(self._last_used.argmin())
+            self._vectors[slot] = vector
+            self._scopes[slot] = scope
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._entries[slot] = (question, answer)
+
+    def __len__(self):
+        with self._lock:
+            return int(((self._scopes != 0) & (self._expires > time.time())).sum())
+
+    def stats(self):
+        """快取統計（本程序的計數）"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'max_entries': self.max_entries,
+            'threshold': self.threshold,
+            'embed_model': self.embedder.model,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'pid': os.getpid(),
+        }
+
+
+def create_semantic_cache(pool=None, session_factory=None):
+    """
+    依環境變數建立語意快取
+
+    SEMANTIC_CACHE: true (預設) / false
+    SEMANTIC_CACHE_THRESHOLD: 命中所需的 cosine 相似度（預設 0.92）
+    SEMANTIC_CACHE_MAX_ENTRIES: 最多項目數（預設 512）
+    SEMANTIC_CACHE_TTL: 快取秒數（預設同 RESPONSE_CACHE_TTL）
+    OLLAMA_EMBED_MODEL: 問題向量化使用的 embedding 模型（與向量檢索相同）
+
+    Args:
+        pool: OllamaNodePool，embedding 請求送往已安裝模型的健康節點
+        session_factory: 返回共用 requests.Session 的函式
+
+    Returns:
+        SemanticCache，停用時返回 None
+    """
+    if os.getenv('SEMANTIC_CACHE', 'true').lower() != 'true':
+        return None
+    cache = SemanticCache(
+        OllamaEmbedder(timeout=10, pool=pool, session_factory=session_factory),
+        threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92')),
+        max_entries=int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '512')),
+        ttl=float(os.getenv('SEMANTIC_CACHE_TTL') or os.getenv('RESPONSE_CACHE_TTL', '3600')),
+    )
+    logger.info(f'✅ 語意快取已啟用 (門檻 {cache.threshold}, 上限 {cache.max_entries} 筆, '
+                f'embedding: {cache.embedder.model})')
+    return cache
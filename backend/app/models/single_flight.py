@@ -0,0 +1,295 @@
+"""
+相同請求合併 (single-flight) 模組
+同一個鍵 (模型, 增強後的 prompt, 截圖摘要) 同時只計算一次，
+其他同時到達的相同請求等待第一個請求的結果
+
+跨 worker：共用目錄中的鎖檔上，以依鍵雜湊決定位置的 POSIX 位元組範圍鎖 (fcntl.lockf) 協調；
+計算完成的 worker 在釋放鎖之前把成功的結果寫入同一目錄（只有擁有者可讀寫），
+等到鎖的 worker 讀取在它開始等待之後寫入的結果，沒有結果（例如前一個計算失敗）才自行計算。不依賴回應快取的後端
+"""
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 跨 worker 等待其他程序完成時的輪詢間隔（秒）
+_POLL_INTERVAL = 0.05
+
+# 結果檔保留秒數：只給同時等待的 worker 讀取，之後由下一個計算的 worker 清除
+_RESULT_TTL = 300
+# 每隔幾次計算清除一次過期的結果檔
+_CLEANUP_EVERY = 100
+
+
+class _Call:
+    """進行中的一次計算；完成時喚醒同步與非同步的等待者"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self._futures = []
+
+    def add_future(self, loop, future):
+        self._futures.append((loop, future))
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.event.set()
+        for loop, future in self._futures:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+
+class SingleFlight:
+    """相同鍵的並行請求只計算一次"""
+
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory: 跨 worker 協調用的目錄（鎖檔與結果檔）；None 表示只在程序內合併
+        """
+        self.directory = directory
+        self.lock_path = None
+        if directory is not None:
+            # 結果檔含使用者的問題與回答，目錄只給執行服務的使用者存取
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            try:
+                os.chmod(directory, 0o700)
+            except OSError as e:
+                logger.warning(f'⚠️ 無法限制合併目錄的權限 ({directory}): {str(e)}')
+            self.lock_path = os.path.join(directory, 'inflight.lock')
+        self.leaders = 0
+        self.coalesced = 0
+        self.coalesced_remote = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._lock_pid = None
+
+    def _join(self, key):
+        """
+        Returns:
+            (_Call, 是否為等待者)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, True
+            call = _Call()
+            self._calls[key] = call
+            self.leaders += 1
+            return call, False
+
+    def _leave(self, key, call, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        call.finish(result, error)
+
+    @staticmethod
+    def _result(call):
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+    def _fd(self):
+        """
+        每個程序各自開啟一次鎖檔且不關閉：
+        POSIX 記錄鎖屬於程序，關閉同一檔案的任一個 fd 會釋放該程序的所有鎖
+        """
+        if self._lock_fd is None or self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock_pid = os.getpid()
+        return self._lock_fd
+
+    @staticmethod
+    def _offset(key):
+        return int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:4], 'big') >> 1
+
+    def _try_lock(self, offset):
+        try:
+            fcntl.lockf(self._fd(), fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(self, offset):
+        fcntl.lockf(self._fd(), fcntl.LOCK_UN, 1, offset)
+
+    def _result_path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.result')
+
+    def _publish(self, key, result, publishable=None):
+        """
+        持有鎖時寫入結果檔，讓正在等待同一個鍵的 worker 讀取（只支援字串結果）
+
+        Args:
+            publishable: 結果 → 是否提供給其他 worker；失敗的結果不寫入，等待的 worker 改為自行計算
+        """
+        if not isinstance(result, str) or (publishable is not None and not publishable(result)):
+            return
+        path = self._result_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.write(result)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'⚠️ 無法寫入合併結果檔: {str(e)}')
+        if self.leaders % _CLEANUP_EVERY == 0:
+            self._cleanup()
+
+    def _read_published(self, key, since):
+        """讀取在 since 之後寫入的結果檔（較舊的是先前請求留下的結果）"""
+        path = self._result_path(key)
+        try:
+            if os.stat(path).st_mtime < since:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _cleanup(self):
+        """刪除過期的結果檔"""
+        expired = time.time() - _RESULT_TTL
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(('.result', '.tmp')) and entry.stat().st_mtime < expired:
+                        os.unlink(entry.path)
+        except OSError:
+            pass
+
+    def do(self, key, fn, publishable=None):
+        """
+        以 single-flight 方式執行 fn
+
+        Args:
+            key: 合併鍵
+            fn: 計算結果的函式
+            publishable: 結果 → 是否提供給其他 worker 合併的請求（None 表示所有字串結果）
+
+        Returns:
+            (結果, 是否為合併而來的結果)
+        """
+        call, waiting = self._join(key)
+        if waiting:
+            call.event.wait()
+            return self._result(call)
+
+        try:
+            result, coalesced = self._lead(key, fn, publishable)
+        except BaseException as e:
+            self._leave(key, call, error=e)
+            raise
+        self._leave(key, call, result=result)
+        return result, coalesced
+
+    def _lead(self, key, fn, publishable):
+        if self.lock_path is None:
+            return fn(), False
+        offset = self._offset(key)
+        since = time.time()
+        waited = False
+        while not self._try_lock(offset):
+            waited = True
+            time.sleep(_POLL_INTERVAL)
+        try:
+            if waited:
+                result = self._read_published(key, since)
+                if result is not None:
+                    with self._lock:
+                        self.coalesced_remote += 1
+                    return result, True
+            result = fn()
+            self._publish(key, result, publishable)
+            return result, False
+        finally:
+            self._unlock(offset)
+
+    async def do_async(self, key, coro_fn, publishable=None):
+        """
+        do 的非同步版本
+
+        Args:
+            coro_fn: 返回 coroutine 的函式
+            publishable: 同 do
+        """
+        call, waiting = self._join(key)
+        if waiting:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            call.add_future(loop, future)
+            # 加入等待前計算可能已完成
+            if not call.event.is_set():
+                await future
+            return self._result(call)
+
+        try:
+            result, coalesced = await self._lead_async(key, coro_fn, publishable)
+        except BaseException as e:
+            self._leave(key, call, error=e)
+            raise
+        self._leave(key, call, result=result)
+        return result, coalesced
+
+    async def _lead_async(self, key, coro_fn, publishable):
+        if self.lock_path is None:
+            return await coro_fn(), False
+        offset = self._offset(key)
+        since = time.time()
+        waited = False
+        while not self._try_lock(offset):
+            waited = True
+            await asyncio.sleep(_POLL_INTERVAL)
+        try:
+            if waited:
+                result = await asyncio.to_thread(self._read_published, key, since)
+                if result is not None:
+                    with self._lock:
+                        self.coalesced_remote += 1
+                    return result, True
+            result = await coro_fn()
+            await asyncio.to_thread(self._publish, key, result, publishable)
+            return result, False
+        finally:
+            self._unlock(offset)
+
+    def stats(self):
+        """合併統計（本程序）"""
+        with self._lock:
+            return {
+                'cross_worker': self.lock_path is not None,
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'coalesced_remote': self.coalesced_remote,
+            }
+
+
+def create_single_flight():
+    """
+    依環境變數建立 single-flight
+
+    REQUEST_COALESCING: true (預設，同一台機器的 worker 之間也會合併) / local (只在程序內合併) / false
+    REQUEST_COALESCING_DIR: 跨 worker 合併的鎖檔與結果檔目錄（預設為暫存目錄下的 campus_ai_inflight）
+
+    Returns:
+        SingleFlight，停用時返回 None
+    """
+    mode = os.getenv('REQUEST_COALESCING', 'true').lower()
+    if mode not in ('true', 'local'):
+        return None
+    directory = None
+    if mode == 'true':
+        directory = os.getenv('REQUEST_COALESCING_DIR') or os.path.join(tempfile.gettempdir(), 'campus_ai_inflight')
+    return SingleFlight(directory)
@@ -2,17 +2,102 @@
 API 路由定義
 """
 
-from flask import Blueprint, request, jsonify, g
+from flask import Blueprint, Response, request, jsonify, g, stream_with_context
 from datetime import datetime
 import base64
+import hmac
+import json
 import logging
+import os
 import traceback
+from ..models import metrics
+from ..models.admission import QueueFullError
 from ..models.retriever import get_retriever
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 logger = logging.getLogger(__name__)
 
+def parse_ask_request(data):
+    """
+    驗證 /ask 類端點的請求內容（Flask 與 ASGI 路由共用）
+    
+    Returns:
+        (question, screenshot, model)
+    
+    Raises:
+        ValueError: 請求內容不合法，訊息可直接回給使用者
+    """
+    # 驗證必需的欄位
+    if not data:
+        raise ValueError('無效的請求體')
+    
+    question = data.get('question', '').strip()
+    screenshot = data.get('screenshot')
+    model = data.get('model', 'llava')
+    
+    if not question:
+        raise ValueError('問題不能為空')
+    
+    if not screenshot:
+        raise ValueError('截圖不能為空')
+    
+    return question, screenshot, model
+
+def parse_upload_request(fields, image_data):
+    """
+    驗證二進位截圖上傳端點的請求內容（Flask 與 ASGI 路由共用）
+    
+    Args:
+        fields: question、model 欄位（multipart 表單或查詢參數）
+        image_data: 截圖位元組
+    
+    Returns:
+        (question, model)
+    
+    Raises:
+        ValueError: 請求內容不合法，訊息可直接回給使用者
+    """
+    question = (fields.get('question') or '').strip()
+    if not question:
+        raise ValueError('問題不能為空')
+    if not image_data:
+        raise ValueError('截圖不能為空')
+    return question, fields.get('model') or 'llava'
+
+def format_sse(event):
+    """將 AIModel.stream_query 的事件字典轉為 Server-Sent Events 格式"""
+    payload = {k: v for k, v in event.items() if k != 'type'}
+    return f"event: {event['type']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def queue_full_body(error):
+    """推論佇列已滿時的 429 回應內容（Flask 與 ASGI 路由共用）"""
+    return {
+        'error': '伺服器忙碌中',
+        'message': str(error),
+        'retry_after': error.retry_after,
+        'timestamp': datetime.now().isoformat()
+    }
+
+def admin_token_matches(provided, admin_token):
+    """
+    以固定時間比較 X-Admin-Token 與 ADMIN_TOKEN（Flask 與 ASGI 路由共用）
+
+    標頭值由伺服器以 latin-1 解碼，先還原為原始位元組再與 UTF-8 編碼的 ADMIN_TOKEN 比較；
+    compare_digest 遇到非 ASCII 字串會拋出 TypeError
+    """
+    try:
+        provided = provided.encode('latin-1')
+    except UnicodeEncodeError:
+        provided = provided.encode('utf-8', 'surrogatepass')
+    return hmac.compare_digest(provided, admin_token.encode('utf-8', 'surrogatepass'))
+
+def _queue_full_response(error):
+    response = jsonify(queue_full_body(error))
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
 @bp.route('/ask', methods=['POST'])
+@metrics.track_request('ask')
 def ask_ai():
     """
     主要端點：接收螢幕截圖和問題，返回 AI 回應
@@ -24,45 +109,113 @@ def ask_ai():
         "model": "ai 模型名稱 (qwen/gpt/claude)",
         "timestamp": "ISO 格式時間戳"
     }
+    
+    回應的 meta 包含 cached、queue_depth (排在前面的請求數)、queue_wait_ms，
+    以及模型路由改派時的 routed_to (實際使用的模型) 與 routing_reason；
+    推論佇列已滿時返回 429 與 Retry-After 標頭
     """
     try:
-        data = request.get_json()
-        
-        # 驗證必需的欄位
-        if not data:
-            return jsonify({'error': '無效的請求體'}), 400
-        
-        question = data.get('question', '').strip()
-        screenshot = data.get('screenshot')
-        model = data.get('model', 'llava')
-        
-        if not question:
-            return jsonify({'error': '問題不能為空'}), 400
+        with metrics.STAGE_SECONDS.time(stage='json_parse'):
+            data = request.get_json()
         
-        if not screenshot:
-            return jsonify({'error': '截圖不能為空'}), 400
+        try:
+            question, screenshot, model = parse_ask_request(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # 記錄請求
         logger.info(f'接收問題: {question[:50]}... 使用模型: {model}')
         
         # 🎯 使用輕量級檢索器增強 prompt
         retriever = get_retriever()
-        enhanced_question = retriever.get_context_prompt(question)
+        context = retriever.get_context(question, model)
         
         # 調用 AI 模型（使用增強後的問題）
+        meta = {}
         response_text = g.ai_model.process_query(
-            question=enhanced_question,
+            question=context.prompt,
             screenshot=screenshot,
-            model_type=model
+            model_type=model,
+            meta=meta,
+            context=context
         )
         
+        with metrics.STAGE_SECONDS.time(stage='serialize'):
+            response = jsonify({
+                'status': 'success',
+                'response': response_text,
+                'model': model,
+                'meta': meta,
+                'timestamp': datetime.now().isoformat()
+            })
+        return response, 200
+        
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    except Exception as e:
+        logger.error(f'處理請求時發生錯誤: {str(e)}')
+        logger.error(traceback.format_exc())
         return jsonify({
-            'status': 'success',
-            'response': response_text,
-            'model': model,
+            'error': '處理請求失敗',
+            'message': str(e),
             'timestamp': datetime.now().isoformat()
-        }), 200
+        }), 500
+
+@bp.route('/ask/upload', methods=['POST'])
+@metrics.track_request('ask_upload')
+def ask_ai_upload():
+    """
+    二進位截圖上傳端點：與 /ask 相同，但截圖不經 base64 與 JSON，直接以位元組傳送
+    
+    請求格式（二擇一）:
+    - multipart/form-data: question、model 欄位與 screenshot 檔案
+    - image/jpeg 或 image/png 原始內容: question、model 以查詢參數傳送
+    """
+    try:
+        if request.mimetype == 'multipart/form-data':
+            with metrics.STAGE_SECONDS.time(stage='upload_read'):
+                upload = request.files.get('screenshot')
+                image_data = upload.read() if upload else b''
+            fields = request.form
+        elif request.mimetype.startswith('image/'):
+            # 請求體直接讀成一份 bytes，不經表單解析
+            with metrics.STAGE_SECONDS.time(stage='upload_read'):
+                image_data = request.get_data(cache=False)
+            fields = request.args
+        else:
+            return jsonify({'error': '不支援的內容類型，請使用 multipart/form-data 或 image/*'}), 415
+        
+        try:
+            question, model = parse_upload_request(fields, image_data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        logger.info(f'接收問題 (上傳 {len(image_data)} bytes): {question[:50]}... 使用模型: {model}')
+        
+        retriever = get_retriever()
+        context = retriever.get_context(question, model)
+        
+        meta = {}
+        response_text = g.ai_model.process_query(
+            question=context.prompt,
+            image_data=image_data,
+            model_type=model,
+            meta=meta,
+            context=context
+        )
         
+        with metrics.STAGE_SECONDS.time(stage='serialize'):
+            response = jsonify({
+                'status': 'success',
+                'response': response_text,
+                'model': model,
+                'meta': meta,
+                'timestamp': datetime.now().isoformat()
+            })
+        return response, 200
+        
+    except QueueFullError as e:
+        return _queue_full_response(e)
     except Exception as e:
         logger.error(f'處理請求時發生錯誤: {str(e)}')
         logger.error(traceback.format_exc())
@@ -72,6 +225,62 @@ def ask_ai():
             'timestamp': datetime.now().isoformat()
         }), 500
 
+@bp.route('/ask/stream', methods=['POST'])
+@metrics.track_request('ask_stream')
+def ask_ai_stream():
+    """
+    串流端點：與 /ask 相同的請求格式，以 Server-Sent Events 逐步返回回應
+    
+    事件:
+    - token: {"content": "回應片段"}
+    - error: {"message": "錯誤訊息"}
+    - done: {"model": "模型名稱", "timing": {...}}（最後一個事件，含 queue_wait_ms 等排隊資訊）
+    
+    推論佇列已滿時在開始串流前返回 429
+    """
+    with metrics.STAGE_SECONDS.time(stage='json_parse'):
+        data = request.get_json(silent=True)
+    try:
+        question, screenshot, model = parse_ask_request(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    logger.info(f'接收串流問題: {question[:50]}... 使用模型: {model}')
+    
+    retriever = get_retriever()
+    context = retriever.get_context(question, model)
+    events = g.ai_model.stream_query(
+        question=context.prompt,
+        screenshot=screenshot,
+        model_type=model,
+        context=context
+    )
+    try:
+        # 先取得第一個事件：排隊被拒時還能返回 429 而不是已開始的 200 串流
+        first = next(events)
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    except Exception as e:
+        logger.error(f'串流處理請求時發生錯誤: {str(e)}')
+        logger.error(traceback.format_exc())
+        return jsonify({'error': '處理請求失敗', 'message': str(e)}), 500
+    
+    def generate():
+        try:
+            yield format_sse(first)
+            for event in events:
+                yield format_sse(event)
+        except Exception as e:
+            logger.error(f'串流處理請求時發生錯誤: {str(e)}')
+            logger.error(traceback.format_exc())
+            yield format_sse({'type': 'error', 'message': f'處理請求失敗: {str(e)}'})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @bp.route('/analyze', methods=['POST'])
 def analyze():
     """
@@ -82,12 +291,14 @@ def analyze():
 
 @bp.route('/models', methods=['GET'])
 def get_available_models():
-    """獲取可用的 AI 模型列表"""
+    """獲取可用的 AI 模型列表：背景探測的快取，含各模型是否已安裝與是否載入在記憶體中"""
     try:
-        models = g.ai_model.get_available_models()
+        ai_model = g.ai_model
+        models = ai_model.get_available_models()
         return jsonify({
             'status': 'success',
             'models': models,
+            'catalog': ai_model.model_catalog.freshness(),
             'timestamp': datetime.now().isoformat()
         }), 200
     except Exception as e:
@@ -97,6 +308,81 @@ def get_available_models():
             'timestamp': datetime.now().isoformat()
         }), 500
 
+@bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """回應快取統計：命中 / 未命中次數、目前項目數、相同請求合併次數、語意快取與預先產生回答的統計"""
+    cache = g.ai_model.response_cache
+    single_flight = g.ai_model.single_flight
+    return jsonify({
+        'status': 'success',
+        'enabled': cache is not None,
+        'stats': cache.stats() if cache is not None else {},
+        'coalescing': single_flight.stats() if single_flight is not None else {},
+        'semantic': g.ai_model.semantic_cache.stats() if g.ai_model.semantic_cache is not None else {},
+        'faq': g.ai_model.faq_answers.stats() if g.ai_model.faq_answers is not None else {},
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+@bp.route('/queue/stats', methods=['GET'])
+def queue_stats():
+    """推論佇列統計：各後端的進行中 / 排隊數、拒絕次數與排隊時間"""
+    return jsonify({
+        'status': 'success',
+        'queues': g.ai_model.queue_stats(),
+        'pid': os.getpid(),
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+@bp.route('/router/stats', methods=['GET'])
+def router_stats():
+    """模型路由統計：各改派原因的次數、各模型的實測延遲與進行中請求、最近的路由決策"""
+    return jsonify({
+        'status': 'success',
+        'router': g.ai_model.router.stats(),
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+@bp.route('/ollama/nodes', methods=['GET'])
+def ollama_nodes():
+    """Ollama 節點狀態：健康狀態、已安裝 / 已載入的模型、進行中請求與延遲、常駐模型與冷啟動、系統提示前綴重用統計"""
+    return jsonify({
+        'status': 'success',
+        'pool': g.ai_model.ollama_pool.stats(),
+        'residency': g.ai_model.residency.stats(),
+        'prompt_prefixes': g.ai_model.prompt_prefixes.stats(),
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+@bp.route('/knowledge/reload', methods=['POST'])
+def reload_knowledge():
+    """
+    管理端點：重新載入知識庫並增量重建索引
+    
+    請求需帶上與 ADMIN_TOKEN 相同的 X-Admin-Token 標頭；未設定 ADMIN_TOKEN 時一律拒絕。
+    只會重新載入處理此請求的 worker，其他 worker 透過檔案修改時間輪詢自動更新。
+    """
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token:
+        return jsonify({'error': '管理端點未啟用（未設定 ADMIN_TOKEN）'}), 403
+    if not admin_token_matches(request.headers.get('X-Admin-Token', ''), admin_token):
+        return jsonify({'error': '未授權'}), 403
+    
+    try:
+        report = get_retriever().reload(force=True)
+        report['pid'] = os.getpid()
+        return jsonify({
+            'status': 'success',
+            'report': report,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        logger.error(f'重新載入知識庫失敗: {str(e)}')
+        return jsonify({
+            'error': '重新載入知識庫失敗',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }), 500
+
 @bp.route('/test', methods=['GET'])
 def test_endpoint():
     """測試端點"""
@@ -0,0 +1,307 @@
+"""
+ASGI 路由定義
+與 api_routes.py 相同的端點，改以 Starlette 實作並呼叫 AsyncAIModel，
+等待模型回應時不佔用 worker
+"""
+
+import asyncio
+import logging
+import os
+import traceback
+from datetime import datetime
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from ..models import metrics
+from ..models.admission import QueueFullError
+from ..models.retriever import get_retriever
+from .api_routes import (admin_token_matches, format_sse, parse_ask_request, parse_upload_request,
+                         queue_full_body)
+
+logger = logging.getLogger(__name__)
+
+
+async def _read_json(request: Request):
+    """讀取 JSON 請求體；格式錯誤時返回 None"""
+    with metrics.STAGE_SECONDS.time(stage='json_parse'):
+        try:
+            return await request.json()
+        except Exception:
+            return None
+
+
+def _queue_full_response(error):
+    return JSONResponse(queue_full_body(error), status_code=429,
+                        headers={'Retry-After': str(error.retry_after)})
+
+
+@metrics.track_request('ask')
+async def ask_ai(request: Request):
+    """
+    主要端點：接收螢幕截圖和問題，返回 AI 回應
+
+    請求與回應格式同 Flask 版 /api/ask
+    """
+    try:
+        try:
+            question, screenshot, model = parse_ask_request(await _read_json(request))
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+
+        logger.info(f'接收問題: {question[:50]}... 使用模型: {model}')
+
+        # 檢索可能呼叫 embedding 服務，放到執行緒池
+        context = await asyncio.to_thread(get_retriever().get_context, question, model)
+
+        meta = {}
+        response_text = await request.app.state.ai_model.process_query_async(
+            question=context.prompt,
+            screenshot=screenshot,
+            model_type=model,
+            meta=meta,
+            context=context
+        )
+
+        with metrics.STAGE_SECONDS.time(stage='serialize'):
+            return JSONResponse({
+                'status': 'success',
+                'response': response_text,
+                'model': model,
+                'meta': meta,
+                'timestamp': datetime.now().isoformat()
+            })
+
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    except Exception as e:
+        logger.error(f'處理請求時發生錯誤: {str(e)}')
+        logger.error(traceback.format_exc())
+        return JSONResponse({
+            'error': '處理請求失敗',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }, status_code=500)
+
+
+@metrics.track_request('ask_upload')
+async def ask_ai_upload(request: Request):
+    """
+    二進位截圖上傳端點：multipart/form-data 或 image/* 原始內容，格式同 Flask 版 /api/ask/upload
+
+    multipart 需要安裝 python-multipart
+    """
+    try:
+        content_type = request.headers.get('content-type', '').split(';')[0].strip()
+        if content_type == 'multipart/form-data':
+            with metrics.STAGE_SECONDS.time(stage='upload_read'):
+                form = await request.form()
+                upload = form.get('screenshot')
+                image_data = await upload.read() if upload is not None and hasattr(upload, 'read') else b''
+            fields = form
+        elif content_type.startswith('image/'):
+            with metrics.STAGE_SECONDS.time(stage='upload_read'):
+                image_data = await request.body()
+            fields = request.query_params
+        else:
+            return JSONResponse({'error': '不支援的內容類型，請使用 multipart/form-data 或 image/*'}, status_code=415)
+
+        try:
+            question, model = parse_upload_request(fields, image_data)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+
+        logger.info(f'接收問題 (上傳 {len(image_data)} bytes): {question[:50]}... 使用模型: {model}')
+
+        context = await asyncio.to_thread(get_retriever().get_context, question, model)
+
+        meta = {}
+        response_text = await request.app.state.ai_model.process_query_async(
+            question=context.prompt,
+            image_data=image_data,
+            model_type=model,
+            meta=meta,
+            context=context
+        )
+
+        with metrics.STAGE_SECONDS.time(stage='serialize'):
+            return JSONResponse({
+                'status': 'success',
+                'response': response_text,
+                'model': model,
+                'meta': meta,
+                'timestamp': datetime.now().isoformat()
+            })
+
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    except Exception as e:
+        logger.error(f'處理請求時發生錯誤: {str(e)}')
+        logger.error(traceback.format_exc())
+        return JSONResponse({
+            'error': '處理請求失敗',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }, status_code=500)
+
+
+@metrics.track_request('ask_stream')
+async def ask_ai_stream(request: Request):
+    """串流端點：以 Server-Sent Events 逐步返回回應，事件格式同 Flask 版 /api/ask/stream"""
+    try:
+        question, screenshot, model = parse_ask_request(await _read_json(request))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+
+    logger.info(f'接收串流問題: {question[:50]}... 使用模型: {model}')
+
+    context = await asyncio.to_thread(get_retriever().get_context, question, model)
+    events = request.app.state.ai_model.stream_query_async(
+        question=context.prompt,
+        screenshot=screenshot,
+        model_type=model,
+        context=context
+    )
+    try:
+        # 先取得第一個事件：排隊被拒時還能返回 429
+        first = await events.__anext__()
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    except Exception as e:
+        logger.error(f'串流處理請求時發生錯誤: {str(e)}')
+        logger.error(traceback.format_exc())
+        return JSONResponse({'error': '處理請求失敗', 'message': str(e)}, status_code=500)
+
+    async def generate():
+        try:
+            yield format_sse(first)
+            async for event in events:
+                yield format_sse(event)
+        except Exception as e:
+            logger.error(f'串流處理請求時發生錯誤: {str(e)}')
+            logger.error(traceback.format_exc())
+            yield format_sse({'type': 'error', 'message': f'處理請求失敗: {str(e)}'})
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async def get_available_models(request: Request):
+    """獲取可用的 AI 模型列表：背景探測的快取，含各模型是否已安裝與是否載入在記憶體中"""
+    try:
+        ai_model = request.app.state.ai_model
+        models = ai_model.get_available_models()
+        return JSONResponse({
+            'status': 'success',
+            'models': models,
+            'catalog': ai_model.model_catalog.freshness(),
+            'timestamp': datetime.now().isoformat()
+        })
+    except Exception as e:
+        logger.error(f'獲取模型列表失敗: {str(e)}')
+        return JSONResponse({
+            'error': '獲取模型列表失敗',
+            'timestamp': datetime.now().isoformat()
+        }, status_code=500)
+
+
+async def cache_stats(request: Request):
+    """回應快取統計：命中 / 未命中次數、目前項目數、相同請求合併次數、語意快取與預先產生回答的統計"""
+    ai_model = request.app.state.ai_model
+    cache = ai_model.response_cache
+    stats = await asyncio.to_thread(cache.stats) if cache is not None else {}
+    return JSONResponse({
+        'status': 'success',
+        'enabled': cache is not None,
+        'stats': stats,
+        'coalescing': ai_model.single_flight.stats() if ai_model.single_flight is not None else {},
+        'semantic': ai_model.semantic_cache.stats() if ai_model.semantic_cache is not None else {},
+        'faq': ai_model.faq_answers.stats() if ai_model.faq_answers is not None else {},
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def queue_stats(request: Request):
+    """推論佇列統計：各後端的進行中 / 排隊數、拒絕次數與排隊時間"""
+    return JSONResponse({
+        'status': 'success',
+        'queues': request.app.state.ai_model.queue_stats(),
+        'pid': os.getpid(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def router_stats(request: Request):
+    """模型路由統計：各改派原因的次數、各模型的實測延遲與進行中請求、最近的路由決策"""
+    return JSONResponse({
+        'status': 'success',
+        'router': request.app.state.ai_model.router.stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def ollama_nodes(request: Request):
+    """Ollama 節點狀態：健康狀態、已安裝 / 已載入的模型、進行中請求與延遲、常駐模型與冷啟動、系統提示前綴重用統計"""
+    return JSONResponse({
+        'status': 'success',
+        'pool': request.app.state.ai_model.ollama_pool.stats(),
+        'residency': request.app.state.ai_model.residency.stats(),
+        'prompt_prefixes': request.app.state.ai_model.prompt_prefixes.stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def reload_knowledge(request: Request):
+    """管理端點：重新載入知識庫並增量重建索引（需 X-Admin-Token，同 Flask 版）"""
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token:
+        return JSONResponse({'error': '管理端點未啟用（未設定 ADMIN_TOKEN）'}, status_code=403)
+    if not admin_token_matches(request.headers.get('X-Admin-Token', ''), admin_token):
+        return JSONResponse({'error': '未授權'}, status_code=403)
+
+    try:
+        report = await asyncio.to_thread(get_retriever().reload, True)
+        report['pid'] = os.getpid()
+        return JSONResponse({
+            'status': 'success',
+            'report': report,
+            'timestamp': datetime.now().isoformat()
+        })
+    except Exception as e:
+        logger.error(f'重新載入知識庫失敗: {str(e)}')
+        return JSONResponse({
+            'error': '重新載入知識庫失敗',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }, status_code=500)
+
+
+async def test_endpoint(request: Request):
+    """測試端點"""
+    return JSONResponse({
+        'status': 'success',
+        'message': '校務系統 AI 助手後端正在運行',
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+routes = [
+    Mount('/api', routes=[
+        Route('/ask', ask_ai, methods=['POST']),
+        Route('/ask/upload', ask_ai_upload, methods=['POST']),
+        Route('/ask/stream', ask_ai_stream, methods=['POST']),
+        # Chrome 擴展使用的別名
+        Route('/analyze', ask_ai, methods=['POST']),
+        Route('/models', get_available_models, methods=['GET']),
+        Route('/cache/stats', cache_stats, methods=['GET']),
+        Route('/queue/stats', queue_stats, methods=['GET']),
+        Route('/router/stats', router_stats, methods=['GET']),
+        Route('/ollama/nodes', ollama_nodes, methods=['GET']),
+        Route('/knowledge/reload', reload_knowledge, methods=['POST']),
+        Route('/test', test_endpoint, methods=['GET']),
+    ])
+]
@@ -0,0 +1,99 @@
+"""
+ASGI 主應用文件
+校務系統AI助手 - 非同步模式（Starlette + AsyncAIModel）
+
+等待 Ollama 推論時不佔用 worker，單一程序即可同時處理數百個請求：
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import time
+
+# 啟動耗時的起點：開始匯入應用
+_BOOT_STARTED = time.perf_counter()
+
+from contextlib import asynccontextmanager
+from datetime import datetime
+import logging
+import os
+
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+# 載入環境變數（須在匯入 app.* 之前，模組層級的設定才會讀到 .env）
+load_dotenv()
+
+from app.routes import asgi_routes
+from app.models import metrics
+from app.models.async_ai_model import AsyncAIModel
+
+# 日誌設定
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# 初始化 AI 模型（不阻塞：後端探測與雲端 SDK 匯入在背景進行）
+ai_model = AsyncAIModel(boot_started=_BOOT_STARTED)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.ai_model = ai_model
+    yield
+    # worker 結束時釋放 Ollama 連線池
+    await ai_model.aclose()
+
+
+class FirstRequestMiddleware:
+    """記錄從開始匯入應用到收到第一個請求的時間"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            ai_model.mark_first_request()
+        await self.app(scope, receive, send)
+
+
+async def health_check(request):
+    """健康檢查端點：內容同 Flask 版（ready、backends、startup；?ready=1 尚未就緒時返回 503）"""
+    readiness = ai_model.readiness()
+    status = 503 if request.query_params.get('ready') and not readiness['ready'] else 200
+    return JSONResponse({
+        'status': 'healthy',
+        'timestamp': datetime.now().isoformat(),
+        'version': '1.0.0',
+        **readiness
+    }, status_code=status)
+
+
+async def metrics_endpoint(request):
+    """Prometheus 文字格式指標；設定 METRICS_DIR 時彙總所有 worker"""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ] + asgi_routes.routes,
+    middleware=[
+        Middleware(FirstRequestMiddleware),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+    ],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', 5000))
+    logger.info(f'啟動 ASGI 應用，監聽 localhost:{port}')
+    uvicorn.run(app, host='0.0.0.0', port=port)
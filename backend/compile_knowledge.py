@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+知識庫編譯腳本
+將 app/knowledge/knowledge_base.json 與其關鍵字自動機、BM25 索引編譯成可 mmap 的二進位檔，
+讓所有 gunicorn worker 共用同一份知識庫與索引頁面，載入時不需重建索引
+
+用法:
+    python compile_knowledge.py                 # 編譯
+    python compile_knowledge.py --with-vectors  # 一併寫入向量索引 (需先以 dense 模式建好索引)
+    python compile_knowledge.py --measure       # 比較 JSON 與二進位格式的 worker 啟動時間與記憶體
+                                                # (RETRIEVER_SCORER=bm25 量測 BM25 索引)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app.models.kb_binary import compile_knowledge_base, default_binary_path  # noqa: E402
+from app.models.dense_retriever import VectorIndex, content_hash  # noqa: E402
+
+DEFAULT_SOURCE = BACKEND_DIR / 'app' / 'knowledge' / 'knowledge_base.json'
+DEFAULT_INDEX_DIR = BACKEND_DIR / 'app' / 'knowledge' / 'index'
+
+# 在子程序中建立檢索器，回報載入耗時與常駐記憶體
+_MEASURE_SNIPPET = r'''
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {backend!r})
+from app.models.retriever import LightweightRetriever
+retriever = LightweightRetriever({source!r})
+elapsed = (time.perf_counter() - started) * 1000
+rss_kb = 0
+with open('/proc/self/status') as f:
+    for line in f:
+        if line.startswith('VmRSS:'):
+            rss_kb = int(line.split()[1])
+print(json.dumps({{'startup_ms': round(elapsed, 2), 'rss_kb': rss_kb, 'load_stats': retriever.load_stats}}))
+'''
+
+
+def load_vectors(source, index_dir):
+    """讀取向量索引，僅在內容雜湊與知識庫完全一致時使用"""
+    with open(source, 'r', encoding='utf-8') as f:
+        chunks = json.load(f).get('chunks', [])
+    meta, vectors = VectorIndex(index_dir, embedder=None).load(mmap_mode=None)
+    if meta is None or vectors is None:
+        raise SystemExit('❌ 找不到向量索引，請先以 RETRIEVER_BACKEND=dense 啟動一次以建立索引')
+    if meta.get('hashes') != [content_hash(c.get('content', '')) for c in chunks]:
+        raise SystemExit('❌ 向量索引與知識庫內容不一致，請先以 RETRIEVER_BACKEND=dense 啟動一次以更新索引')
+    return vectors, meta.get('model')
+
+
+def measure(source, binary_mode):
+    """在全新的子程序中量測一次檢索器啟動"""
+    env = dict(os.environ, KNOWLEDGE_BINARY=binary_mode, KNOWLEDGE_RELOAD_INTERVAL='0')
+    code = _MEASURE_SNIPPET.format(backend=str(BACKEND_DIR), source=str(source))
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='編譯知識庫為二進位格式')
+    parser.add_argument('--source', default=str(DEFAULT_SOURCE), help='knowledge_base.json 路徑')
+    parser.add_argument('--output', default=None, help='輸出路徑（預設與 JSON 同目錄的 .bin）')
+    parser.add_argument('--with-vectors', action='store_true', help='一併寫入向量索引')
+    parser.add_argument('--index-dir', default=os.getenv('DENSE_INDEX_DIR') or str(DEFAULT_INDEX_DIR),
+                        help='向量索引目錄')
+    parser.add_argument('--measure', action='store_true', help='比較 JSON 與二進位格式的啟動時間與記憶體')
+    args = parser.parse_args()
+
+    vectors, vector_model = None, None
+    if args.with_vectors:
+        vectors, vector_model = load_vectors(args.source, args.index_dir)
+
+    output = compile_knowledge_base(args.source, args.output, vectors=vectors, vector_model=vector_model)
+    print(f'✅ 已編譯: {output} ({os.path.getsize(output)} bytes)')
+
+    if args.measure:
+        if args.output and args.output != default_binary_path(args.source):
+            os.environ['KNOWLEDGE_BINARY_PATH'] = args.output
+        for mode in ('off', 'auto'):
+            result = measure(args.source, mode)
+            label = 'JSON  ' if mode == 'off' else 'binary'
+            print(f"📊 {label}: 啟動 {result['startup_ms']} ms, RSS {result['rss_kb']} KB, "
+                  f"讀取 {result['load_stats'].get('read_ms')} ms, 建索引 {result['load_stats'].get('index_ms')} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+gunicorn 設定
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+import shutil
+
+from dotenv import load_dotenv
+
+# 設定檔在載入應用之前執行，先載入 .env，worker 數、執行緒數與 METRICS_DIR 才會讀到 .env 的設定
+load_dotenv()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+
+# 每個 worker 以多個執行緒處理請求，推論准入控制（見 app/models/admission.py）的排隊與 429 才會生效；
+# sync worker 一次只處理一個請求，永遠不會排隊。預設執行緒數 = Ollama 同時推論數 + 排隊上限 + 4，
+# 佇列滿時的請求仍有執行緒可以立即返回 429
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS') or
+              int(os.getenv('OLLAMA_MAX_CONCURRENCY', '2')) + int(os.getenv('OLLAMA_MAX_QUEUE', '32')) + 4)
+# gthread 的逾時只檢查 worker 是否存活，長時間的推論與串流不會被中斷
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+
+def on_starting(server):
+    """啟動時清空上一次執行留下的指標快照，避免計數器帶入舊值"""
+    metrics_dir = os.getenv('METRICS_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+常見問題回答預先產生腳本
+以本地 Ollama 模型為 app/knowledge/knowledge_base.json 的每個片段產生標準回答，
+寫回片段的 answer 欄位（answer_hash 為產生時的內容雜湊、answer_model 為產生的模型）；
+片段內容修改後回答即過期，執行時只重新產生過期或缺少的回答
+
+用法:
+    python precompute_answers.py                      # 產生缺少或過期的回答
+    python precompute_answers.py --model qwen2.5      # 指定模型
+    python precompute_answers.py --ids login_issue --force
+    python precompute_answers.py --dry-run            # 只列出需要產生的片段
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+BACKEND_DIR = Path(__file__).parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app.models.faq import answer_hash, stored_answer  # noqa: E402
+from app.models.kb_binary import MappedKnowledgeBase, compile_knowledge_base, default_binary_path  # noqa: E402
+
+DEFAULT_SOURCE = BACKEND_DIR / 'app' / 'knowledge' / 'knowledge_base.json'
+
+SYSTEM_PROMPT = """你是成功大學校務系統的客服人員，負責撰寫常見問題的標準回答。
+回答會直接顯示給師生，不會附上截圖或參考資料，因此：
+1. 只根據提供的說明回答，不要加入說明中沒有的資訊
+2. 先直接回答問題，再列出具體步驟（如果適用）
+3. 保留說明中的聯絡方式與網址
+4. 用繁體中文回答，語氣親切專業，300 字以內"""
+
+
+def chunk_question(chunk):
+    """片段描述的問題：內容中第一個以問號結尾的句子，沒有時用標題"""
+    lines = [line.strip() for line in chunk.get('content', '').splitlines() if line.strip()]
+    for line in lines:
+        if line.endswith(('？', '?')):
+            return line
+    title = next((line.lstrip('#').strip() for line in lines if line.startswith('#')), '')
+    return title or str(chunk.get('id', ''))
+
+
+def build_prompt(chunk):
+    return f"""【說明】
+{chunk.get('content', '')}
+
+【常見問題】
+{chunk_question(chunk)}
+
+請根據說明撰寫這個常見問題的標準回答："""
+
+
+def generate_answer(session, ollama_url, model, chunk, timeout):
+    """呼叫 Ollama /api/generate 產生一個片段的回答"""
+    response = session.post(
+        f'{ollama_url}/api/generate',
+        json={
+            'model': model,
+            'system': SYSTEM_PROMPT,
+            'prompt': build_prompt(chunk),
+            'stream': False,
+            'options': {'temperature': 0.2},
+        },
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    answer = response.json().get('response', '').strip()
+    if not answer:
+        raise RuntimeError('模型沒有產生回答')
+    return answer
+
+
+def format_knowledge_base(data):
+    """與手動編輯的 knowledge_base.json 相同的格式：每個欄位一行，列表寫在同一行"""
+    lines = ['{', '  "chunks": [']
+    chunks = data.get('chunks', [])
+    for index, chunk in enumerate(chunks):
+        fields = [f'      {json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}'
+                  for key, value in chunk.items()]
+        lines.append('    {')
+        lines.append(',\n'.join(fields))
+        lines.append('    }' + (',' if index < len(chunks) - 1 else ''))
+    lines.append('  ]')
+    for key, value in data.items():
+        if key != 'chunks':
+            lines[-1] += ','
+            lines.append(f'  {json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_knowledge_base(path, data):
+    """先寫入暫存檔再替換，運行中的 worker 不會讀到寫到一半的知識庫"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(format_knowledge_base(data))
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='為知識庫片段預先產生標準回答')
+    parser.add_argument('--source', default=str(DEFAULT_SOURCE), help='knowledge_base.json 路徑')
+    parser.add_argument('--ollama-url', default=os.getenv('OLLAMA_URL', 'http://localhost:11434'))
+    parser.add_argument('--model', default=os.getenv('FAQ_ANSWER_MODEL', 'qwen2.5'), help='產生回答的 Ollama 模型')
+    parser.add_argument('--ids', nargs='*', help='只處理指定 id 的片段')
+    parser.add_argument('--force', action='store_true', help='回答未過期也重新產生')
+    parser.add_argument('--dry-run', action='store_true', help='只列出需要產生的片段')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    with open(args.source, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    chunks = data.get('chunks', [])
+    pending = [
+        chunk for chunk in chunks
+        if (not args.ids or chunk.get('id') in args.ids) and (args.force or stored_answer(chunk) is None)
+    ]
+    print(f'📋 共 {len(chunks)} 個片段，需要產生 {len(pending)} 個回答')
+    if args.dry_run or not pending:
+        for chunk in pending:
+            print(f"  - {chunk.get('id')}: {chunk_question(chunk)}")
+        return
+
+    session = requests.Session()
+    generated = 0
+    for chunk in pending:
+        started = time.perf_counter()
+        try:
+            answer = generate_answer(session, args.ollama_url, args.model, chunk, args.timeout)
+        except Exception as e:
+            print(f"❌ {chunk.get('id')}: {e}")
+            continue
+        chunk['answer'] = answer
+        chunk['answer_hash'] = answer_hash(chunk)
+        chunk['answer_model'] = args.model
+        generated += 1
+        print(f"✅ {chunk.get('id')} ({time.perf_counter() - started:.1f}s, {len(answer)} 字)")
+        # 每產生一個就寫回，中途中斷時已產生的回答不會遺失
+        write_knowledge_base(args.source, data)
+
+    print(f'💾 已寫入 {generated} 個回答: {args.source}')
+    binary_path = default_binary_path(args.source)
+    if generated and os.path.exists(binary_path):
+        # 二進位知識庫與 JSON 不一致時會被忽略，一併重新編譯（保留原本的向量）
+        mapped = MappedKnowledgeBase(binary_path)
+        vectors = None if mapped.vectors is None or len(mapped) != len(chunks) else mapped.vectors.copy()
+        compile_knowledge_base(args.source, binary_path, vectors=vectors, vector_model=mapped.vector_model)
+        print(f'✅ 已重新編譯: {binary_path}')
+
+
+if __name__ == '__main__':
+    main()
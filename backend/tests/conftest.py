@@ -0,0 +1,45 @@
+"""
+pytest 共用設定：讓測試以 backend/ 為根目錄匯入 app 套件
+    cd backend && python -m pytest -q tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+# 涵蓋重疊、重複、大小寫、英文與空字串關鍵字的小型知識庫
+SAMPLE_CHUNKS = [
+    {'id': 'password', 'keywords': ['密碼', '忘記密碼', '重設密碼', 'Password'],
+     'content': '# 忘記密碼\n\n請至登入頁點選「忘記密碼」，依照信件指示重設密碼。'},
+    {'id': 'graduate', 'keywords': ['畢業', '畢業生', '無法登入', '畢業'],
+     'content': '# 畢業生使用權限\n\n學生畢業半年後即無法登入數位學習平臺，請自行備份課程資料。'},
+    {'id': 'upload', 'keywords': ['上傳', '作業', '檔案大小', 'upload'],
+     'content': '# 作業上傳\n\n作業檔案大小上限為 100MB，上傳失敗時請確認網路連線。'},
+    {'id': 'login', 'keywords': ['登入', '帳號', 'login', ''],
+     'content': '# 登入說明\n\n請使用學號與校務系統密碼登入；帳號被鎖定時請聯絡計網中心。'},
+    {'id': 'browser', 'keywords': ['瀏覽器', 'Chrome', 'chrome'],
+     'content': '# 建議瀏覽器\n\n建議使用最新版 Chrome 或 Firefox，並允許彈出視窗。'},
+]
+
+SAMPLE_QUESTIONS = [
+    '我忘記密碼了怎麼重設密碼？',
+    '畢業生還能登入嗎？畢業半年後無法登入',
+    'How do I upload homework? 作業檔案大小限制',
+    'Chrome 瀏覽器無法 LOGIN',
+    'PASSWORD reset',
+    '完全無關的問題',
+    '',
+]
+
+
+@pytest.fixture
+def knowledge_base_path(tmp_path):
+    """寫入 SAMPLE_CHUNKS 的知識庫 JSON"""
+    path = tmp_path / 'knowledge_base.json'
+    path.write_text(json.dumps({'chunks': SAMPLE_CHUNKS}, ensure_ascii=False), encoding='utf-8')
+    return path
@@ -0,0 +1,141 @@
+"""推論准入控制：名額、排隊優先順序、佇列滿與排隊逾時"""
+import asyncio
+import threading
+import time
+
+import pytest
+from flask import Flask, g
+
+from app.models.admission import AdmissionController, QueueFullError
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, '等待逾時'
+        time.sleep(0.005)
+
+
+def test_admits_up_to_max_concurrency():
+    controller = AdmissionController('test', max_concurrency=2, max_queue=0)
+    assert controller.acquire() == {'queue_depth': 0, 'queue_wait_ms': pytest.approx(0, abs=50)}
+    controller.acquire()
+    with pytest.raises(QueueFullError):
+        controller.acquire()
+    controller.release()
+    controller.acquire()
+    stats = controller.stats()
+    assert stats['active'] == 2
+    assert stats['admitted'] == 3
+    assert stats['rejected'] == 1
+
+
+def test_queue_full_suggests_retry_after():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=1, queue_timeout=5)
+    controller.acquire()
+    controller.release(service_time=4.0)
+    controller.acquire()
+    waiter = threading.Thread(target=lambda: (controller.acquire(), controller.release()))
+    waiter.start()
+    wait_until(lambda: controller.queued == 1)
+    with pytest.raises(QueueFullError) as raised:
+        controller.acquire()
+    # 前面還有一個排隊中的請求：(1 + 1) × 4 秒
+    assert raised.value.retry_after == 8
+    controller.release()
+    waiter.join()
+    assert controller.stats()['active'] == 0
+
+
+def test_queue_timeout():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=4, queue_timeout=0.05)
+    controller.acquire()
+    with pytest.raises(QueueFullError):
+        controller.acquire()
+    stats = controller.stats()
+    assert stats['timeouts'] == 1
+    assert stats['queued'] == 0
+    # 逾時的等待者不會佔用之後釋放的名額
+    controller.release()
+    assert controller.stats()['active'] == 0
+
+
+def test_priority_order():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=4, queue_timeout=5)
+    controller.acquire()
+    order = []
+
+    def request(name, priority):
+        info = controller.acquire(priority)
+        order.append((name, info['queue_depth']))
+        controller.release()
+
+    threads = [threading.Thread(target=request, args=('batch', 5))]
+    threads[0].start()
+    wait_until(lambda: controller.queued == 1)
+    threads.append(threading.Thread(target=request, args=('interactive', 0)))
+    threads[1].start()
+    wait_until(lambda: controller.queued == 2)
+    controller.release()
+    for thread in threads:
+        thread.join()
+    assert order == [('interactive', 1), ('batch', 0)]
+
+
+def test_async_waiter_woken_by_thread_release():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=4, queue_timeout=5)
+
+    async def main():
+        await controller.acquire_async()
+        task = asyncio.create_task(controller.acquire_async())
+        while controller.queued != 1:
+            await asyncio.sleep(0.005)
+        threading.Thread(target=controller.release).start()
+        info = await task
+        controller.release()
+        return info
+
+    info = asyncio.run(main())
+    assert info['queue_depth'] == 0
+    assert controller.stats()['active'] == 0
+
+
+def test_async_cancelled_waiter_leaves_queue():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=4, queue_timeout=5)
+
+    async def main():
+        await controller.acquire_async()
+        task = asyncio.create_task(controller.acquire_async())
+        while controller.queued != 1:
+            await asyncio.sleep(0.005)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        controller.release()
+
+    asyncio.run(main())
+    stats = controller.stats()
+    assert stats['queued'] == 0
+    assert stats['active'] == 0
+
+
+class _BusyModel:
+    def process_query(self, **kwargs):
+        raise QueueFullError('ollama 推論佇列已滿，請稍後再試', retry_after=7)
+
+
+def test_ask_returns_429_with_retry_after():
+    from app.routes import api_routes
+
+    app = Flask(__name__)
+    app.register_blueprint(api_routes.bp)
+
+    @app.before_request
+    def setup_context():
+        g.ai_model = _BusyModel()
+
+    response = app.test_client().post('/api/ask', json={
+        'question': '忘記密碼怎麼辦', 'screenshot': 'aGk=', 'model': 'qwen2.5'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '7'
+    assert response.get_json()['retry_after'] == 7
@@ -0,0 +1,56 @@
+"""參考資料打包：依模型的 token 預算挑選段落"""
+from app.models.context_packer import ContextPacker, estimate_tokens, split_passages, trim_to_budget
+from app.models.model_registry import ModelRegistry
+
+from conftest import SAMPLE_CHUNKS
+
+LONG_CHUNK = {
+    'id': 'long',
+    'content': '# 作業上傳\n\n'
+               + '\n\n'.join(f'第 {i} 段說明：作業上傳前請確認檔案格式與大小，系統會在上傳完成後寄送通知信。' * 3
+                             for i in range(12))
+               + '\n\n## 忘記密碼\n\n請至登入頁點選忘記密碼，依照信件指示重設密碼。',
+}
+
+
+def ranked(*chunks, confidence=0.75):
+    return [{'chunk': chunk, 'score': 1, 'confidence': confidence} for chunk in chunks]
+
+
+def test_estimate_tokens():
+    assert estimate_tokens('忘記密碼') == 4
+    assert estimate_tokens('password 12345') == 2 + 2
+    assert estimate_tokens('a\n\n\nb，') == 1 + 1 + 1 + 1
+
+
+def test_split_passages_attaches_headings():
+    assert split_passages('# 標題\n\n第一段\n\n## 小節\n第二段') == [('# 標題', '第一段'), ('## 小節', '第二段')]
+
+
+def test_trim_to_budget_keeps_whole_sentences():
+    assert trim_to_budget('第一句。第二句很長很長很長。', 5) == '第一句。'
+    assert trim_to_budget('沒有句點的一長串文字', 4).endswith('…')
+
+
+def test_everything_fits_keeps_original_contents():
+    packer = ContextPacker(ModelRegistry.load())
+    packed = packer.pack('忘記密碼', ranked(*SAMPLE_CHUNKS[:2]), 'qwen2.5')
+    assert packed.texts == [chunk['content'] for chunk in SAMPLE_CHUNKS[:2]]
+    assert packed.trimmed_tokens == 0
+    assert packed.budget == 1536
+
+
+def test_over_budget_keeps_relevant_passages_within_budget():
+    packer = ContextPacker(ModelRegistry([]), default_budget=120)
+    packed = packer.pack('忘記密碼怎麼重設', ranked(LONG_CHUNK), 'unknown')
+    assert packed.budget == 120
+    assert 0 < packed.tokens <= 120
+    assert packed.trimmed_tokens == estimate_tokens(LONG_CHUNK['content']) - packed.tokens
+    assert '## 忘記密碼' in packed.texts[0]
+    assert '重設密碼' in packed.texts[0]
+
+
+def test_zero_budget_is_unlimited():
+    packer = ContextPacker(ModelRegistry([]), default_budget=0)
+    packed = packer.pack('作業', ranked(LONG_CHUNK), None)
+    assert packed.texts == [LONG_CHUNK['content']]
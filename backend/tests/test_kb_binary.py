@@ -0,0 +1,56 @@
+"""二進位知識庫：mmap 載入後的檢索結果必須與直接讀取 JSON 相同"""
+import pytest
+
+from app.models.kb_binary import MappedKnowledgeBase, compile_knowledge_base
+from app.models.retriever import LightweightRetriever
+
+from conftest import SAMPLE_CHUNKS, SAMPLE_QUESTIONS
+
+
+@pytest.fixture
+def retrievers(knowledge_base_path, monkeypatch):
+    """返回 scorer 名稱 → (JSON 檢索器, 二進位檢索器)"""
+    monkeypatch.delenv('KNOWLEDGE_BINARY_PATH', raising=False)
+    compile_knowledge_base(str(knowledge_base_path))
+
+    def build(scorer):
+        monkeypatch.setenv('KNOWLEDGE_BINARY', 'off')
+        from_json = LightweightRetriever(str(knowledge_base_path), scorer=scorer)
+        monkeypatch.setenv('KNOWLEDGE_BINARY', 'auto')
+        from_binary = LightweightRetriever(str(knowledge_base_path), scorer=scorer)
+        assert from_json.load_stats['format'] == 'json'
+        assert from_binary.load_stats['format'] == 'binary'
+        return from_json, from_binary
+
+    return build
+
+
+def test_mapped_chunks_round_trip(knowledge_base_path):
+    mapped = MappedKnowledgeBase(compile_knowledge_base(str(knowledge_base_path)))
+    assert len(mapped) == len(SAMPLE_CHUNKS)
+    for chunk, expected in zip(mapped, SAMPLE_CHUNKS):
+        assert chunk['id'] == expected['id']
+        assert list(chunk['keywords']) == expected['keywords']
+        assert chunk['content'] == expected['content']
+    assert mapped.is_fresh(str(knowledge_base_path))
+
+
+@pytest.mark.parametrize('scorer', ['keywords', 'bm25'])
+def test_binary_ranking_matches_json(retrievers, scorer):
+    from_json, from_binary = retrievers(scorer)
+    for question in SAMPLE_QUESTIONS:
+        expected = from_json.rank(question, max_chunks=len(SAMPLE_CHUNKS))
+        actual = from_binary.rank(question, max_chunks=len(SAMPLE_CHUNKS))
+        assert [r['chunk']['id'] for r in actual] == [r['chunk']['id'] for r in expected]
+        assert [r['score'] for r in actual] == pytest.approx([r['score'] for r in expected])
+        assert [r['confidence'] for r in actual] == pytest.approx([r['confidence'] for r in expected])
+
+
+def test_stale_binary_falls_back_to_json(knowledge_base_path, monkeypatch):
+    monkeypatch.delenv('KNOWLEDGE_BINARY_PATH', raising=False)
+    monkeypatch.setenv('KNOWLEDGE_BINARY', 'auto')
+    compile_knowledge_base(str(knowledge_base_path))
+    knowledge_base_path.write_text(knowledge_base_path.read_text(encoding='utf-8') + '\n', encoding='utf-8')
+    retriever = LightweightRetriever(str(knowledge_base_path), scorer='keywords')
+    assert retriever.load_stats['format'] == 'json'
+    assert len(retriever.chunks) == len(SAMPLE_CHUNKS)
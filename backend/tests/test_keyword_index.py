@@ -0,0 +1,64 @@
+"""關鍵字索引：Aho-Corasick 自動機與逐一子字串比對的計分必須一致"""
+import pytest
+
+from app.models.keyword_index import FlatKeywordIndex, KeywordIndex
+from app.models.scorers import KeywordScorer
+
+from conftest import SAMPLE_CHUNKS, SAMPLE_QUESTIONS
+
+
+def baseline_scores(chunks, question):
+    """原本的計分方式：每個關鍵字以子字串比對，命中一次加一分"""
+    question_lower = question.lower()
+    scores = {}
+    for index, chunk in enumerate(chunks):
+        hits = sum(1 for keyword in chunk.get('keywords', []) if keyword.lower() in question_lower)
+        if hits:
+            scores[index] = hits
+    return scores
+
+
+@pytest.mark.parametrize('question', SAMPLE_QUESTIONS)
+def test_matches_substring_baseline(question):
+    index = KeywordIndex(SAMPLE_CHUNKS)
+    assert index.score(question) == baseline_scores(SAMPLE_CHUNKS, question)
+
+
+@pytest.mark.parametrize('question', SAMPLE_QUESTIONS)
+def test_flat_index_matches_automaton(question):
+    index = KeywordIndex(SAMPLE_CHUNKS)
+    flat = FlatKeywordIndex(index.to_arrays())
+    assert flat.score(question) == index.score(question)
+
+
+def test_overlapping_keywords_all_match():
+    # 「忘記密碼」「重設密碼」與其後綴「密碼」都要算到，重複的「畢業」計兩次
+    scores = KeywordIndex(SAMPLE_CHUNKS).score('忘記密碼後重設密碼，畢業')
+    assert scores[0] == 3
+    assert scores[1] == 2
+
+
+def test_empty_keyword_always_matches():
+    assert KeywordIndex(SAMPLE_CHUNKS).score('完全無關的問題') == {3: 1}
+
+
+def test_generated_keywords_match_baseline():
+    # 字母表很小的關鍵字，製造大量共同前後綴與失敗連結
+    alphabet = 'ab密碼'
+    chunks = []
+    for i in range(40):
+        keywords = [''.join(alphabet[(i * 7 + j * 3 + k) % len(alphabet)] for k in range(1 + (i + j) % 4))
+                    for j in range(1 + i % 5)]
+        chunks.append({'keywords': keywords})
+    questions = ['abab密碼ba', '密碼密碼a', 'bbbbab', 'AB密碼', '碼a碼b']
+    index = KeywordIndex(chunks)
+    flat = FlatKeywordIndex(index.to_arrays())
+    for question in questions:
+        expected = baseline_scores(chunks, question)
+        assert index.score(question) == expected
+        assert flat.score(question) == expected
+
+
+def test_keyword_scorer_uses_index():
+    scorer = KeywordScorer(SAMPLE_CHUNKS)
+    assert scorer.score('upload 作業') == {2: 2, 3: 1}
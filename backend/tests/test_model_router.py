@@ -0,0 +1,75 @@
+"""模型路由：依問題是否提到畫面與檢索信心度選擇本地模型"""
+from collections import namedtuple
+
+import pytest
+
+from app.models import metrics
+from app.models.model_registry import ModelRegistry
+from app.models.model_router import ModelRouter
+
+Context = namedtuple('Context', ['question', 'confidence'])
+
+
+@pytest.fixture
+def registry():
+    return ModelRegistry.load()
+
+
+def make_router(registry, installed=None, **kwargs):
+    def resolve(name):
+        spec = registry.get(name)
+        if spec is None:
+            return 'ollama', 'qwen2.5'
+        return spec.backend, spec.name
+
+    def available(name):
+        return installed is None or name in installed
+
+    return ModelRouter(registry, resolve, registry.get, available, **kwargs)
+
+
+def test_text_model_stays_text_at_low_confidence(registry):
+    decision = make_router(registry).route('qwen2.5', Context('忘記密碼怎麼辦', 0.2))
+    assert (decision.model, decision.reason) == ('qwen2.5', 'requested')
+    assert decision.signals['needs_vision'] is False
+
+
+def test_screen_reference_routes_to_vision(registry):
+    decision = make_router(registry).route('qwen2.5', Context('畫面上的錯誤訊息是什麼意思？', 0.9))
+    assert (decision.model, decision.reason) == ('llava', 'screen_reference')
+
+
+def test_confident_vision_request_uses_text_model(registry):
+    router = make_router(registry)
+    decision = router.route('llava', Context('忘記密碼怎麼辦', 0.9))
+    assert (decision.model, decision.reason) == ('qwen2.5', 'text_sufficient')
+    decision = router.route('llava', Context('忘記密碼怎麼辦', 0.3))
+    assert (decision.model, decision.reason) == ('llava', 'requested')
+
+
+def test_unavailable_model_falls_back_within_kind(registry):
+    decision = make_router(registry, installed={'bakllava', 'qwen2.5'}).route('llava', Context('這個按鈕', 0.1))
+    assert (decision.model, decision.reason) == ('bakllava', 'unavailable')
+
+
+def test_load_balance_between_same_kind(registry):
+    router = make_router(registry)
+    router.observe('llava', 8.0)
+    router.observe('bakllava', 2.0)
+    with router.track('llava'):
+        decision = router.route('llava', Context('畫面上的按鈕', 0.1))
+    assert (decision.model, decision.reason) == ('bakllava', 'load_balance')
+
+
+def test_cloud_and_off_mode_are_not_rerouted(registry):
+    assert make_router(registry).route('gpt', Context('忘記密碼', 0.9)).model == 'gpt'
+    router = make_router(registry, mode='off')
+    assert router.route('llava', Context('忘記密碼', 0.9)).model == 'llava'
+
+
+def test_unknown_model_name_is_not_a_metric_label(registry, monkeypatch):
+    labels = []
+    monkeypatch.setattr(metrics.ROUTING_DECISIONS, 'inc', lambda **kw: labels.append(kw))
+    decision = make_router(registry).route('<script>任意名稱', Context('忘記密碼', 0.9))
+    assert decision.reason == 'default'
+    assert labels[0]['requested'] == 'default'
@@ -0,0 +1,36 @@
+"""BM25 計分與斷詞"""
+from app.models.scorers import BM25Scorer, tokenize
+
+from conftest import SAMPLE_CHUNKS
+
+
+def test_tokenize_cjk_ngrams_and_words():
+    assert tokenize('重設Password') == ['password', '重設']
+    assert tokenize('忘記密碼') == ['忘記', '記密', '密碼', '忘記密', '記密碼']
+    # 過短的中文字串整段保留
+    assert tokenize('密 Chrome 100') == ['chrome', '100', '密']
+
+
+def test_bm25_ranks_relevant_chunk_first():
+    scorer = BM25Scorer(SAMPLE_CHUNKS)
+    scores = scorer.score('忘記密碼要怎麼重設？')
+    assert max(scores, key=scores.get) == 0
+    scores = scorer.score('畢業生還能登入嗎')
+    assert max(scores, key=scores.get) == 1
+
+
+def test_bm25_min_score_and_unknown_terms():
+    scorer = BM25Scorer(SAMPLE_CHUNKS)
+    assert scorer.score('完全無關') == {}
+    assert scorer.score('') == {}
+    assert all(score >= scorer.min_score for score in scorer.score('作業上傳 upload').values())
+
+
+def test_bm25_reuses_previous_term_counts():
+    previous = BM25Scorer(SAMPLE_CHUNKS)
+    changed = [dict(chunk) for chunk in SAMPLE_CHUNKS]
+    changed[2]['content'] = '# 作業上傳\n\n上傳上限已調整為 200MB。'
+    rebuilt = BM25Scorer(changed, previous=previous)
+    fresh = BM25Scorer(changed)
+    for question in ('作業上傳上限', '忘記密碼', 'chrome'):
+        assert rebuilt.score(question) == fresh.score(question)
@@ -0,0 +1,140 @@
+"""single-flight：程序內與跨 worker 合併相同的請求，失敗的結果不提供給其他 worker"""
+import multiprocessing
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from app.models.single_flight import SingleFlight
+
+requires_fork = pytest.mark.skipif(not hasattr(os, 'fork'), reason='跨 worker 合併需要 fork 與 fcntl')
+
+
+def test_concurrent_callers_share_one_computation():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return 'answer'
+
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+    leader.start()
+    started.wait(2)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', compute))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()['coalesced'] < 3:
+        time.sleep(0.005)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 3
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_errors_propagate_to_waiters():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def compute():
+        started.set()
+        release.wait(2)
+        raise RuntimeError('backend down')
+
+    def call():
+        try:
+            flight.do('key', compute)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(2)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    while flight.stats()['coalesced'] < 1:
+        time.sleep(0.005)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert errors == ['backend down', 'backend down']
+
+
+def test_do_async_coalesces():
+    import asyncio
+
+    flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async('key', compute) for _ in range(4)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 3
+
+
+def _worker(directory, key, answer, delay, log_path, queue):
+    """另一個 worker 程序：計算時在 log_path 記錄一行"""
+    flight = SingleFlight(directory)
+
+    def compute():
+        with open(log_path, 'a', encoding='utf-8') as f:
+            f.write(f'{os.getpid()}\n')
+        time.sleep(delay)
+        return answer
+
+    queue.put(flight.do(key, compute, publishable=lambda result: not result.startswith('錯誤')))
+
+
+def _run_two_workers(tmp_path, answer):
+    directory = str(tmp_path / 'inflight')
+    log_path = tmp_path / 'computations.log'
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    leader = context.Process(target=_worker, args=(directory, 'key', answer, 0.5, str(log_path), queue))
+    leader.start()
+    while not log_path.exists():
+        time.sleep(0.005)
+    follower = context.Process(target=_worker, args=(directory, 'key', answer, 0.0, str(log_path), queue))
+    follower.start()
+    results = [queue.get(timeout=10), queue.get(timeout=10)]
+    leader.join(10)
+    follower.join(10)
+    return directory, results, log_path.read_text(encoding='utf-8').split()
+
+
+@requires_fork
+def test_cross_worker_coalescing(tmp_path):
+    directory, results, computations = _run_two_workers(tmp_path, 'answer')
+    assert len(computations) == 1
+    assert sorted(results) == [('answer', False), ('answer', True)]
+    # 結果檔含使用者的問題與回答，只給服務帳號存取
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    for name in os.listdir(directory):
+        assert stat.S_IMODE(os.stat(os.path.join(directory, name)).st_mode) & 0o077 == 0
+
+
+@requires_fork
+def test_failed_result_is_not_shared_across_workers(tmp_path):
+    directory, results, computations = _run_two_workers(tmp_path, '錯誤: 後端逾時')
+    assert len(computations) == 2
+    assert results == [('錯誤: 後端逾時', False)] * 2
+    assert not [name for name in os.listdir(directory) if name.endswith('.result')]
@@ -1,7 +1,40 @@
-# Flask 應用工廠（可選）
+"""
+WSGI 入口
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+backend/ 目錄下的 `import app` 會解析為 app/ 套件而不是 app.py，
+gunicorn 無法以 app:app 找到 Flask 應用；這裡依檔案路徑載入 app.py 並匯出其中的 app
+"""
+import importlib.util
+import os
+import sys
+
 from flask import Flask
 from flask_cors import CORS
 
+_MODULE_NAME = 'campus_ai_main'
+
+
+def _load_main():
+    """載入 app.py（同一程序只載入一次）"""
+    module = sys.modules.get(_MODULE_NAME)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(
+            _MODULE_NAME, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[_MODULE_NAME] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[_MODULE_NAME]
+            raise
+    return module
+
+
+app = _load_main().app
+
+
+# Flask 應用工廠（可選）
 def create_app(config_name='development'):
     """應用工廠函數"""
     app = Flask(__name__)
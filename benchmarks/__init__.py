@@ -0,0 +1,5 @@
+"""
+效能測試工具
+- fake_ollama: 模擬 Ollama API 的本地伺服器，不需要 GPU 與真正的模型
+- load_test: 重播 /api/ask 流量，輸出吞吐量、延遲百分位數與記憶體，結果存成 JSON 供比較
+"""
@@ -0,0 +1,396 @@
+"""
+模擬 Ollama API 的本地伺服器
+不需要 GPU 與真正的模型，以可調整的延遲與生成速度回應，用來壓測後端：
+
+    python -m benchmarks.fake_ollama --port 11434 --tokens-per-second 30 --response-tokens 64
+
+支援的端點：
+- POST /api/generate: 串流 (NDJSON) 與非串流，回傳 Ollama 的計時欄位 (eval_count、load_duration 等)；
+  prompt 為空時只載入模型 (done_reason=load)，keep_alive=0 卸載；
+  與執行器的 KV 快取相同，和同一模型上一個請求相同的開頭（system 與 prompt 套用範本後）不計入 prompt_eval_count，
+  raw=true 時不套用範本
+- POST /api/embeddings、/api/embed: 以字元 bigram 雜湊產生的確定性向量，相近的文字有相近的向量
+- GET /api/tags、/api/ps、/api/version
+- GET /stats: 模擬伺服器自己的請求統計（非 Ollama API）
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DEFAULT_MODELS = ('llava:latest', 'qwen2.5:latest', 'bakllava:latest', 'nomic-embed-text:latest')
+
+# 生成內容循環使用的文字（每個字元視為一個 token）
+_RESPONSE_TEXT = '根據截圖，這是數位學習平臺的課程頁面。您可以在左側選單找到作業與公告，點選後即可查看詳細內容。'
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓字元各算一個，其他字元約四個一個"""
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class FakeOllama:
+    """模擬 Ollama 的模型狀態、延遲與統計"""
+
+    def __init__(self, models=DEFAULT_MODELS, latency=0.05, jitter=0.1, tokens_per_second=30.0,
+                 prompt_tokens_per_second=500.0, response_tokens=64, image_tokens=576,
+                 load_duration=0.0, keep_alive=300.0, parallel=4, embedding_dim=768,
+                 embedding_latency=0.01, seed=None):
+        """
+        Args:
+            models: 已安裝的模型名稱
+            latency: 每個請求的固定延遲（秒）
+            jitter: 延遲與生成速度的隨機變動比例
+            tokens_per_second: 生成速度
+            prompt_tokens_per_second: prompt 處理速度
+            response_tokens: 每個回應的 token 數
+            image_tokens: 每張圖片佔用的 prompt token 數
+            load_duration: 模型未載入時的載入秒數
+            keep_alive: 預設的模型閒置保留秒數
+            parallel: 每個模型同時處理的請求數，0 表示不限制
+            embedding_dim: 向量維度
+            embedding_latency: 每次 embedding 的延遲（秒）
+        """
+        self.models = {name: 4_000_000_000 for name in models}
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.response_tokens = response_tokens
+        self.image_tokens = image_tokens
+        self.load_duration = load_duration
+        self.keep_alive = keep_alive
+        self.parallel = parallel
+        self.embedding_dim = embedding_dim
+        self.embedding_latency = embedding_latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._resident = {}  # 模型名稱 -> 到期時間
+        self._kv = {}  # 模型名稱 -> 上一個請求套用範本後的 prompt（模擬 KV 快取）
+        self.stats = {'generate': 0, 'generate_stream': 0, 'embeddings': 0, 'loads': 0, 'prompt_tokens': 0,
+                      'eval_tokens': 0, 'active': 0, 'max_active': 0}
+
+    def resolve(self, model):
+        """找出已安裝的模型名稱；未指定標籤時視為 latest"""
+        if model in self.models:
+            return model
+        if ':' not in model and f'{model}:latest' in self.models:
+            return f'{model}:latest'
+        return None
+
+    def _vary(self, value):
+        if not self.jitter:
+            return value
+        return max(0.0, value * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def _slot(self, model):
+        with self._lock:
+            if model not in self._slots:
+                self._slots[model] = threading.BoundedSemaphore(self.parallel) if self.parallel > 0 else None
+            return self._slots[model]
+
+    def _load(self, model, keep_alive):
+        """
+        確認模型已載入並更新到期時間
+
+        Returns:
+            載入秒數（已在記憶體中時為 0）
+        """
+        now = time.time()
+        with self._lock:
+            expires = self._resident.get(model)
+            loaded = expires is not None and expires > now
+            if keep_alive is not None and _parse_duration(keep_alive) == 0:
+                self._resident.pop(model, None)
+            else:
+                seconds = self.keep_alive if keep_alive is None else _parse_duration(keep_alive)
+                self._resident[model] = now + seconds if seconds >= 0 else float('inf')
+            if not loaded:
+                self.stats['loads'] += 1
+                self._kv.pop(model, None)
+        return 0.0 if loaded else self._vary(self.load_duration)
+
+    def generate(self, body):
+        """
+        依請求內容產生回應事件；串流時每個片段一個事件，非串流時只有最後的完整事件
+
+        Yields:
+            Ollama /api/generate 的回應字典
+        """
+        model = self.resolve(body.get('model', ''))
+        started = time.perf_counter()
+        prompt = (body.get('system') or '') + (body.get('prompt') or '')
+        # 簡化的 chat 範本；raw 時直接使用 prompt
+        if body.get('raw'):
+            templated = body.get('prompt') or ''
+        else:
+            templated = f"<|system|>{body.get('system') or ''}<|user|>{body.get('prompt') or ''}"
+        images = body.get('images') or []
+        stream = body.get('stream', True)
+
+        slot = self._slot(model)
+        if slot is not None:
+            slot.acquire()
+        with self._lock:
+            self.stats['generate_stream' if stream else 'generate'] += 1
+            self.stats['active'] += 1
+            self.stats['max_active'] = max(self.stats['max_active'], self.stats['active'])
+        try:
+            load = self._load(model, body.get('keep_alive'))
+            time.sleep(self._vary(self.latency) + load)
+
+            if not prompt and not images:
+                # 空 prompt：只載入 (keep_alive=0 時卸載) 模型
+                keep_alive = body.get('keep_alive')
+                unload = keep_alive is not None and _parse_duration(keep_alive) == 0
+                yield self._final(model, started, load, 0, 0.0, 0, 0.0, done_reason='unload' if unload else 'load')
+                return
+
+            prompt_tokens = estimate_tokens(templated) + self.image_tokens * len(images)
+            context = body.get('context') or []
+            with self._lock:
+                previous = self._kv.get(model, '')
+                self._kv[model] = templated
+            common = len(os.path.commonprefix([previous, templated]))
+            # 沿用 context 與 KV 快取中相同開頭的部分不需要重新處理
+            new_tokens = max(1, prompt_tokens - len(context) - estimate_tokens(templated[:common]))
+            prompt_seconds = self._vary(new_tokens / self.prompt_tokens_per_second)
+            time.sleep(prompt_seconds)
+
+            eval_started = time.perf_counter()
+            interval = 1 / self._vary(self.tokens_per_second) if self.tokens_per_second > 0 else 0.0
+            parts = []
+            for i in range(self.response_tokens):
+                time.sleep(interval)
+                token = _RESPONSE_TEXT[i % len(_RESPONSE_TEXT)]
+                parts.append(token)
+                if stream:
+                    yield {'model': model, 'created_at': _now(), 'response': token, 'done': False}
+            eval_seconds = time.perf_counter() - eval_started
+
+            with self._lock:
+                self.stats['prompt_tokens'] += new_tokens
+                self.stats['eval_tokens'] += self.response_tokens
+            final = self._final(model, started, load, new_tokens, prompt_seconds, self.response_tokens, eval_seconds)
+            final['context'] = list(range(prompt_tokens + self.response_tokens))
+            if not stream:
+                final['response'] = ''.join(parts)
+            yield final
+        finally:
+            with self._lock:
+                self.stats['active'] -= 1
+            if slot is not None:
+                slot.release()
+
+    @staticmethod
+    def _final(model, started, load, prompt_tokens, prompt_seconds, eval_tokens, eval_seconds, done_reason='stop'):
+        return {
+            'model': model,
+            'created_at': _now(),
+            'response': '',
+            'done': True,
+            'done_reason': done_reason,
+            'total_duration': int((time.perf_counter() - started) * 1e9),
+            'load_duration': int(load * 1e9),
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(prompt_seconds * 1e9),
+            'eval_count': eval_tokens,
+            'eval_duration': int(eval_seconds * 1e9),
+        }
+
+    def embed(self, text):
+        """字元 bigram 雜湊到固定維度後正規化：共享字詞越多的文字 cosine 相似度越高"""
+        with self._lock:
+            self.stats['embeddings'] += 1
+        time.sleep(self._vary(self.embedding_latency))
+        vector = np.zeros(self.embedding_dim, dtype=np.float32)
+        text = text or ' '
+        for i in range(max(1, len(text) - 1)):
+            digest = hashlib.md5(text[i:i + 2].encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.embedding_dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def tags(self):
+        return {'models': [
+            {'name': name, 'model': name, 'size': size, 'modified_at': _now(),
+             'details': {'family': name.split(':')[0], 'families': self._families(name),
+                         'parameter_size': '7B', 'quantization_level': 'Q4_0'}}
+            for name, size in self.models.items()
+        ]}
+
+    @staticmethod
+    def _families(name):
+        """與真正的 Ollama 相同，視覺模型的 families 含圖片編碼器 (clip)"""
+        family = name.split(':')[0]
+        return [family, 'clip'] if 'llava' in family or 'vl' in family else [family]
+
+    def ps(self):
+        now = time.time()
+        with self._lock:
+            resident = {m: e for m, e in self._resident.items() if e > now}
+            self._resident = resident
+        return {'models': [
+            {'name': name, 'model': name, 'size': self.models[name], 'size_vram': self.models[name],
+             'expires_at': (datetime.fromtimestamp(expires, timezone.utc).isoformat()
+                            if expires != float('inf') else '2318-01-01T00:00:00Z')}
+            for name, expires in resident.items()
+        ]}
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _parse_duration(value):
+    """keep_alive 可為秒數或 '5m'、'1h' 等字串；負數表示永久保留"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    for suffix in ('ms', 's', 'm', 'h'):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * units[suffix]
+    return float(value)
+
+
+def make_handler(fake):
+    """建立綁定到 FakeOllama 實例的請求處理類別"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, obj, status=200):
+            body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            if self.path == '/api/tags':
+                self._send_json(fake.tags())
+            elif self.path == '/api/ps':
+                self._send_json(fake.ps())
+            elif self.path == '/api/version':
+                self._send_json({'version': '0.0.0-fake'})
+            elif self.path == '/stats':
+                with fake._lock:
+                    self._send_json(dict(fake.stats))
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            try:
+                body = self._read_json()
+            except ValueError:
+                return self._send_json({'error': 'invalid JSON'}, 400)
+
+            if self.path in ('/api/embeddings', '/api/embed'):
+                if fake.resolve(body.get('model', '')) is None:
+                    return self._send_json({'error': f"model '{body.get('model')}' not found"}, 404)
+                if self.path == '/api/embeddings':
+                    return self._send_json({'embedding': fake.embed(body.get('prompt', ''))})
+                inputs = body.get('input', '')
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                return self._send_json({'model': body['model'], 'embeddings': [fake.embed(t) for t in inputs]})
+
+            if self.path != '/api/generate':
+                return self._send_json({'error': 'not found'}, 404)
+            if fake.resolve(body.get('model', '')) is None:
+                return self._send_json({'error': f"model '{body.get('model')}' not found, try pulling it first"}, 404)
+
+            if not body.get('stream', True):
+                for event in fake.generate(body):
+                    pass
+                return self._send_json(event)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event in fake.generate(body):
+                self._write_chunk(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+    return Handler
+
+
+def serve(fake, host='127.0.0.1', port=11434):
+    """
+    在背景執行緒啟動模擬伺服器
+
+    Returns:
+        ThreadingHTTPServer（呼叫 shutdown() 停止）
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-ollama', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模擬 Ollama API 的本地伺服器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS), help='已安裝的模型，逗號分隔')
+    parser.add_argument('--latency', type=float, default=0.05, help='每個請求的固定延遲秒數')
+    parser.add_argument('--jitter', type=float, default=0.1, help='隨機變動比例')
+    parser.add_argument('--tokens-per-second', type=float, default=30.0)
+    parser.add_argument('--prompt-tokens-per-second', type=float, default=500.0)
+    parser.add_argument('--response-tokens', type=int, default=64)
+    parser.add_argument('--image-tokens', type=int, default=576)
+    parser.add_argument('--load-duration', type=float, default=0.0, help='模型未載入時的載入秒數')
+    parser.add_argument('--keep-alive', type=float, default=300.0, help='模型閒置保留秒數')
+    parser.add_argument('--parallel', type=int, default=4, help='每個模型同時處理的請求數，0 表示不限制')
+    parser.add_argument('--embedding-dim', type=int, default=768)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeOllama(
+        models=[m.strip() for m in args.models.split(',') if m.strip()],
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        prompt_tokens_per_second=args.prompt_tokens_per_second,
+        response_tokens=args.response_tokens,
+        image_tokens=args.image_tokens,
+        load_duration=args.load_duration,
+        keep_alive=args.keep_alive,
+        parallel=args.parallel,
+        embedding_dim=args.embedding_dim,
+        seed=args.seed,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    server.daemon_threads = True
+    print(f'🧪 模擬 Ollama 伺服器: http://{args.host}:{args.port}  模型: {", ".join(fake.models)}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
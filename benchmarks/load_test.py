@@ -0,0 +1,469 @@
+"""
+/api/ask 壓力測試
+以多個並行客戶端重播帶截圖的問答請求（混合模型、部分重複的問題與截圖），
+輸出吞吐量、p50/p95/p99 延遲與後端記憶體，結果存成 JSON 以便比較不同版本：
+
+    # 自動啟動模擬 Ollama 與 gunicorn 後端
+    python -m benchmarks.load_test --spawn-ollama --server gunicorn --requests 200 --concurrency 16
+
+    # 對已在執行的後端測試，並與上一次結果比較
+    python -m benchmarks.load_test --target http://localhost:5000 --compare benchmarks/results/baseline.json
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import requests
+from PIL import Image, ImageDraw
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT / 'backend'
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+# 使用者實際會問的問題：知識庫內的問題與需要看畫面的問題
+QUESTIONS = [
+    '畢業生還能使用數位學習平臺嗎？',
+    '畢業後多久就不能登入了？',
+    '作業要在哪裡繳交？',
+    '這個頁面是在做什麼？',
+    '畫面上的紅色按鈕是什麼功能？',
+    '我要怎麼下載上課的講義？',
+    '為什麼我看不到這門課？',
+    '這裡顯示的成績是什麼意思？',
+    '要怎麼查看課程公告？',
+    '螢幕上這個錯誤訊息要怎麼處理？',
+    '忘記密碼怎麼辦？',
+    '平臺可以用來備份檔案嗎？',
+]
+
+SCREEN_SIZES = ((1366, 768), (1920, 1080), (1280, 800), (1536, 864))
+
+# 比較時越大越好的指標，其餘越小越好
+_HIGHER_IS_BETTER = {'throughput_rps'}
+
+
+def make_screenshot(rng, size):
+    """產生類似學習平臺頁面的截圖：頂端工具列、側邊選單與多行文字區塊"""
+    width, height = size
+    image = Image.new('RGB', size, (250, 250, 250))
+    draw = ImageDraw.Draw(image)
+    accent = tuple(rng.randint(0, 160) for _ in range(3))
+    draw.rectangle([0, 0, width, 64], fill=accent)
+    draw.rectangle([0, 64, 240, height], fill=(236, 239, 243))
+    for y in range(90, height - 40, 36):
+        draw.rectangle([20, y, 20 + rng.randint(120, 200), y + 14], fill=(120, 120, 130))
+    y = 100
+    while y < height - 60:
+        for line in range(rng.randint(2, 6)):
+            length = rng.randint(width // 4, width - 320)
+            draw.rectangle([280, y, 280 + length, y + 12], fill=(60, 60, 70))
+            y += 24
+        if rng.random() < 0.3:
+            draw.rectangle([280, y, 440, y + 36], fill=(200, 40, 40) if rng.random() < 0.5 else accent)
+            y += 48
+        y += 28
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def parse_mix(text):
+    """'llava=0.6,qwen2.5=0.4' -> ([模型], [權重])"""
+    models, weights = [], []
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name:
+            models.append(name)
+            weights.append(float(weight or 1))
+    return models, weights
+
+
+def build_workload(args):
+    """
+    產生請求序列；repeat_ratio 比例的請求重複先前的問題、截圖與模型（讓快取與請求合併發揮作用）
+
+    Returns:
+        [{'question', 'model', 'screenshot'(index)}]
+    """
+    rng = random.Random(args.seed)
+    models, weights = parse_mix(args.models)
+    workload = []
+    for _ in range(args.requests):
+        if workload and rng.random() < args.repeat_ratio:
+            workload.append(dict(rng.choice(workload)))
+            continue
+        workload.append({
+            'question': rng.choice(QUESTIONS),
+            'model': rng.choices(models, weights)[0],
+            'screenshot': rng.randrange(args.screenshots),
+        })
+    return workload
+
+
+def send_request(session, target, endpoint, item, images, encoded, timeout):
+    """
+    送出一個請求
+
+    Returns:
+        {'model', 'status', 'latency', 'ttft'(僅串流), 'error'}
+    """
+    started = time.perf_counter()
+    result = {'model': item['model'], 'status': None, 'latency': None, 'ttft': None, 'error': None}
+    try:
+        if endpoint == 'upload':
+            response = session.post(
+                f'{target}/api/ask/upload',
+                params={'question': item['question'], 'model': item['model']},
+                data=images[item['screenshot']],
+                headers={'Content-Type': 'image/png'},
+                timeout=timeout
+            )
+            response.content
+        elif endpoint == 'stream':
+            response = session.post(
+                f'{target}/api/ask/stream',
+                json={'question': item['question'], 'screenshot': encoded[item['screenshot']], 'model': item['model']},
+                stream=True,
+                timeout=timeout
+            )
+            for line in response.iter_lines():
+                if line.startswith(b'event: token') and result['ttft'] is None:
+                    result['ttft'] = time.perf_counter() - started
+                elif line.startswith(b'event: error'):
+                    result['error'] = 'stream error event'
+        else:
+            response = session.post(
+                f'{target}/api/ask',
+                json={'question': item['question'], 'screenshot': encoded[item['screenshot']], 'model': item['model']},
+                timeout=timeout
+            )
+            response.content
+        result['status'] = response.status_code
+        if response.status_code != 200 and result['error'] is None:
+            result['error'] = f'HTTP {response.status_code}'
+    except requests.RequestException as e:
+        result['error'] = type(e).__name__
+    result['latency'] = time.perf_counter() - started
+    return result
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    array = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(array, [50, 95, 99])
+    return {'p50': round(float(p50), 2), 'p95': round(float(p95), 2), 'p99': round(float(p99), 2),
+            'mean': round(float(array.mean()), 2), 'max': round(float(array.max()), 2)}
+
+
+class RSSSampler:
+    """定期讀取 /proc 取得後端程序（含所有子程序，例如 gunicorn worker）的 RSS 總和"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    @staticmethod
+    def _children(pid):
+        children = []
+        try:
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    children.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+        return children
+
+    @staticmethod
+    def _rss(pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def tree_rss(self):
+        total, stack = 0, [self.pid]
+        while stack:
+            pid = stack.pop()
+            total += self._rss(pid)
+            stack.extend(self._children(pid))
+        return total
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.samples.append(self.tree_rss())
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if os.path.isdir(f'/proc/{self.pid}'):
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        samples = [s for s in self.samples if s]
+        if not samples:
+            return None
+        return {'peak_mb': round(max(samples) / 2**20, 1), 'final_mb': round(samples[-1] / 2**20, 1)}
+
+
+def wait_for(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'等待 {url} 逾時')
+
+
+def spawn_ollama(args):
+    command = [
+        sys.executable, '-m', 'benchmarks.fake_ollama',
+        '--port', str(args.ollama_port),
+        '--latency', str(args.ollama_latency),
+        '--tokens-per-second', str(args.tokens_per_second),
+        '--response-tokens', str(args.response_tokens),
+        '--parallel', str(args.ollama_parallel),
+        '--seed', str(args.seed),
+    ]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+    wait_for(f'http://127.0.0.1:{args.ollama_port}/api/tags')
+    return process
+
+
+def spawn_server(args, ollama_url):
+    """啟動受測後端：flask (開發伺服器) / gunicorn / asgi (uvicorn)"""
+    env = dict(os.environ, PORT=str(args.port), DEBUG='False', FLASK_DEBUG='False',
+               GUNICORN_BIND=f'127.0.0.1:{args.port}', GUNICORN_WORKERS=str(args.workers))
+    if ollama_url:
+        env['OLLAMA_URL'] = ollama_url
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app']
+        if args.threads:
+            command[3:3] = ['--threads', str(args.threads)]
+    elif args.server == 'asgi':
+        command = ['uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(args.port),
+                   '--workers', str(args.workers), '--log-level', 'warning']
+    else:
+        command = [sys.executable, 'app.py']
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for(f'http://127.0.0.1:{args.port}/health')
+    return process
+
+
+def run(args, target, server_pid=None, ollama_url=None):
+    """執行一次壓測並返回結果字典"""
+    rng = random.Random(args.seed)
+    sizes = [SCREEN_SIZES[i % len(SCREEN_SIZES)] for i in range(args.screenshots)]
+    images = [make_screenshot(rng, size) for size in sizes]
+    encoded = [base64.b64encode(image).decode('ascii') for image in images]
+    workload = build_workload(args)
+
+    local = threading.local()
+
+    def worker(item):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return send_request(local.session, target, args.endpoint, item, images, encoded, args.timeout)
+
+    # 暖機：讓模型載入與連線建立不計入結果
+    if args.warmup:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(worker, workload[:args.warmup]))
+
+    sampler = RSSSampler(server_pid).start() if server_pid else None
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(worker, workload))
+    elapsed = time.perf_counter() - started
+    memory = sampler.stop() if sampler else None
+
+    ok = [r for r in results if r['status'] == 200 and r['error'] is None]
+    statuses = {}
+    for r in results:
+        key = str(r['status'] or r['error'])
+        statuses[key] = statuses.get(key, 0) + 1
+    by_model = {}
+    for model in sorted({r['model'] for r in results}):
+        latencies = [r['latency'] for r in ok if r['model'] == model]
+        by_model[model] = {'requests': sum(1 for r in results if r['model'] == model),
+                           'ok': len(latencies), **percentiles(latencies)}
+
+    summary = {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': len(results) - len(ok),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': percentiles([r['latency'] for r in ok]),
+        'statuses': statuses,
+        'by_model': by_model,
+        'server_memory': memory,
+        'client_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if args.endpoint == 'stream':
+        summary['ttft_ms'] = percentiles([r['ttft'] for r in ok if r['ttft'] is not None])
+    if ollama_url:
+        try:
+            summary['ollama_stats'] = requests.get(f'{ollama_url}/stats', timeout=5).json()
+        except (requests.RequestException, ValueError):
+            pass
+    return summary
+
+
+def flatten(summary):
+    """比較用的主要指標"""
+    latency = summary['latency_ms']
+    values = {
+        'throughput_rps': summary['throughput_rps'],
+        'p50_ms': latency['p50'],
+        'p95_ms': latency['p95'],
+        'p99_ms': latency['p99'],
+        'errors': summary['errors'],
+    }
+    if summary.get('server_memory'):
+        values['server_peak_mb'] = summary['server_memory']['peak_mb']
+    return values
+
+
+def compare(current, baseline, threshold):
+    """
+    與基準結果比較並列印差異
+
+    Returns:
+        退步超過 threshold (比例) 的指標名稱列表
+    """
+    regressions = []
+    now, before = flatten(current), flatten(baseline)
+    print(f'\n{"指標":<16}{"基準":>12}{"本次":>12}{"變化":>10}')
+    for key, value in now.items():
+        old = before.get(key)
+        if value is None or old is None:
+            continue
+        change = (value - old) / old if old else 0.0
+        worse = -change if key in _HIGHER_IS_BETTER else change
+        flag = ' ⚠️' if worse > threshold and key != 'errors' else ''
+        if key == 'errors' and value > old:
+            flag = ' ⚠️'
+        if flag:
+            regressions.append(key)
+        print(f'{key:<16}{old:>12}{value:>12}{change:>+10.1%}{flag}')
+    return regressions
+
+
+def print_summary(summary):
+    latency = summary['latency_ms']
+    print(f"\n請求: {summary['requests']}  成功: {summary['ok']}  失敗: {summary['errors']}  狀態: {summary['statuses']}")
+    print(f"耗時: {summary['elapsed_s']} s  吞吐量: {summary['throughput_rps']} req/s")
+    print(f"延遲 (ms): p50={latency['p50']}  p95={latency['p95']}  p99={latency['p99']}  max={latency['max']}")
+    if 'ttft_ms' in summary:
+        ttft = summary['ttft_ms']
+        print(f"首個片段 (ms): p50={ttft['p50']}  p95={ttft['p95']}  p99={ttft['p99']}")
+    for model, stats in summary['by_model'].items():
+        print(f"  {model:<12} {stats['ok']}/{stats['requests']}  p50={stats['p50']}  p95={stats['p95']}")
+    if summary.get('server_memory'):
+        memory = summary['server_memory']
+        print(f"後端記憶體: 峰值 {memory['peak_mb']} MB  結束時 {memory['final_mb']} MB")
+    if summary.get('ollama_stats'):
+        stats = summary['ollama_stats']
+        print(f"Ollama 呼叫: {stats['generate'] + stats['generate_stream']}  同時處理峰值: {stats['max_active']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/api/ask 壓力測試')
+    parser.add_argument('--target', help='已在執行的後端 URL；未指定時以 --server 啟動')
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'asgi'), default='gunicorn')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='gunicorn 每個 worker 的執行緒數（預設依 gunicorn.conf.py）')
+    parser.add_argument('--endpoint', choices=('ask', 'upload', 'stream'), default='ask')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=8, help='不計入結果的暖機請求數')
+    parser.add_argument('--models', default='llava=0.5,qwen2.5=0.3,bakllava=0.2', help='模型=權重，逗號分隔')
+    parser.add_argument('--screenshots', type=int, default=8, help='不同截圖的數量')
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help='重複先前請求的比例')
+    parser.add_argument('--timeout', type=float, default=180)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--spawn-ollama', action='store_true', help='啟動模擬 Ollama 伺服器')
+    parser.add_argument('--ollama-port', type=int, default=11500)
+    parser.add_argument('--ollama-latency', type=float, default=0.05)
+    parser.add_argument('--tokens-per-second', type=float, default=30.0)
+    parser.add_argument('--response-tokens', type=int, default=64)
+    parser.add_argument('--ollama-parallel', type=int, default=4)
+    parser.add_argument('--name', help='結果檔名（預設為時間戳記）')
+    parser.add_argument('--output', help='結果 JSON 路徑（預設 benchmarks/results/<name>.json）')
+    parser.add_argument('--compare', help='與此基準結果 JSON 比較')
+    parser.add_argument('--threshold', type=float, default=0.1, help='視為退步的變化比例')
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        ollama_url = None
+        if args.spawn_ollama:
+            processes.append(spawn_ollama(args))
+            ollama_url = f'http://127.0.0.1:{args.ollama_port}'
+        server_pid = None
+        target = args.target
+        if target is None:
+            server = spawn_server(args, ollama_url)
+            processes.append(server)
+            server_pid = server.pid
+            target = f'http://127.0.0.1:{args.port}'
+
+        print(f'🚀 壓測 {target} ({args.endpoint})：{args.requests} 個請求，並行 {args.concurrency}，模型 {args.models}')
+        summary = run(args, target.rstrip('/'), server_pid, ollama_url)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=30)
+
+    print_summary(summary)
+
+    name = args.name or datetime.now().strftime('%Y%m%d-%H%M%S')
+    output = Path(args.output) if args.output else RESULTS_DIR / f'{name}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'name')}
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'name': name, 'timestamp': datetime.now().isoformat(), 'config': config, 'summary': summary},
+                  f, ensure_ascii=False, indent=2)
+    print(f'\n💾 結果已儲存: {output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline['summary'], args.threshold)
+        if regressions:
+            print(f'\n❌ 效能退步: {", ".join(regressions)}')
+            sys.exit(1)
+        print('\n✅ 未發現效能退步')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+後端啟動耗時測試
+啟動後端程序並量測：程序啟動到第一個成功回應 (/health) 的時間、到就緒（第一次後端探測完成）的時間，
+以及後端自己回報的 init / discovery / first_request 耗時：
+
+    # Ollama 無法連接時的啟動（不應被探測逾時拖慢）
+    python -m benchmarks.startup --server flask --runs 5
+
+    # 搭配模擬 Ollama
+    python -m benchmarks.startup --server gunicorn --spawn-ollama
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+from .load_test import BACKEND_DIR, ROOT, wait_for
+
+
+def measure(args, ollama_url):
+    """
+    啟動一次後端並量測
+
+    Returns:
+        {'first_response_ms', 'ready_ms', 'startup': 後端回報的耗時}
+    """
+    env = dict(os.environ, PORT=str(args.port), DEBUG='False', FLASK_DEBUG='False', OLLAMA_URL=ollama_url,
+               GUNICORN_BIND=f'127.0.0.1:{args.port}', GUNICORN_WORKERS=str(args.workers))
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app']
+    elif args.server == 'asgi':
+        command = ['uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(args.port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, 'app.py']
+
+    url = f'http://127.0.0.1:{args.port}/health'
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = {'first_response_ms': None, 'ready_ms': None, 'startup': None}
+    try:
+        deadline = started + args.timeout
+        while time.perf_counter() < deadline:
+            try:
+                body = requests.get(url, timeout=1).json()
+            except (requests.RequestException, ValueError):
+                time.sleep(0.01)
+                continue
+            elapsed = round((time.perf_counter() - started) * 1000, 2)
+            if result['first_response_ms'] is None:
+                result['first_response_ms'] = elapsed
+            if body.get('ready'):
+                result['ready_ms'] = elapsed
+                result['startup'] = body.get('startup')
+                result['ollama_available'] = body.get('backends', {}).get('ollama', {}).get('available')
+                break
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='後端啟動耗時測試')
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'asgi'), default='flask')
+    parser.add_argument('--port', type=int, default=5051)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--spawn-ollama', action='store_true', help='啟動模擬 Ollama；未指定時 Ollama 為無法連接的位址')
+    parser.add_argument('--ollama-port', type=int, default=11501)
+    parser.add_argument('--output', help='結果 JSON 路徑')
+    args = parser.parse_args()
+
+    ollama = None
+    if args.spawn_ollama:
+        ollama = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_ollama', '--port', str(args.ollama_port)],
+                                  cwd=ROOT, stdout=subprocess.DEVNULL)
+        wait_for(f'http://127.0.0.1:{args.ollama_port}/api/tags')
+    try:
+        runs = [measure(args, f'http://127.0.0.1:{args.ollama_port}') for _ in range(args.runs)]
+    finally:
+        if ollama is not None:
+            ollama.terminate()
+            ollama.wait(timeout=30)
+
+    for i, run in enumerate(runs, 1):
+        print(f'#{i}  第一個回應 {run["first_response_ms"]} ms  就緒 {run["ready_ms"]} ms  後端回報 {run["startup"]}')
+    first = [r['first_response_ms'] for r in runs if r['first_response_ms'] is not None]
+    ready = [r['ready_ms'] for r in runs if r['ready_ms'] is not None]
+    summary = {
+        'server': args.server,
+        'ollama': 'fake' if args.spawn_ollama else 'unreachable',
+        'first_response_ms_median': round(statistics.median(first), 2) if first else None,
+        'ready_ms_median': round(statistics.median(ready), 2) if ready else None,
+        'runs': runs,
+    }
+    print(f'\n中位數：第一個回應 {summary["first_response_ms_median"]} ms，就緒 {summary["ready_ms_median"]} ms')
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f'💾 結果已儲存: {args.output}')
+
+
+if __name__ == '__main__':
+    main()